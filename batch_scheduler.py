@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Async micro-batching scheduler between an HTTP endpoint and a batched model call.
+
+The /api/diagnosis handler of Medical_Assistant-final.ipynb calls run_llm() once per
+request, so concurrent users queue behind each other in FastAPI's thread pool while
+the GPU decodes a batch of one, and nothing limits how many requests pile up.
+MicroBatchScheduler collects requests for a few milliseconds, runs them as one call
+of `generate_batch(prompts) -> texts` and hands every caller its own result.
+
+— How it works —
+* submit(prompt) puts a job (prompt + asyncio future) on the queue and awaits the
+  future. With MAX_QUEUE jobs already waiting it raises Overloaded at once —
+  the endpoint turns it into a 503 with Retry-After instead of letting latency grow
+  without bound.
+* One collector task takes the first job, then keeps taking jobs until MAX_BATCH
+  are collected or MAX_WAIT_MS have passed since the first one. Jobs whose caller
+  has gone away (cancelled future) are dropped before the batch runs.
+* The batch runs in a single worker thread (run_in_executor), so the event loop
+  keeps accepting and rejecting requests while the GPU works, and batches never
+  overlap on the device. Requests arriving meanwhile form the next batch.
+* An exception in generate_batch is set on every future of that batch; the
+  scheduler itself keeps running.
+* run_exclusive(fn, ...) runs work that cannot join a batch (a streamed generation)
+  on the same worker thread, between batches, and counts against the same queue
+  limit.
+
+Usage:
+    scheduler = MicroBatchScheduler(HFBatchGenerator(model, tokenizer), max_batch=8)
+    await scheduler.start()
+    text = await scheduler.submit(prompt)        # raises Overloaded when the queue is full
+    info = await scheduler.run_exclusive(generator.stream, prompt, emit, cancelled)
+    print(scheduler.stats.summary())
+    await scheduler.stop()
+"""
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+
+MAX_BATCH   = 8     # prompts per generate call
+MAX_WAIT_MS = 10    # how long the first job of a batch waits for company
+MAX_QUEUE   = 64    # jobs waiting (not yet in a batch) before submit() raises Overloaded
+
+
+class Overloaded(Exception):
+    """The queue is full; retry after `retry_after` seconds."""
+
+    def __init__(self, depth: int, retry_after: float):
+        super().__init__(f"queue full ({depth} waiting)")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class _Job(NamedTuple):
+    prompt: Any
+    future: asyncio.Future
+    t_submit: float
+
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+class SchedulerStats:
+    """Counters of one scheduler; summary() for logs, as_dict() for a health endpoint."""
+
+    WINDOW = 10_000   # latencies kept for the percentiles
+
+    def __init__(self):
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.exclusive = 0                   # run_exclusive() jobs
+        self.batches = 0
+        self.batch_items = 0
+        self.batch_seconds = 0.0
+        self.queue_waits: List[float] = []   # submit → batch start
+        self.latencies: List[float] = []     # submit → result
+
+    @classmethod
+    def _keep(cls, values: List[float], v: float):
+        values.append(v)
+        if len(values) > 2 * cls.WINDOW:
+            del values[:-cls.WINDOW]
+
+    def add_wait(self, seconds: float):
+        self._keep(self.queue_waits, seconds)
+
+    def add_latency(self, seconds: float):
+        self._keep(self.latencies, seconds)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "submitted": self.submitted, "rejected": self.rejected, "completed": self.completed,
+            "failed": self.failed, "cancelled": self.cancelled, "batches": self.batches,
+            "exclusive": self.exclusive,
+            "mean_batch": round(self.batch_items / self.batches, 2) if self.batches else 0.0,
+            "batch_seconds": round(self.batch_seconds, 3),
+            "queue_wait_p50_ms": round(1e3 * _percentile(self.queue_waits, 0.50), 1),
+            "latency_p50_ms": round(1e3 * _percentile(self.latencies, 0.50), 1),
+            "latency_p95_ms": round(1e3 * _percentile(self.latencies, 0.95), 1),
+        }
+
+    def summary(self) -> str:
+        d = self.as_dict()
+        return (f"scheduler: {d['completed']} done, {d['rejected']} rejected (503), {d['failed']} failed | "
+                f"{d['batches']} batches, mean size {d['mean_batch']} | latency p50 {d['latency_p50_ms']} ms, "
+                f"p95 {d['latency_p95_ms']} ms | queue wait p50 {d['queue_wait_p50_ms']} ms")
+
+
+class MicroBatchScheduler:
+    """Collects submit() calls into batches for generate_batch (one batch on the device at a time)."""
+
+    def __init__(self, generate_batch: Callable[[List[Any]], List[Any]], max_batch: int = MAX_BATCH,
+                 max_wait_ms: float = MAX_WAIT_MS, max_queue: int = MAX_QUEUE):
+        self.generate_batch = generate_batch
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0.0, max_wait_ms) / 1e3
+        self.max_queue = max(1, max_queue)
+        self.stats = SchedulerStats()
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._exclusive_waiting = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._mean_batch_s = 0.0   # EMA of batch time, for Retry-After
+
+    # ---- public ----------------------------------------------------------------
+
+    @property
+    def depth(self) -> int:
+        return (self._queue.qsize() if self._queue is not None else 0) + self._exclusive_waiting
+
+    async def start(self):
+        self._ensure_started()
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while not self._queue.empty():
+            job = self._queue.get_nowait()
+            if not job.future.done():
+                job.future.set_exception(RuntimeError("scheduler stopped"))
+        self._executor.shutdown(wait=True)
+
+    async def submit(self, prompt: Any) -> Any:
+        """Result of generate_batch for this prompt; raises Overloaded when MAX_QUEUE jobs are waiting."""
+        self._ensure_started()
+        self._admit()
+        job = _Job(prompt, asyncio.get_running_loop().create_future(), time.perf_counter())
+        self._queue.put_nowait(job)
+        self.stats.submitted += 1
+        return await job.future
+
+    def run_exclusive(self, fn: Callable[..., Any], *args) -> "asyncio.Future":
+        """
+        Future of fn(*args) run on the generate thread between batches. Overloaded is raised
+        here, synchronously, so a caller can still answer 503 before it starts a response.
+        """
+        self._ensure_started()
+        self._admit()
+        self._exclusive_waiting += 1
+        self.stats.exclusive += 1
+
+        def run():
+            self._loop.call_soon_threadsafe(self._exclusive_started)
+            return fn(*args)
+
+        return self._loop.run_in_executor(self._executor, run)
+
+    # ---- internals -------------------------------------------------------------
+
+    def _ensure_started(self):
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()   # bounded by _admit(), together with the exclusive jobs
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-generate")
+        self._task = self._loop.create_task(self._collect())
+
+    def _admit(self):
+        if self.depth >= self.max_queue:
+            self.stats.rejected += 1
+            batches_ahead = self.max_queue / self.max_batch + 1
+            raise Overloaded(self.depth, round(max(1.0, batches_ahead * self._mean_batch_s), 1))
+
+    def _exclusive_started(self):
+        self._exclusive_waiting -= 1
+
+    async def _take_batch(self) -> List[_Job]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        live = [job for job in batch if not job.future.done()]   # caller disconnected → cancelled
+        self.stats.cancelled += len(batch) - len(live)
+        return live
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._take_batch()
+            if not batch:
+                continue
+            t0 = time.perf_counter()
+            for job in batch:
+                self.stats.add_wait(t0 - job.t_submit)
+            try:
+                results = await loop.run_in_executor(self._executor, self.generate_batch, [j.prompt for j in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"generate_batch returned {len(results)} results for {len(batch)} prompts")
+            except Exception as e:   # handed to every caller of this batch
+                self.stats.failed += len(batch)
+                for job in batch:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                continue
+            finally:
+                dt = time.perf_counter() - t0
+                self.stats.batches += 1
+                self.stats.batch_items += len(batch)
+                self.stats.batch_seconds += dt
+                self._mean_batch_s = dt if self.stats.batches == 1 else 0.8 * self._mean_batch_s + 0.2 * dt
+            now = time.perf_counter()
+            for job, result in zip(batch, results):
+                if not job.future.done():
+                    job.future.set_result(result)
+                    self.stats.completed += 1
+                    self.stats.add_latency(now - job.t_submit)
@@ -0,0 +1,754 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks + regression checks for the preprocessing helpers.
+
+Each sub-command first proves the fast path returns exactly what the reference
+implementation returns (on a built-in regression corpus and, optionally, on real
+files), then times both.
+
+    python bench.py header                      # built-in corpus, 100k synthetic cases
+    python bench.py header --input prompts_single_step_cot.txt
+    python bench.py header --cases 20000 --repeat 3
+    python bench.py judge                       # fast_judge rules corpus + speed
+    python bench.py judge --verify verify_single_step_cot.txt --results results/single_step_cot.jsonl
+    python bench.py extract                     # structured_output vs the old fence + greedy-regex parse
+    python bench.py extract --input results/single_step_cot.jsonl   # + recorded outputs / verdicts
+    python bench.py engine                      # meerkat_engine vs model.generate, tiny random Llama on CPU
+    python bench.py engine --requests 96 --batch 16 --max-new 256
+    python bench.py stop                        # stop_criteria corpus + replay of runaway answers
+    python bench.py service                     # /api/diagnosis load test, stub model: unbatched vs micro-batched
+    python bench.py service --requests 400 --concurrency 64 --queue 32
+    python bench.py stream                      # incremental parser == final parse; time to first condition (stub)
+    python bench.py stop --input per_method_outputs/results_single_step_cot.txt --tokenizer dmis-lab/meerkat-7b-v1.0
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+from pathlib import Path
+from typing import Callable, List
+
+
+# =============================================================================
+#                                  Helpers
+# =============================================================================
+
+def timeit(fn: Callable[[], object], repeat: int) -> float:
+    """Best-of-N wall time in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def report(name: str, n: int, t_ref: float, t_new: float):
+    print(f"  {name:<10} reference: {t_ref*1e3:9.1f} ms  ({n / t_ref:>10,.0f}/s)")
+    print(f"  {'':<10} fast path: {t_new*1e3:9.1f} ms  ({n / t_new:>10,.0f}/s)  → x{t_ref / t_new:.2f}")
+
+
+# =============================================================================
+#                     header: parse_case vs extract_* / redact
+# =============================================================================
+
+# Regression corpus: every header shape the reference code has a branch for.
+HEADER_CORPUS: List[str] = [
+    # typical prompts_*.txt block
+    "DxBench_481\nMigraine\n\nPatient Symptoms:\nExplicit: {\"headache\": \"True\"}\nImplicit: {}\n\nASSISTANT:\n",
+    # notebook format: blank line before ID, leading spaces, CRLF
+    "\r\nDxBench_12\r\n  Acute appendicitis  \r\nPatient Symptoms:\r\nExplicit: pain\r\n",
+    # alternative ID spellings
+    "dxbench-7\nGout\nSymptoms: big toe pain\n",
+    "DXBENCH 1148\nTinea pedis\nClinical Notes:\nitchy feet\n",
+    # GT before the ID line / no ID at all
+    "Psoriasis\nDxBench_3\nCase:\nplaques\n",
+    "Eczema\n\nExplicit Symptoms:\nitch\n",
+    # header present but no GT, only the ID
+    "DxBench_9\nPatient Symptoms:\ncough\n",
+    # several ID lines, extra header lines kept
+    "DxBench_10\nDxBench_11\nAsthma\nnote kept\n\nImplicit Symptoms:\nwheeze\n",
+    # no STOP header: fallback rules (GT = first text line after an ID)
+    "DxBench_20\nMeasles\nfever and rash\nDxBench_21\n",
+    "intro line\nDxBench_22\n\nRubella\nrest\n",
+    "just text\nno id\n",
+    "a\nb\nc\nd\ne\nf gt-candidate beyond 5 lines\n",
+    # ID line only inside the body (after the header)
+    "Varicella\nPatient Symptoms:\nblisters\nDxBench_30\n",
+    # "Case" as a header word, trailing whitespace everywhere
+    "DxBench_40   \nSinusitis   \n  case: recurrent  \nfacial pain   \n",
+    # empty / whitespace only
+    "",
+    "   \n\n",
+]
+
+def synthetic_case(rng: random.Random, i: int) -> str:
+    gt = rng.choice(["Migraine", "Gout", "Acute appendicitis", "Psoriasis", "Asthma"])
+    head = rng.choice([
+        f"DxBench_{i}\n{gt}\n\n",
+        f"\n  DxBench_{i}\n{gt}\n",
+        f"{gt}\nDxBench_{i}\n",
+        f"DxBench_{i}\n\n\n\n{gt}\nnote\n",
+    ])
+    sym = "".join(f"Explicit: {{\"symptom {k}\": \"True\"}}\n" for k in range(rng.randint(2, 20)))
+    tail = rng.choice(["Patient Symptoms:\n", "Symptoms:\n", "Case:\n", ""])
+    return head + tail + sym + "\nYou are a specialized medical AI assistant.\nASSISTANT:\n"
+
+def bench_header(args):
+    from generate import extract_id, extract_gt, redact_id_and_gt_for_api
+    from prompt_blocks import parse_case, iter_blocks, SEP_EQ
+
+    def reference(block):
+        return extract_id(block), extract_gt(block), redact_id_and_gt_for_api(block)
+
+    def fast(block):
+        c = parse_case(block)
+        return c.id, c.gt, c.body
+
+    rng = random.Random(0)
+    corpus = list(HEADER_CORPUS) + [synthetic_case(rng, i) for i in range(args.cases)]
+    if args.input:
+        corpus += list(iter_blocks(Path(args.input), separators=(SEP_EQ,)))
+
+    mismatches = 0
+    for block in corpus:
+        if reference(block) != fast(block):
+            mismatches += 1
+            if mismatches <= 5:
+                print("✗ mismatch on block:", repr(block[:200]))
+                print("    reference:", reference(block))
+                print("    fast     :", fast(block))
+    print(f"header: {len(corpus)} blocks, {mismatches} mismatches")
+    if mismatches:
+        sys.exit(1)
+
+    t_ref = timeit(lambda: [reference(b) for b in corpus], args.repeat)
+    t_new = timeit(lambda: [fast(b) for b in corpus], args.repeat)
+    report("header", len(corpus), t_ref, t_new)
+
+
+# =============================================================================
+#                   judge: fast_judge rules + agreement with the LLM
+# =============================================================================
+
+def _ranked(*names, best=None) -> str:
+    probs = [0.5, 0.2, 0.12, 0.1, 0.08, 0.05]
+    return json.dumps({"BEST": best or names[0], "RANKED": [[n, probs[i]] for i, n in enumerate(names)]})
+
+# (GT, assistant output, expected verdict as "TOP1/TOP3/TOP5" or None = deferred to the LLM)
+JUDGE_CORPUS = [
+    ("Migraine", _ranked("Migraine", "Tension headache", "Cluster headache"), "YES/YES/YES"),
+    ("Gout", _ranked("Pseudogout", "Septic arthritis", "Cellulitis", "Gout", "Trauma"), "NO/NO/YES"),
+    ("Psoriasis", _ranked("Atopic dermatitis", "Tinea corporis", "Lichen planus", "Seborrheic dermatitis", "Psoriasis"), "NO/NO/YES"),
+    ("Asthma", _ranked("Pneumonia", "Bronchiolitis", "Croup", "Foreign body", "GERD"), None),   # foreign body ∉ CONCEPTS
+    ("Cerebrovascular accident (CVA)", _ranked("Stroke", "TIA", "Migraine"), "YES/YES/YES"),
+    ("Myocardial infarction", _ranked("Unstable angina", "Heart attack", "Pericarditis"), "NO/YES/YES"),
+    ("Eczema", _ranked("Contact dermatitis", "Atopic dermatitis"), None),    # dermatitis ~ dermatitis
+    ("UTI", _ranked("Urinary tract infection", "Pyelonephritis"), "YES/YES/YES"),
+    ("Acute pancreatitis", _ranked("Chronic pancreatitis", "Cholecystitis"), None),
+    ("Diabetes mellitus", _ranked("Diabetic ketoacidosis", "Hyperthyroidism"), None),
+    ("Appendicitis", "The most likely diagnosis is appendicitis.", None),      # free text → LLM
+    ("Appendicitis", "```json\n" + _ranked("Appendicitis", "Ovarian torsion") + "\n```", "YES/YES/YES"),
+    ("Appendicitis", '{"BEST":"Appendicitis","RANKED":"oops"}', None),
+    ("Appendicitis", _ranked("Ovarian torsion", "Ectopic pregnancy", "Appendicitis", best="Appendicitis"), "YES/YES/YES"),
+    ("Appendicitis", _ranked("Torsion", "Ectopic pregnancy", "Cystitis", "Appendicitis", best="Appendicitis"), None),
+    ("<UNKNOWN_GT>", _ranked("Appendicitis"), None),
+    # synonyms without a shared word — formerly confident NO/NO/NO
+    ("Gastroesophageal reflux disease", _ranked("GERD", "Peptic ulcer"), "YES/YES/YES"),
+    ("Stroke", _ranked("Cerebral infarction", "Migraine"), "YES/YES/YES"),
+    ("Hypertension", _ranked("High blood pressure"), "YES/YES/YES"),
+    ("Heart failure", _ranked("CHF", "Pneumonia"), "YES/YES/YES"),
+    ("Tinea pedis", _ranked("Athlete's foot", "Cellulitis"), "YES/YES/YES"),
+    ("Chickenpox", _ranked("Varicella", "Measles"), "YES/YES/YES"),
+    ("Myasthenia gravis", _ranked("Guillain-Barre syndrome", "Botulism"), None),   # unknown, no shared word
+    ("Hypertension", _ranked("Migraine", "Tension headache", "Cluster headache"), "NO/NO/NO"),
+]
+
+# (output A, output B, same dedup key?) — formatting-only variants share a key, content never does
+DEDUP_CORPUS = [
+    (_ranked("Migraine", "Tension headache"), "```json\n" + _ranked("Migraine", "Tension headache") + "\n```", True),
+    ("**Migraine** is most likely", "Migraine is most likely", True),
+    ("## Diagnosis\n> Migraine", "Diagnosis\nMigraine", True),
+    ("Diagnosis:   Migraine\n\n", "Diagnosis: Migraine", True),
+    ('{"BEST":"Type 2 diabetes (HbA1c >6.5%)","RANKED":["a_b"]}',
+     '{"BEST":"Type 2 diabetes (HbA1c 6.5%)","RANKED":["a b"]}', False),
+    ("a_b", "a b", False),
+    ("HbA1c >6.5%", "HbA1c 6.5%", False),
+    ("5 * 3 = 15", "5 3 = 15", False),
+    ("C# and F#", "C and F", False),
+    ("my__dunder__name", "mydundername", False),
+    ("x ** 2", "x 2", False),
+    ("`code`", "code", False),
+    ("line\n#hashtag", "line\nhashtag", False),
+    ("Migraine", "migraine", False),
+]
+
+def _llm_verdict(rec: dict):
+    from structured_output import parse_content
+    content = (rec.get("answer") or {}).get("content")
+    if content is None or (rec.get("answer") or {}).get("source") == "fast_judge":
+        return None
+    verdict = parse_content(content)
+    return verdict if isinstance(verdict, dict) else None
+
+def bench_judge(args):
+    from generate import build_verification_prompt
+    from fast_judge import judge, split_verification_prompt, agreement, canonical_pair_key
+    from prompt_blocks import iter_blocks, SEP_EQ, SEP_DASH
+
+    wrong = 0
+    for gt, output, expected in JUDGE_CORPUS:
+        v = judge(*split_verification_prompt(build_verification_prompt("dxbench_1", gt, output)))
+        got = None if v is None else f"{v['TOP1']}/{v['TOP3']}/{v['TOP5']}"
+        if got != expected:
+            wrong += 1
+            print(f"✗ GT={gt!r} output={output[:80]!r}\n    expected {expected}, got {got}")
+    print(f"judge: {len(JUDGE_CORPUS)} rule cases, {wrong} wrong")
+
+    collided = 0
+    for out_a, out_b, same in DEDUP_CORPUS:
+        key_a = canonical_pair_key(build_verification_prompt("dxbench_1", "Migraine", out_a))
+        key_b = canonical_pair_key(build_verification_prompt("dxbench_2", "Migraine", out_b))
+        if (key_a == key_b) != same:
+            collided += 1
+            print(f"✗ dedup {out_a!r} vs {out_b!r}: expected {'same' if same else 'different'} keys")
+    print(f"dedup: {len(DEDUP_CORPUS)} key cases, {collided} wrong")
+    if wrong or collided:
+        sys.exit(1)
+
+    texts = [build_verification_prompt(f"dxbench_{i}", gt, out)
+             for i, (gt, out, _) in enumerate(JUDGE_CORPUS * (args.cases // len(JUDGE_CORPUS) + 1))][:args.cases]
+    t = timeit(lambda: [judge(*split_verification_prompt(x)) for x in texts], args.repeat)
+    print(f"  judge      {t * 1e6 / len(texts):.1f} µs/prompt  ({len(texts) / t:,.0f}/s)")
+
+    if args.verify and args.results:
+        llm = {}
+        with open(args.results, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                verdict = _llm_verdict(rec)
+                if verdict is not None:
+                    llm[rec.get("idx")] = verdict
+        # same block numbering as test-api-final.py (idx = block index)
+        blocks = iter_blocks(Path(args.verify), separators=(SEP_EQ, SEP_DASH))
+        agg = agreement((block, llm[idx]) for idx, block in enumerate(blocks) if idx in llm)
+        n, d = agg["total"], agg["decided"]
+        print(f"\nagreement on {n} LLM-judged prompts: fast judge decided {d} ({100.0 * d / n if n else 0:.1f}%)")
+        for field in ("TOP1", "TOP3", "TOP5"):
+            same, tot = agg[field]
+            print(f"  {field}: {same}/{tot} agree ({100.0 * same / tot if tot else 0:.1f}%)")
+        for field, gt, best, fast, other in agg["disagreements"]:
+            print(f"  ≠ {field}: GT={gt!r} BEST={best!r} fast={fast} llm={other}")
+
+
+# =============================================================================
+#            extract: structured_output vs fences + greedy {.*} regex
+# =============================================================================
+
+REF_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+REF_BRACE = re.compile(r"\{.*\}", re.DOTALL)
+
+def reference_parse_content(raw):
+    """judgments.parse_content before structured_output.py (reference)."""
+    if raw is None:
+        return None
+    s = REF_FENCE.sub("", str(raw).strip()).strip()
+    if not (s.startswith("{") and s.endswith("}")):
+        m = REF_BRACE.search(s)
+        if m:
+            s = m.group(0)
+    try:
+        return json.loads(s)
+    except Exception:
+        return None
+
+_VERDICT = '{"TOP1":"YES","TOP3":"YES","TOP5":"YES","BEST":"Migraine"}'
+
+# (content, expected parse) — every shape seen in judge answers and generation outputs
+EXTRACT_CORPUS = [
+    (_VERDICT, json.loads(_VERDICT)),
+    ("```json\n" + _VERDICT + "\n```", json.loads(_VERDICT)),
+    ("Verdict: " + _VERDICT + " (strict)", json.loads(_VERDICT)),
+    ('{"BEST":"a}b","RANKED":[["a}b",0.9]]}', {"BEST": "a}b", "RANKED": [["a}b", 0.9]]}),
+    ('He\'s 5" tall. ' + _VERDICT, json.loads(_VERDICT)),
+    ("Step 1 {draft} ... final: " + _VERDICT, json.loads(_VERDICT)),            # greedy regex: None
+    ('{"TOP1":"NO"} then revised {"TOP1":"YES"}', {"TOP1": "YES"}),           # greedy regex: None
+    (_VERDICT + "}", json.loads(_VERDICT)),                                   # stray brace
+    ('{"x": "unterminated', None),
+    ("no json at all", None),
+    ("", None),
+    ('{"a": {"b": [1, 2, {"c": "\\"}"}]}}', {"a": {"b": [1, 2, {"c": '"}'}]}}),
+]
+
+def synthetic_output(rng: random.Random, i: int) -> str:
+    """Long chain-of-thought text with a final JSON answer, sometimes fenced or with stray braces."""
+    steps = "".join(f"Step {k}: consider finding {rng.randint(1, 99)} (score {{{k}}}) and weigh it.\n"
+                    for k in range(rng.randint(20, 200)))
+    answer = json.dumps({"BEST": f"Dx {i}", "RANKED": [[f"Dx {i + k}", round(0.5 / (k + 1), 3)] for k in range(5)]})
+    return rng.choice([steps + answer, steps + "```json\n" + answer + "\n```", answer, "```json\n" + answer + "\n```"])
+
+def bench_extract(args):
+    from structured_output import parse_content, loads, JSON_BACKEND
+
+    wrong = 0
+    for content, expected in EXTRACT_CORPUS:
+        got = parse_content(content)
+        if got != expected:
+            wrong += 1
+            print(f"✗ {content[:80]!r}\n    expected {expected}, got {got}")
+    print(f"extract: {len(EXTRACT_CORPUS)} rule cases, {wrong} wrong")
+
+    rng = random.Random(0)
+    corpus = [synthetic_output(rng, i) for i in range(args.cases)]
+    lines = []
+    if args.input:
+        with open(args.input, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                lines.append(line)
+                content = (rec.get("answer") or {}).get("content") if isinstance(rec.get("answer"), dict) else rec.get("output")
+                if isinstance(content, str):
+                    corpus.append(content)
+
+    # identical wherever the reference parsed; the scanner may additionally recover answers
+    mismatches = recovered = 0
+    for text in corpus:
+        ref, new = reference_parse_content(text), parse_content(text)
+        if ref is not None and ref != new:
+            mismatches += 1
+            if mismatches <= 5:
+                print("✗ mismatch on:", repr(text[:200]), "\n    reference:", ref, "\n    new      :", new)
+        elif ref is None and new is not None:
+            recovered += 1
+    print(f"extract: {len(corpus)} outputs, {mismatches} mismatches, {recovered} recovered (reference gave None)")
+    if wrong or mismatches:
+        sys.exit(1)
+
+    # most of the gain is the fence strip (the reference's trailing \s*``` is retried at every offset)
+    t_ref = timeit(lambda: [reference_parse_content(x) for x in corpus], args.repeat)
+    t_new = timeit(lambda: [parse_content(x) for x in corpus], args.repeat)
+    report("extract", len(corpus), t_ref, t_new)
+
+    # linear time: a chain of unclosed '{"a": ' must cost ~8x more at 8x the size, not ~64x
+    small, large = ('note {"a": ' * n for n in (1_000, 8_000))
+    t_small = timeit(lambda: parse_content(small), args.repeat)
+    t_large = timeit(lambda: parse_content(large), args.repeat)
+    print(f"  unclosed   {len(small) >> 10} KB: {t_small * 1e3:.2f} ms, {len(large) >> 10} KB: "
+          f"{t_large * 1e3:.2f} ms  → x{t_large / t_small:.1f} for x8 the text")
+    if lines:
+        t_ref = timeit(lambda: [json.loads(x) for x in lines], args.repeat)
+        t_new = timeit(lambda: [loads(x) for x in lines], args.repeat)
+        report(f"jsonl/{JSON_BACKEND}", len(lines), t_ref, t_new)
+
+
+# =============================================================================
+#            engine: meerkat_engine.BatchEngine vs model.generate
+# =============================================================================
+
+def tiny_llama(vocab: int, hidden: int, layers: int, seed: int = 0):
+    """Randomly initialised Llama small enough for CPU (same architecture family as Meerkat)."""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    torch.manual_seed(seed)
+    cfg = LlamaConfig(vocab_size=vocab, hidden_size=hidden, intermediate_size=2 * hidden,
+                      num_hidden_layers=layers, num_attention_heads=4, num_key_value_heads=2,
+                      max_position_embeddings=4096, bos_token_id=1, eos_token_id=2, pad_token_id=0)
+    return LlamaForCausalLM(cfg).eval()
+
+def bench_engine(args):
+    import torch
+    from meerkat_engine import BatchEngine
+
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    model = tiny_llama(args.vocab, args.hidden, args.layers)
+    rng = random.Random(0)
+    # prompt lengths like the three templates (short / long), answer lengths long-tailed like the notebook outputs
+    prompts = [[1] + [rng.randrange(3, args.vocab) for _ in range(rng.randint(args.min_prompt, args.max_prompt))]
+               for _ in range(args.requests)]
+    limits = [min(args.max_new, max(8, int(rng.lognormvariate(0, 0.8) * args.max_new / 4))) for _ in prompts]
+    useful = sum(limits)
+
+    def sequential():
+        out = []
+        with torch.no_grad():
+            for p, n in zip(prompts, limits):
+                ids = torch.tensor([p])
+                gen = model.generate(ids, attention_mask=torch.ones_like(ids), max_new_tokens=n, min_new_tokens=n,
+                                     do_sample=False, eos_token_id=2, pad_token_id=0)
+                out.append(gen[0, len(p):].tolist())
+        return out
+
+    def static():
+        with torch.no_grad():
+            for k in range(0, len(prompts), args.batch):
+                group, width = prompts[k:k + args.batch], max(len(p) for p in prompts[k:k + args.batch])
+                ids = torch.tensor([[0] * (width - len(p)) + p for p in group])
+                mask = torch.tensor([[0] * (width - len(p)) + [1] * len(p) for p in group])
+                n = max(limits[k:k + args.batch])   # a static batch runs as long as its longest answer
+                model.generate(ids, attention_mask=mask, max_new_tokens=n, min_new_tokens=n,
+                               do_sample=False, eos_token_id=2, pad_token_id=0)
+
+    engine = BatchEngine(model, max_batch=args.batch, bucket_width=args.bucket, eos_token_id=[], pad_token_id=0)
+    t0 = time.perf_counter(); ref = sequential(); t_seq = time.perf_counter() - t0
+    t0 = time.perf_counter(); got = engine.generate_ids(prompts, limits); t_eng = time.perf_counter() - t0
+    t0 = time.perf_counter(); static(); t_static = time.perf_counter() - t0
+
+    same = sum(g.token_ids == r for g, r in zip(got, ref))
+    print(f"engine: {len(prompts)} requests, greedy tokens identical to model.generate for {same}/{len(prompts)}")
+    print(f"  {engine.stats.summary(args.batch)}")
+    for name, t in (("sequential", t_seq), (f"static x{args.batch}", t_static), (f"engine x{args.batch}", t_eng)):
+        print(f"  {name:<12} {t:8.2f} s  ({useful / t:8.1f} useful tok/s)  → x{t_seq / t:.2f}")
+    if same != len(prompts):
+        sys.exit(1)
+
+
+# =============================================================================
+#        stream: DiagnosisStreamParser vs the whole-text parse, TTFC
+# =============================================================================
+
+def step3_answer(rng: random.Random, i: int) -> str:
+    """An answer in the prompt's "Diagnosis Name:" format with 1-7 differentials."""
+    body = "".join(f"Diagnosis Name: Dx {i}.{k}\nJustification: fits finding {rng.randint(1, 99)}\n  and finding {k}.\n"
+                   f"Likelihood: {rng.choice(['High', 'Medium', 'Low', f'{rng.randint(1, 99)}%'])}\nConfidence: Low\n\n"
+                   for k in range(rng.randint(1, 7)))
+    return (f"Step 1 – Symptom Categorization:\n- cough: respiratory\nStep 2 – Broad List:\n- Dx {i}.0\n"
+            f"Step 3 – Differential Diagnoses:\n{body}Clarifying Questions to Ask:\n1. First?\n2. Second?\n")
+
+def bench_stream(args):
+    import asyncio
+    import httpx
+    from batch_scheduler import MicroBatchScheduler
+    from diagnosis_service import DiagnosisStreamParser, build_output, create_app, StubGenerator, STUB_ANSWER
+
+    rng = random.Random(0)
+    corpus = [STUB_ANSWER] + [step3_answer(rng, i) for i in range(args.cases)] + \
+             [runaway_output(rng, i) for i in range(args.cases)]
+    wrong, at = 0, []
+    for text in corpus:
+        parser, events, pos = DiagnosisStreamParser(), [], 0
+        while pos < len(text):   # token-sized pieces
+            step = rng.randint(1, 8)
+            for kind, data in parser.feed(text[pos:pos + step]):
+                events.append((kind, data, pos + step))
+            pos += step
+        events += [(kind, data, len(text)) for kind, data in parser.close()]
+        final = build_output(text)
+        conditions = [data for kind, data, _ in events if kind == "condition"]
+        questions = [data for kind, data, _ in events if kind == "question"]
+        if conditions != [c.model_dump() for c in final.conditions] or questions != final.clarifying_questions:
+            wrong += 1
+            if wrong <= 3:
+                print(f"✗ {text[:120]!r}\n    streamed {conditions} {questions}\n    final    {final}")
+        first = next((p for kind, _, p in events if kind == "condition"), None)
+        if first is not None:
+            at.append(first / len(text))
+    at.sort()
+    print(f"stream: {len(corpus)} answers, {wrong} differ from the whole-text parse | first condition at "
+          f"{100 * at[len(at) // 2]:.0f}% of the text (median), {100 * at[int(0.95 * len(at))]:.0f}% (p95)")
+
+    async def ttfc():
+        scheduler = MicroBatchScheduler(StubGenerator(token_s=args.token_s))
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(scheduler)),
+                                         base_url="http://dx") as client:
+                r = await client.post("/api/diagnosis/stream", json={"symptoms": ["fever", "cough"]})
+                done = json.loads(r.text.rsplit("event: done\ndata: ", 1)[1])
+                return done
+        finally:
+            await scheduler.stop()
+    done = asyncio.run(ttfc())
+    print(f"  stub ({1e3 * args.token_s:.0f} ms/token, {done['tokens']} tokens): first condition after "
+          f"{done['first_condition_s']:.2f} s, complete answer after {done['seconds']:.2f} s; "
+          f"result == /api/diagnosis: {done['result'] == build_output(STUB_ANSWER).model_dump()}")
+    if wrong:
+        sys.exit(1)
+
+
+# =============================================================================
+#               stop: stop_criteria on complete / runaway answers
+# =============================================================================
+
+_QUESTIONS = "Clarifying Questions to Ask:\n1. Any fever?\n2. How long has it lasted?\n"
+
+# (answer text, criterion expected to fire or None, text kept) — shapes of the three templates' outputs
+STOP_CORPUS = [
+    ("Step 1 – Symptoms:\n- cough\nStep 2 – Broad list:\n- asthma\nStep 3 – Differential:\n1. Asthma\n"
+     + _QUESTIONS + "\nStep 3 – Differential:\n1. Asthma\n",
+     "questions_end",
+     "Step 1 – Symptoms:\n- cough\nStep 2 – Broad list:\n- asthma\nStep 3 – Differential:\n1. Asthma\n" + _QUESTIONS + "\n"),
+    ("1. **Diagnosis Name:** Asthma\n" + _QUESTIONS + "These questions help narrow it down.\n",
+     "questions_end", "1. **Diagnosis Name:** Asthma\n" + _QUESTIONS),
+    ("Output Section I: Differential Diagnoses:\n1. Asthma\nOutput Section I: Differential Diagnoses:\n",
+     "repeated_section", "Output Section I: Differential Diagnoses:\n1. Asthma\n"),
+    ("Clarifying Questions:\n" + "".join(f"- Question {k}?\n" for k in range(1, 9)),
+     "questions_end", "Clarifying Questions:\n" + "".join(f"- Question {k}?\n" for k in range(1, 6))),
+    ('```json\n{"BEST": "Asthma", "RANKED": [["Asthma", 0.6]]}\n```\nSome trailing text',
+     "json_complete", '```json\n{"BEST": "Asthma", "RANKED": [["Asthma", 0.6]]}'),
+    ('{"BEST": "a}b", "note": "\\"}"} trailing', "json_complete", '{"BEST": "a}b", "note": "\\"}"}'),
+    ("Step 2 list of conditions follows.\nStep 2 list again.\n", None, None),             # not headers
+    ("Answer {draft} then {more}.\n", None, None),                                         # prose braces
+    (_QUESTIONS + "   continued detail of question 2\n", None, None),                       # still in the list
+]
+
+class PieceTokenizer:
+    """Whitespace-piece 'tokenizer' (decode = concatenation) for replaying texts without a model tokenizer."""
+
+    PIECE = re.compile(r"\s*\S+|\s+")
+
+    def __init__(self):
+        self.pieces: List[str] = []
+        self._ids = {}
+
+    def encode(self, text: str, add_special_tokens: bool = False) -> List[int]:
+        ids = []
+        for piece in self.PIECE.findall(text):
+            if piece not in self._ids:
+                self._ids[piece] = len(self.pieces)
+                self.pieces.append(piece)
+            ids.append(self._ids[piece])
+        return ids
+
+    def decode(self, ids, skip_special_tokens: bool = True) -> str:
+        return "".join(self.pieces[i] for i in ids)
+
+def runaway_output(rng: random.Random, i: int) -> str:
+    """A single_step_cot answer that is complete after the questions and then repeats Step 3 to the limit."""
+    dx = "".join(f"    {k}. **Diagnosis Name:** Dx {i + k}\n       **Justification:** fits finding {rng.randint(1, 99)}.\n"
+                 for k in range(1, 6))
+    answer = (f"Step 1 – Symptom Categorization:\n- cough: respiratory\nStep 2 – Broad List:\n- Dx {i}\n"
+              f"Step 3 – Differential Diagnoses:\n{dx}\nClarifying Questions to Ask:\n"
+              + "".join(f"{k}. Question {k} about finding {rng.randint(1, 99)}?\n" for k in range(1, rng.randint(3, 4)))
+              + "\n")
+    return answer + f"Step 3 – Differential Diagnoses:\n{dx}\n" * rng.randint(0, 12)
+
+def read_results_txt(path: str) -> List[str]:
+    """assistant_output blocks of a results_<technique>.txt (notebook / meerkat_eval format)."""
+    text = Path(path).read_text(encoding="utf-8")
+    return [block.split("assistant_output:\n", 1)[1].rstrip("\n") + "\n"
+            for block in text.split("=" * 22 + "\n") if "assistant_output:\n" in block]
+
+def bench_stop(args):
+    from stop_criteria import StopChecker, default_criteria
+
+    tokenizer = PieceTokenizer()
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+
+    def replay(text: str):
+        """Feed text token by token until a criterion fires → (checker, tokens of the full text)."""
+        ids = tokenizer.encode(text, add_special_tokens=False)
+        checker = StopChecker(tokenizer, default_criteria())
+        for tok in ids:
+            if checker.feed(tok):
+                break
+        return checker, len(ids)
+
+    wrong = 0
+    for text, reason, kept in STOP_CORPUS:
+        checker, _ = replay(text)
+        got = (checker.hit.reason, checker.answer().lstrip(" ")) if checker.hit else (None, None)
+        if got != (reason, kept):   # lstrip: tokenizers that add a prefix space
+            wrong += 1
+            print(f"✗ {text[:80]!r}\n    expected {reason} {kept!r}\n    got      {got[0]} {got[1]!r}")
+    print(f"stop: {len(STOP_CORPUS)} rule cases, {wrong} wrong")
+
+    rng = random.Random(0)
+    corpus = [runaway_output(rng, i) for i in range(args.cases)]
+    for path in args.input or []:
+        corpus += read_results_txt(path)
+
+    reasons, kept_tok, full_tok, t_check = {}, 0, 0, 0.0
+    for text in corpus:
+        t0 = time.perf_counter()
+        checker, n_full = replay(text)
+        t_check += time.perf_counter() - t0
+        reason = checker.hit.reason if checker.hit else "none"
+        reasons[reason] = reasons.get(reason, 0) + 1
+        kept_tok += len(checker.decoder.tokens)
+        full_tok += n_full
+    print(f"stop: {len(corpus)} answers | " + ", ".join(f"{k} {v}" for k, v in sorted(reasons.items())))
+    print(f"  tokens decoded {kept_tok} of {full_tok} → {100 * (1 - kept_tok / max(1, full_tok)):.1f}% saved "
+          f"({(full_tok - kept_tok) / max(1, len(corpus)):.0f} per answer)")
+    print(f"  checking cost {1e6 * t_check / max(1, kept_tok):.1f} µs/token")
+    if wrong:
+        sys.exit(1)
+
+
+# =============================================================================
+#          service: /api/diagnosis load test (stub model, in-process)
+# =============================================================================
+
+SYMPTOM_SETS = [["fever", "cough"], ["headache", "nausea", "photophobia"], ["chest pain", "shortness of breath"],
+                ["itchy rash"], ["sore throat", "fever", "swollen glands"], ["joint pain", "morning stiffness"],
+                ["abdominal pain", "diarrhea"], ["fatigue", "weight loss", "night sweats"]]
+
+def symptom_variant(rng: random.Random, symptoms: List[str]) -> List[str]:
+    """The same set as a frontend user might type it: other order, case, spacing, duplicates."""
+    out = [rng.choice([s, s.upper(), s.title(), f"  {s} ", s.replace(" ", "  ")]) for s in symptoms]
+    rng.shuffle(out)
+    return out + ([rng.choice(out)] if rng.random() < 0.2 else [])
+
+async def _load(app, n: int, concurrency: int, distinct: int = 0):
+    """n POSTs with `concurrency` in flight → (latencies of 200s, status counts, wall seconds).
+    distinct > 0: requests draw (Zipf-like) from that many symptom sets, in typed variants."""
+    import asyncio
+    import httpx
+
+    sem = asyncio.Semaphore(concurrency)
+    latencies, status = [], {}
+    rng = random.Random(0)
+    if distinct:
+        sets = [SYMPTOM_SETS[k % len(SYMPTOM_SETS)] + [f"symptom {k}"] * (k >= len(SYMPTOM_SETS)) for k in range(distinct)]
+        weights = [1 / (k + 1) for k in range(distinct)]
+        requests = [symptom_variant(rng, rng.choices(sets, weights)[0]) for _ in range(n)]
+    else:
+        requests = [SYMPTOM_SETS[i % len(SYMPTOM_SETS)] for i in range(n)]
+
+    async def one(client, i):
+        async with sem:
+            t0 = time.perf_counter()
+            r = await client.post("/api/diagnosis", json={"symptoms": requests[i]})
+            status[r.status_code] = status.get(r.status_code, 0) + 1
+            if r.status_code == 200:
+                latencies.append(time.perf_counter() - t0)
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://dx") as client:
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(n)))
+        return latencies, status, time.perf_counter() - t0
+
+def bench_service(args):
+    import asyncio
+    from batch_scheduler import MicroBatchScheduler
+    from diagnosis_cache import DiagnosisCache
+    from diagnosis_service import create_app, StubGenerator, build_output, STUB_ANSWER
+
+    expected = build_output(STUB_ANSWER)
+    runs = [("unbatched", 1, args.requests, 0), (f"batch x{args.batch}", args.batch, args.requests, 0),
+            (f"queue {args.queue}", args.batch, args.queue, 0),
+            ("+ cache", args.batch, args.requests, args.distinct)]
+    print(f"service: {args.requests} requests, {args.concurrency} in flight, stub generate "
+          f"{1e3 * args.batch_s:.0f} ms + {1e3 * args.row_s:.0f} ms/prompt")
+    base = None
+    for name, batch, queue, distinct in runs:
+        scheduler = MicroBatchScheduler(StubGenerator(args.batch_s, args.row_s), max_batch=batch,
+                                        max_wait_ms=args.wait_ms, max_queue=queue)
+        cache = DiagnosisCache() if distinct else None
+
+        async def run():
+            try:
+                return await _load(create_app(scheduler, cache, "stub"), args.requests, args.concurrency, distinct)
+            finally:
+                await scheduler.stop()
+
+        latencies, status, wall = asyncio.run(run())
+        ok = status.get(200, 0)
+        base = base or wall / max(1, ok)
+        latencies.sort()
+        p = lambda q: 1e3 * latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+        print(f"  {name:<12} {ok / wall:7.1f} req/s  p50 {p(0.5):7.0f} ms  p95 {p(0.95):7.0f} ms  "
+              f"503s {status.get(503, 0):4d}  mean batch {scheduler.stats.as_dict()['mean_batch']}  "
+              f"→ x{base / (wall / max(1, ok)):.2f}")
+        if cache is not None:
+            print(f"  {'':<12} {args.distinct} distinct sets in typed variants → {cache.summary()}, "
+                  f"{scheduler.stats.completed} generations")
+        if set(status) - {200, 503}:
+            print(f"✗ unexpected statuses {status}")
+            sys.exit(1)
+
+    # the answer a caller gets back is the one the handler builds for its own text
+    async def check():
+        scheduler = MicroBatchScheduler(StubGenerator(0.0, 0.0), max_batch=4)
+        import httpx
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(scheduler)),
+                                         base_url="http://dx") as client:
+                r = await client.post("/api/diagnosis", json={"symptoms": ["fever"]})
+                empty = await client.post("/api/diagnosis", json={"symptoms": []})
+                return r.json(), empty.status_code
+        finally:
+            await scheduler.stop()
+    body, empty = asyncio.run(check())
+    if body != expected.model_dump() or empty != 400:
+        print("✗ response differs from build_output / empty symptoms not rejected")
+        sys.exit(1)
+
+
+# =============================================================================
+#                                   Main
+# =============================================================================
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("header", help="parse_case vs extract_id/extract_gt/redact_id_and_gt_for_api")
+    p.add_argument("--input", help="Optional real prompts file to add to the corpus")
+    p.add_argument("--cases", type=int, default=100_000, help="Synthetic cases to generate")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_header)
+
+    p = sub.add_parser("judge", help="fast_judge rule corpus, speed, agreement with LLM verdicts")
+    p.add_argument("--verify", help="Verification prompts file (as given to test-api-final.py)")
+    p.add_argument("--results", help="test-api-final.py results JSONL for the same file (LLM verdicts)")
+    p.add_argument("--cases", type=int, default=100_000, help="Prompts to time")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_judge)
+
+    p = sub.add_parser("extract", help="structured_output.parse_content vs the old fence + greedy-regex parse")
+    p.add_argument("--input", help="Optional results JSONL (judge answers or generate outputs) to add to the corpus")
+    p.add_argument("--cases", type=int, default=5_000, help="Synthetic chain-of-thought outputs")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_extract)
+
+    p = sub.add_parser("engine", help="meerkat_engine.BatchEngine vs sequential / static-batch model.generate")
+    p.add_argument("--requests", type=int, default=48)
+    p.add_argument("--batch", type=int, default=8)
+    p.add_argument("--bucket", type=int, default=64)
+    p.add_argument("--min-prompt", type=int, default=64)
+    p.add_argument("--max-prompt", type=int, default=256)
+    p.add_argument("--max-new", type=int, default=128, help="Longest answer (tokens)")
+    p.add_argument("--vocab", type=int, default=1024)
+    p.add_argument("--hidden", type=int, default=128)
+    p.add_argument("--layers", type=int, default=4)
+    p.add_argument("--threads", type=int, default=0, help="torch CPU threads (0 = default)")
+    p.set_defaults(func=bench_engine)
+
+    p = sub.add_parser("service", help="/api/diagnosis load test with a stub model: unbatched vs micro-batched")
+    p.add_argument("--requests", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=32, help="Requests in flight")
+    p.add_argument("--batch", type=int, default=8)
+    p.add_argument("--wait-ms", type=float, default=10)
+    p.add_argument("--queue", type=int, default=16, help="Queue limit of the overload run")
+    p.add_argument("--batch-s", type=float, default=0.05, help="Stub seconds per generate call")
+    p.add_argument("--row-s", type=float, default=0.005, help="Stub seconds per prompt in a call")
+    p.add_argument("--distinct", type=int, default=20, help="Symptom sets behind the cached run's requests")
+    p.set_defaults(func=bench_service)
+
+    p = sub.add_parser("stream", help="DiagnosisStreamParser vs the whole-text parse + time to first condition")
+    p.add_argument("--cases", type=int, default=500, help="Synthetic answers of each kind")
+    p.add_argument("--token-s", type=float, default=0.03, help="Stub seconds per streamed token")
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("stop", help="stop_criteria rule corpus + tokens saved on runaway answers")
+    p.add_argument("--input", nargs="+", help="results_<technique>.txt files to replay (assistant_output blocks)")
+    p.add_argument("--tokenizer", help="Hugging Face tokenizer to replay with (default: whitespace pieces)")
+    p.add_argument("--cases", type=int, default=2_000, help="Synthetic runaway answers")
+    p.set_defaults(func=bench_stop)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
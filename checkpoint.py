@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+Resume checkpoint for the results JSONL files of generate.py / test-api-final.py.
+
+Instead of json.loads-ing every line of a growing <method>.jsonl on start-up, each
+results file gets an append-only sidecar <method>.jsonl.ckpt with one short line
+per finished case:
+
+    <key>\t<byte offset of the results file after this record>\n
+
+— Crash safety —
+* A record is written to the results file first, then its checkpoint line.
+* On load, a checkpoint line without its trailing '\n' (torn write) is cut off.
+* The last offset in the checkpoint says how much of the results file is already
+  indexed; only the bytes after it are parsed (normally zero or one line), so a
+  crash between the two writes is repaired without a full scan.
+* No sidecar yet (old runs) or a results file shorter than the recorded offset
+  (file replaced/truncated) → one full scan, and the sidecar is rebuilt.
+* A torn last results line is terminated with '\n' so the next record does not
+  get glued onto it.
+
+Usage:
+    ckpt = Checkpoint(out_dir / "single_step_cot.jsonl", key_field="idx")
+    done = ckpt.load()                 # set of str keys
+    ckpt.append_result({"idx": 7, ...})
+    ckpt.close()
+"""
+
+import os
+import json
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+
+class Checkpoint:
+    """Append-only key log next to a results JSONL (thread-safe writes)."""
+
+    def __init__(self, results_path: Path, key_field: str = "id", fsync: bool = False):
+        self.results_path = Path(results_path)
+        self.path = self.results_path.with_name(self.results_path.name + ".ckpt")
+        self.key_field = key_field
+        self.fsync = fsync
+        self.done: Set[str] = set()
+        self._lock = threading.Lock()
+        self._results_f = None
+        self._ckpt_f = None
+
+    # ---- loading -------------------------------------------------------------
+
+    def _key_of(self, obj: Dict[str, Any]) -> Optional[str]:
+        v = obj.get(self.key_field)
+        return None if v is None else str(v)
+
+    def _scan_results(self, start: int) -> Tuple[Iterable[Tuple[str, int]], int]:
+        """Parse results from byte `start`; returns ([(key, offset_after)], end_offset)."""
+        found = []
+        with self.results_path.open("rb") as f:
+            f.seek(start)
+            pos = start
+            for raw in f:
+                pos += len(raw)
+                if not raw.endswith(b"\n"):
+                    break  # torn last line: never indexed
+                try:
+                    key = self._key_of(json.loads(raw))
+                except (ValueError, AttributeError):
+                    continue
+                if key is not None:
+                    found.append((key, pos))
+        return found, pos
+
+    def load(self) -> Set[str]:
+        self.done = set()
+        if not self.results_path.exists():
+            if self.path.exists():
+                self.path.unlink()   # results gone → stale checkpoint
+            return self.done
+
+        size = self.results_path.stat().st_size
+        indexed = -1
+        if self.path.exists():
+            self._truncate_torn(self.path)
+            with self.path.open("rb") as f:
+                for raw in f:
+                    key, _, off = raw[:-1].decode("utf-8").rpartition("\t")
+                    if key:
+                        self.done.add(key)
+                        indexed = int(off)
+
+        if indexed > size or not self.path.exists():
+            # results replaced/truncated, or an old run without a sidecar → rebuild once
+            self.done = set()
+            found, _ = self._scan_results(0)
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            with tmp.open("wb") as f:
+                for key, off in found:
+                    f.write(f"{key}\t{off}\n".encode("utf-8"))
+                    self.done.add(key)
+            os.replace(tmp, self.path)
+        elif size > max(indexed, 0):
+            # crash between the result write and its checkpoint line → index the tail
+            found, _ = self._scan_results(max(indexed, 0))
+            self._append_marks(found)
+
+        self._repair_torn_tail()
+        return self.done
+
+    @staticmethod
+    def _truncate_torn(path: Path):
+        """Drop a checkpoint line that lost its '\n' in a crash."""
+        with path.open("rb+") as f:
+            data_end = f.seek(0, os.SEEK_END)
+            if data_end == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) == b"\n":
+                return
+            # walk back to the previous newline (checkpoint lines are short)
+            pos = data_end
+            while pos > 0:
+                step = min(4096, pos)
+                f.seek(pos - step)
+                chunk = f.read(step)
+                nl = chunk.rfind(b"\n")
+                if nl >= 0:
+                    f.truncate(pos - step + nl + 1)
+                    return
+                pos -= step
+            f.truncate(0)
+
+    def _repair_torn_tail(self):
+        if not self.results_path.exists() or self.results_path.stat().st_size == 0:
+            return
+        with self.results_path.open("rb+") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    # ---- writing -------------------------------------------------------------
+
+    def _open(self):
+        if self._results_f is None:
+            self._results_f = self.results_path.open("ab")
+            self._ckpt_f = self.path.open("ab")
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _append_marks(self, marks: Iterable[Tuple[str, int]]):
+        marks = list(marks)
+        if not marks:
+            return
+        with self.path.open("ab") as f:
+            for key, off in marks:
+                f.write(f"{key}\t{off}\n".encode("utf-8"))
+                self.done.add(key)
+
+    def append_result(self, obj: Dict[str, Any]):
+        """Append one record to the results JSONL, then mark its key as done."""
+        self.append_results([obj])
+
+    def append_results(self, objs: Iterable[Dict[str, Any]]):
+        """Group commit: all records, one sync, then all their checkpoint lines, one sync."""
+        with self._lock:
+            self._open()
+            marks = []
+            for obj in objs:
+                self._results_f.write((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+                key = self._key_of(obj)
+                if key is not None:
+                    marks.append(f"{key}\t{self._results_f.tell()}\n")
+                    self.done.add(key)
+            self._sync(self._results_f)
+            if marks:
+                self._ckpt_f.write("".join(marks).encode("utf-8"))
+                self._sync(self._ckpt_f)
+
+    def close(self):
+        with self._lock:
+            for f in (self._results_f, self._ckpt_f):
+                if f is not None:
+                    f.close()
+            self._results_f = self._ckpt_f = None
@@ -1,273 +1,207 @@
 # analyze.py  —  fixed + department breakdown
-import json, re, csv
-from collections import Counter, defaultdict
+#   python dep-analyze.py                                   # DATA_PATH
+#   python dep-analyze.py "runs/*/results/*.jsonl" --jobs 8 # همهٔ مدل×روش‌ها در یک فرمان
+#   python dep-analyze.py results/*.jsonl --watch           # در حین اجرای test-api-final.py، CSVها هر WATCH_EVERY ثانیه
+#   python dep-analyze.py --store results/results.sqlite    # از result store (همهٔ مدل×روش‌ها، بدون پارس JSON)
+#   python dep-analyze.py runs/*/results/*.jsonl --bootstrap 20000   # CI و مقایسهٔ جفتی روش‌ها (0 → خاموش)
+import glob
+import time
+import argparse
 from pathlib import Path
+# پارس answer.content، جدول دپارتمان‌ها، شمارش و نوشتن CSV بین این اسکریپت و pipeline.py مشترک است
+from result_store import ResultStore
+from judgments import (RunningTally, JsonlTail, tally_file, tally_files, run_label, summary_line,
+                       write_count_csvs, write_run_csvs)
+# جدول‌ها با group-by ستونی NumPy (judgment_columns) و CI/آزمون جفتی (judgment_stats)؛
+# بدون numpy همان شمارش dict و بدون CI
+try:
+    import judgment_columns
+    import judgment_stats
+except ImportError:
+    judgment_columns = judgment_stats = None
 
 # =====================[ CONFIG ]=====================
 # مسیر فایل نتایج و فولدر خروجی را اینجا تنظیم کن
 DATA_PATH  = Path("F:\\A-project\\Final\\run\\meerkat - full dataset\\results\\single_step_cot.jsonl")  # اگر لازم بود مطلق کن
 OUTPUT_DIR = Path("F:\\A-project\\Final\\run\\meerkat - full dataset\\results")               # پوشه‌ی خروجی
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+WATCH_EVERY = 30   # ثانیه بین بازنویسی CSVها در --watch
+BOOTSTRAP   = 10000   # تعداد نمونه‌گیری bootstrap برای بازه‌های اطمینان 95٪ (0 → خاموش)
 # ====================================================
 
-# همان منطق پاک‌سازی و پارس JSON در answer.content
-FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)   # حذف ```/```json
-BRACE_BLOCK = re.compile(r"\{.*\}", re.DOTALL)                   # اولین {...}
-
-def parse_content(raw: str):
-    """raw = answer.content (ممکن است بلاک مارک‌داون داشته باشد). خروجی: dict JSON داخلی یا None."""
-    if raw is None:
-        return None
-    s = str(raw).strip()
-    s = FENCE.sub("", s).strip()
-    if not (s.startswith("{") and s.endswith("}")):
-        m = BRACE_BLOCK.search(s)
-        if m:
-            s = m.group(0)
-    try:
-        return json.loads(s)
-    except Exception:
-        return None
-
-def iter_jsonl(path: Path):
-    with path.open("r", encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                yield json.loads(line)
-            except Exception:
-                # خط خراب را رد کن
-                continue
-
-# ---------- تحلیل کلی (مثل نسخه‌ی قبلی شما) ----------
+# ---------- تحلیل (یک گذر: هر رکورد یک بار پارس می‌شود) ----------
 def analyze_overall(path: Path):
-    c_top1 = Counter()     # YES/NO/UNSCORABLE
-    c_top3 = Counter()     # YES/NO
-    c_top5 = Counter()     # YES/NO
-    total = 0
-    invalid_top1 = 0
-    invalid_top3 = 0
-    invalid_top5 = 0
-
-    for rec in iter_jsonl(path):
-        total += 1
-        content = (rec.get("answer") or {}).get("content")
-        inner = parse_content(content)
-        if not isinstance(inner, dict):
-            invalid_top1 += 1
-            invalid_top3 += 1
-            invalid_top5 += 1
-            continue
+    return tally_file(path).overall_row()
 
-        top1 = (inner.get("TOP1") or "").strip().upper()
-        top3 = (inner.get("TOP3") or "").strip().upper()
-        top5 = (inner.get("TOP5") or "").strip().upper()
-
-        if top1 in ("YES","NO","UNSCORABLE"):
-            c_top1[top1] += 1
-        else:
-            invalid_top1 += 1
-
-        if top3 in ("YES","NO"):
-            c_top3[top3] += 1
-        else:
-            invalid_top3 += 1
-
-        if top5 in ("YES","NO"):
-            c_top5[top5] += 1
+def analyze_by_department(path: Path):
+    return tally_file(path).department_rows()
+
+def expand_inputs(specs):
+    """مسیرها یا الگوهای glob (مثل 'runs/*/results/*.jsonl') → فهرست فایل‌ها بدون تکرار."""
+    paths = []
+    for spec in specs:
+        if any(ch in spec for ch in "*?["):
+            # از glob فقط فایل‌های نتیجه (نه failures / metrics)
+            matches = [Path(m) for m in sorted(glob.glob(spec, recursive=True))
+                       if m.endswith(".jsonl") and not m.endswith((".failures.jsonl", "calls.metrics.jsonl"))]
         else:
-            invalid_top5 += 1
-
-    return {
-        "total_rows": total,
-        "TOP1_YES": c_top1.get("YES", 0),
-        "TOP1_NO": c_top1.get("NO", 0),
-        "TOP1_UNSCORABLE": c_top1.get("UNSCORABLE", 0),
-        "TOP3_YES": c_top3.get("YES", 0),
-        "TOP3_NO": c_top3.get("NO", 0),
-        "TOP5_YES": c_top5.get("YES", 0),
-        "TOP5_NO": c_top5.get("NO", 0),
-        "invalid_TOP1": invalid_top1,
-        "invalid_TOP3": invalid_top3,
-        "invalid_TOP5": invalid_top5,
-    }
-
-# ---------- نگاشت دپارتمان‌ها بر اساس جدول شما ----------
-DEPARTMENTS = [
-    ("Surgery", 1, 93),
-    ("Obstetrics and Gynecology", 94, 189),
-    ("Internal Medicine", 190, 288),
-    ("Dentistry", 289, 360),
-    ("Neurology", 361, 436),
-    ("Oncology", 437, 492),
-    ("Orthopedics", 493, 581),
-    ("Pediatrics", 582, 640),
-    ("Otorhinolaryngology", 641, 724),
-    ("Reproductive and Men's Health", 725, 797),
-    ("Dermatovenereology", 798, 918),
-    ("Other", 919, 989),
-    ("Psychology", 990, 1073),
-    ("Hematology", 1074, 1121),
-    ("Infectious Diseases and Immunology", 1122, 1148),
-]
+            matches = [Path(spec)]
+        for m in matches:
+            if m not in paths:
+                paths.append(m)
+    return paths
 
-def dept_for_number(n: int):
-    for dept, start, end in DEPARTMENTS:
-        if start <= n <= end:
-            return dept
-    return None
-
-def extract_dataset_number(rec: dict):
+def analyze_files(paths, jobs: int = 0):
     """
-    فایل فعلی شما فیلد 'dataset_id' دارد مثل 'dxbench_241'.
-    این تابع عدد انتهایی را برمی‌گرداند (241).
+    (overall, by_dept, runs, cols, labels) برای فایل‌های نتایج؛ runs (یک سطر برای هر فایل) فقط با
+    بیش از یک فایل، cols (ستون‌های NumPy برای CI) بدون numpy None است.
     """
-    # ترتیب جست‌وجو شامل dataset_id هم باشد
-    for key in ("dataset_id","id","sample_id","case_id","qid","question_id","dx_id"):
-        if key in rec and rec[key] is not None:
-            s = str(rec[key])
-            m = re.findall(r"(\d+)", s)
-            if m:
-                return int(m[-1])
-    meta = rec.get("meta") or rec.get("metadata") or {}
-    for key in ("dataset_id","id","sample_id","case_id","qid","question_id","dx_id"):
-        if key in meta and meta[key] is not None:
-            s = str(meta[key])
-            m = re.findall(r"(\d+)", s)
-            if m:
-                return int(m[-1])
-    return None
-
-# ---------- تحلیل به تفکیک دپارتمان ----------
-def analyze_by_department(path: Path):
-    # دیکشنری اولیه با همه دپارتمان‌ها
-    results = {
-        dept: {
-            "department": dept,
-            "total_rows": 0,
-            "TOP1_YES": 0, "TOP1_NO": 0, "TOP1_UNSCORABLE": 0, "invalid_TOP1": 0,
-            "TOP3_YES": 0, "TOP3_NO": 0, "invalid_TOP3": 0,
-            "TOP5_YES": 0, "TOP5_NO": 0, "invalid_TOP5": 0,
-        }
-        for dept,_,_ in DEPARTMENTS
-    }
-    # برای شفافیت: رکوردهایی که نگاشت‌پذیر نیستند
-    results["_UNMATCHED"] = {
-        "department": "_UNMATCHED",
-        "total_rows": 0,
-        "TOP1_YES": 0, "TOP1_NO": 0, "TOP1_UNSCORABLE": 0, "invalid_TOP1": 0,
-        "TOP3_YES": 0, "TOP3_NO": 0, "invalid_TOP3": 0,
-        "TOP5_YES": 0, "TOP5_NO": 0, "invalid_TOP5": 0,
-    }
-
-    for rec in iter_jsonl(path):
-        num = extract_dataset_number(rec)
-        dept = dept_for_number(num) if num is not None else None
-        bucket = results[dept] if dept in results else results["_UNMATCHED"]
-        bucket["total_rows"] += 1
-
-        content = (rec.get("answer") or {}).get("content")
-        inner = parse_content(content)
-        if not isinstance(inner, dict):
-            bucket["invalid_TOP1"] += 1
-            bucket["invalid_TOP3"] += 1
-            bucket["invalid_TOP5"] += 1
-            continue
-
-        t1 = (inner.get("TOP1") or "").strip().upper()
-        t3 = (inner.get("TOP3") or "").strip().upper()
-        t5 = (inner.get("TOP5") or "").strip().upper()
-
-        if t1 in ("YES","NO","UNSCORABLE"):
-            bucket["TOP1_" + t1] += 1
-        else:
-            bucket["invalid_TOP1"] += 1
-
-        if t3 in ("YES","NO"):
-            bucket["TOP3_" + t3] += 1
-        else:
-            bucket["invalid_TOP3"] += 1
-
-        if t5 in ("YES","NO"):
-            bucket["TOP5_" + t5] += 1
-        else:
-            bucket["invalid_TOP5"] += 1
-
-    # ترتیب خروجی مطابق سورت جدول شما
-    ordered = [results[dept] for dept,_,_ in DEPARTMENTS]
-    if results["_UNMATCHED"]["total_rows"] > 0:
-        ordered.append(results["_UNMATCHED"])
-    return ordered
+    labels = [run_label(p) for p in paths]
+    cols = None
+    if judgment_columns is not None:
+        # یک گذر پارس برای هر فایل (موازی) → آرایه‌های ستونی؛ همهٔ جدول‌ها با bincount
+        cols = judgment_columns.load_many(paths, jobs=jobs)
+        overall = judgment_columns.overall_row(cols)
+        by_dept = judgment_columns.department_rows(cols)
+        runs = judgment_columns.run_rows(cols, labels) if len(paths) > 1 else []
+    else:
+        # یک گذر برای هر فایل (کلی + دپارتمانی با هم)، فایل‌ها به‌صورت موازی
+        tallies = tally_files(paths, jobs=jobs)
+        total = RunningTally()
+        for t in tallies:
+            total.merge(t)
+        overall = total.overall_row()
+        by_dept = total.department_rows()
+        runs = [(label, t.overall_row(), t.department_rows()) for label, t in zip(labels, tallies)]
+    return overall, by_dept, (runs if len(paths) > 1 else []), cols, labels
+
+def report_stats(cols, labels, n_boot: int, seed: int, out_dir: Path):
+    """بازهٔ اطمینان bootstrap برای هر اجرا × دپارتمان و مقایسهٔ جفتی همهٔ اجراها روی کیس‌های مشترک."""
+    t0 = time.perf_counter()
+    ci_rows = judgment_stats.bootstrap_rows(cols, labels, n_boot, seed=seed)
+    paired = judgment_stats.paired_rows(cols, labels, n_boot, seed=seed) if len(labels) > 1 else []
+    print(f"\n=== BOOTSTRAP {judgment_stats.CI_LEVEL:.0%} CI (B={n_boot}, {time.perf_counter() - t0:.1f}s) ===")
+    for label in labels:
+        cells = [f"{r['metric']} {r['rate_%']}% [{r['ci_low_%']}, {r['ci_high_%']}]"
+                 for r in ci_rows if r["run"] == label and r["department"] == judgment_stats.ALL]
+        print(f"  {label:<45} {'  '.join(cells)}")
+    if paired:
+        print("\n=== PAIRED (A − B on shared cases, McNemar p) ===")
+        for r in paired:
+            if r["department"] == judgment_stats.ALL:
+                diff = f"{r['diff_pp']:+}pp" if r["diff_pp"] != "" else "n/a"
+                print(f"  {r['run_a']} vs {r['run_b']} {r['metric']}: {diff} "
+                      f"[{r['ci_low_pp']}, {r['ci_high_pp']}] p={r['p_mcnemar']} (n={r['n_paired']})")
+    judgment_stats.write_stats_csvs(ci_rows, paired, out_dir)
+
+# ---------- watch: فقط خطوط تازه‌ی فایل‌ها، شمارش افزایشی ----------
+def _write_watch_csvs(paths, tallies, out_dir: Path):
+    total = RunningTally()
+    for p in paths:
+        total.merge(tallies[p])
+    overall = total.overall_row()
+    try:
+        write_count_csvs(overall, total.department_rows(), out_dir, verbose=False)
+        if len(paths) > 1:
+            write_run_csvs([(run_label(p), tallies[p].overall_row(), tallies[p].department_rows()) for p in paths],
+                           out_dir, verbose=False)
+    except OSError as e:
+        # مثلاً CSV در Excel باز است؛ دور بعد دوباره
+        print(f"⚠️ CSV write failed ({e}); retrying next round")
+    decided = overall["TOP1_YES"] + overall["TOP1_NO"]
+    acc = 100.0 * overall["TOP1_YES"] / decided if decided else 0.0
+    print(f"[{time.strftime('%H:%M:%S')}] {summary_line(overall)} | TOP1 acc {acc:.2f}%")
+
+def watch(specs, out_dir: Path, interval: float):
+    """
+    هر interval ثانیه: الگوها دوباره باز می‌شوند (فایل‌های تازه هم دنبال می‌شوند)، از هر فایل فقط
+    خطوط اضافه‌شده از آخرین آفست خوانده و به شمارش همان فایل اضافه می‌شود؛ اگر چیزی عوض شده
+    باشد CSVها بازنویسی می‌شوند. Ctrl+C → نوشتن نهایی و خروج.
+    """
+    tails, tallies = {}, {}
+    print(f"👀 watching {', '.join(specs) if specs else DATA_PATH} → {out_dir.resolve()} (every {interval:g}s, Ctrl+C to stop)")
+    try:
+        while True:
+            changed = False
+            for p in (expand_inputs(specs) if specs else [DATA_PATH]):
+                if p not in tails:
+                    tails[p], tallies[p] = JsonlTail(p), RunningTally()
+            for p, tail in tails.items():
+                recs, reset = tail.read_new()
+                if reset:
+                    tallies[p] = RunningTally()
+                for rec in recs:
+                    tallies[p].add(rec)
+                changed = changed or reset or bool(recs)
+            if changed:
+                _write_watch_csvs(list(tails), tallies, out_dir)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        if tails:
+            _write_watch_csvs(list(tails), tallies, out_dir)
+        print("⏹ watch stopped")
 
 # ---------- main ----------
 def main():
-    # 1) خلاصه‌ی کلی
-    overall = analyze_overall(DATA_PATH)
-
-    # 2) خلاصه‌ی دپارتمانی
-    by_dept = analyze_by_department(DATA_PATH)
+    parser = argparse.ArgumentParser(description="TOP1/TOP3/TOP5 counts (overall, by department, by run)")
+    parser.add_argument("inputs", nargs="*", help="Result JSONL files or globs (default: DATA_PATH)")
+    parser.add_argument("--out", default=str(OUTPUT_DIR), help="Output folder for the CSVs")
+    parser.add_argument("--jobs", type=int, default=0, help="Parallel processes (0 = one per core)")
+    parser.add_argument("--watch", action="store_true", help="Follow the files while they are written; rewrite the CSVs on an interval")
+    parser.add_argument("--interval", type=float, default=WATCH_EVERY, help="Seconds between CSV rewrites in --watch")
+    parser.add_argument("--store", help="Read the judgements from a result store (results.sqlite) instead of JSONL files")
+    parser.add_argument("--model", help="With --store: only this model")
+    parser.add_argument("--bootstrap", type=int, default=BOOTSTRAP, help="Bootstrap resamples for CIs / paired tests (0 = off)")
+    parser.add_argument("--seed", type=int, default=0, help="Bootstrap random seed")
+    args = parser.parse_args()
+
+    if args.watch:
+        out_dir = Path(args.out)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        watch(args.inputs, out_dir, args.interval)
+        return
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.store:
+        # یک کوئری ایندکس‌دار روی result store؛ TOP1/3/5 هنگام نوشتن پارس شده‌اند
+        if judgment_columns is None:
+            raise SystemExit("❌ --store needs numpy (judgment_columns.py).")
+        store = ResultStore(Path(args.store))
+        try:
+            cols, labels = judgment_columns.columns_from_verdicts(store.verdicts(args.model))
+        finally:
+            store.close()
+        if not labels:
+            raise SystemExit("❌ No judgements in the result store.")
+        overall = judgment_columns.overall_row(cols)
+        by_dept = judgment_columns.department_rows(cols)
+        runs = judgment_columns.run_rows(cols, labels) if len(labels) > 1 else []
+    else:
+        paths = expand_inputs(args.inputs) if args.inputs else [DATA_PATH]
+        if not paths:
+            raise SystemExit("❌ No result files matched.")
+        overall, by_dept, runs, cols, labels = analyze_files(paths, args.jobs)
 
     # چاپ خلاصه در ترمینال
+    if runs:
+        print("\n=== SUMMARY (BY RUN) ===")
+        for label, run_overall, _ in runs:
+            print(f"  {label:<45} {summary_line(run_overall)}")
     print("\n=== SUMMARY (OVERALL) ===")
     print(f"  total rows: {overall['total_rows']}")
     print(f"  TOP1 → YES: {overall['TOP1_YES']}  NO: {overall['TOP1_NO']}  UNSCORABLE: {overall['TOP1_UNSCORABLE']}  | invalid/missing: {overall['invalid_TOP1']}")
     print(f"  TOP3 → YES: {overall['TOP3_YES']}  NO: {overall['TOP3_NO']}  | invalid/missing: {overall['invalid_TOP3']}")
     print(f"  TOP5 → YES: {overall['TOP5_YES']}  NO: {overall['TOP5_NO']}  | invalid/missing: {overall['invalid_TOP5']}")
 
-    # ذخیره CSV کلی
-    out_csv_overall = OUTPUT_DIR / "judgment_counts_overall.csv"
-    with out_csv_overall.open("w", encoding="utf-8", newline="") as f:
-        w = csv.writer(f)
-        w.writerow([
-            "total_rows",
-            "TOP1_YES","TOP1_NO","TOP1_UNSCORABLE","invalid_TOP1",
-            "TOP3_YES","TOP3_NO","invalid_TOP3",
-            "TOP5_YES","TOP5_NO","invalid_TOP5",
-        ])
-        w.writerow([
-            overall["total_rows"],
-            overall["TOP1_YES"], overall["TOP1_NO"], overall["TOP1_UNSCORABLE"], overall["invalid_TOP1"],
-            overall["TOP3_YES"], overall["TOP3_NO"], overall["invalid_TOP3"],
-            overall["TOP5_YES"], overall["TOP5_NO"], overall["invalid_TOP5"],
-        ])
-    print(f"CSV (overall) saved to: {out_csv_overall.resolve()}")
-
-    # ذخیره CSV به تفکیک دپارتمان
-    out_csv_by_dept = OUTPUT_DIR / "judgment_counts_by_department.csv"
-    with out_csv_by_dept.open("w", encoding="utf-8", newline="") as f:
-        w = csv.writer(f)
-        w.writerow([
-            "department","total_rows",
-            "TOP1_YES","TOP1_NO","TOP1_UNSCORABLE","invalid_TOP1",
-            "TOP3_YES","TOP3_NO","invalid_TOP3",
-            "TOP5_YES","TOP5_NO","invalid_TOP5",
-        ])
-        for row in by_dept:
-            w.writerow([
-                row["department"], row["total_rows"],
-                row["TOP1_YES"], row["TOP1_NO"], row["TOP1_UNSCORABLE"], row["invalid_TOP1"],
-                row["TOP3_YES"], row["TOP3_NO"], row["invalid_TOP3"],
-                row["TOP5_YES"], row["TOP5_NO"], row["invalid_TOP5"],
-            ])
-    print(f"CSV (by department) saved to: {out_csv_by_dept.resolve()}")
-
-    # (اختیاری) CSV با نرخ‌ها هم بسازیم
-    try:
-        import pandas as pd
-        def safe_pct(n, d): 
-            return round(100.0*n/d, 2) if d else 0.0
-        rows = by_dept
-        df = pd.DataFrame(rows)
-        df["TOP1_ACC_%"] = df.apply(lambda r: safe_pct(r["TOP1_YES"], r["TOP1_YES"]+r["TOP1_NO"]), axis=1)
-        df["TOP3_HIT_%"] = df.apply(lambda r: safe_pct(r["TOP3_YES"], r["TOP3_YES"]+r["TOP3_NO"]), axis=1)
-        df["TOP5_HIT_%"] = df.apply(lambda r: safe_pct(r["TOP5_YES"], r["TOP5_YES"]+r["TOP5_NO"]), axis=1)
-        out_csv_rates = OUTPUT_DIR / "judgment_counts_by_department_with_rates.csv"
-        df.to_csv(out_csv_rates, index=False)
-        print(f"CSV (by department with rates) saved to: {out_csv_rates.resolve()}")
-    except Exception as e:
-        print("Skipping rates CSV (pandas not available?):", e)
+    # ذخیره CSV کلی + دپارتمانی (+ نرخ‌ها اگر pandas باشد)؛ با چند فایل: جمع همه
+    write_count_csvs(overall, by_dept, out_dir)
+    # مقایسهٔ مدل×روش: یک سطر برای هر فایل / اجرا
+    if runs:
+        write_run_csvs(runs, out_dir)
+    if args.bootstrap > 0 and cols is not None:
+        report_stats(cols, labels, args.bootstrap, args.seed, out_dir)
 
 if __name__ == "__main__":
     main()
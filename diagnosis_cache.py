@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Result cache for /api/diagnosis (diagnosis_service.py), keyed by the canonical symptom set.
+
+Users of the frontend submit the same few symptoms in different orders, cases and
+spacing ("Fever, cough" / " cough", "FEVER"); decoding is greedy, so the answer only
+depends on the prompt. The service builds the prompt from canonical_symptoms() when the
+cache is on, so one key ↔ one prompt ↔ one answer, and a hit returns exactly what the
+model would have produced again.
+
+Key  = sha256 of (model id, prompt version, generation params, canonical symptoms).
+       The prompt version is a hash of the prompt template, so editing the prompt
+       invalidates the cache by itself.
+LRU:   at most max_entries results in memory, least recently used evicted first.
+TTL:   a result expires ttl_s seconds after it was stored (0 = never).
+Disk:  optional JSONL journal (one line per stored result). It is replayed on start
+       (expired entries skipped, most recent store wins), then rewritten compactly;
+       it is compacted again once it holds twice the live entries. After a restart
+       the LRU order is the store order.
+Stats: hits / misses / expired / evictions / stores → summary() and as_dict().
+
+Usage:
+    cache = DiagnosisCache(max_entries=4096, ttl_s=7 * 86400, path=Path("dx_cache.jsonl"))
+    key = cache.key(canonical_symptoms(symptoms), model="dmis-lab/meerkat-7b-v1.0", prompt_version=v)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.put(key, value)
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+
+CACHE_MAX_ENTRIES = 4096
+CACHE_TTL_S       = 7 * 24 * 3600   # a week; 0 = no expiry
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCT = re.compile(r"^[\s.,;:!?\-–—*•]+|[\s.,;:!?\-–—*•]+$")   # bullets / trailing periods
+
+
+def canonical_symptom(s: str) -> str:
+    """NFKC, case-folded, inner whitespace collapsed, bullets/punctuation at the edges removed."""
+    s = unicodedata.normalize("NFKC", str(s)).casefold()
+    return _EDGE_PUNCT.sub("", _SPACES.sub(" ", s)).strip()
+
+def canonical_symptoms(symptoms: Sequence[str]) -> List[str]:
+    """Sorted, de-duplicated canonical symptoms (empty ones dropped)."""
+    return sorted({c for c in (canonical_symptom(s) for s in symptoms) if c})
+
+def text_version(text: str) -> str:
+    """Short hash identifying a prompt template (or any text) in a cache key."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class DiagnosisCache:
+    """Thread-safe LRU + TTL cache of JSON-able results, optionally journaled to disk."""
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl_s: float = CACHE_TTL_S,
+                 path: Optional[Path] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl_s = ttl_s
+        self.path = Path(path) if path else None
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()   # key → (stored_at, value)
+        self._journal = None
+        self._journal_lines = 0
+        self.hits = self.misses = self.expired = self.stores = self.evictions = 0
+        if self.path is not None:
+            self._load()
+
+    # ---- keys ------------------------------------------------------------------
+
+    @staticmethod
+    def key(symptoms: Sequence[str], model: str, prompt_version: str,
+            params: Optional[Dict[str, Any]] = None) -> str:
+        blob = json.dumps([model, prompt_version, params or {}, list(symptoms)], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    # ---- get / put -------------------------------------------------------------
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self._is_expired(entry[0], time.time()):
+                del self._lru[key]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._lru.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            self._lru.pop(key, None)
+            self._lru[key] = (now, value)
+            self.stores += 1
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+                self.evictions += 1
+            if self._journal is not None:
+                self._journal.write(json.dumps({"k": key, "t": now, "v": value}, ensure_ascii=False) + "\n")
+                self._journal.flush()
+                self._journal_lines += 1
+                if self._journal_lines > 2 * len(self._lru) + 64:
+                    self._compact()
+
+    def __len__(self) -> int:
+        return len(self._lru)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    # ---- journal ---------------------------------------------------------------
+
+    def _is_expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_s > 0 and now - stored_at > self.ttl_s
+
+    def _load(self):
+        now = time.time()
+        if self.path.exists():
+            with self.path.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        key, stored_at, value = rec["k"], float(rec["t"]), rec["v"]
+                    except (ValueError, KeyError, TypeError):
+                        continue   # torn last line after a crash
+                    self._lru.pop(key, None)
+                    if not self._is_expired(stored_at, now):
+                        self._lru[key] = (stored_at, value)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+        with self._lock:
+            self._compact()   # drops dead lines and any torn tail before appending
+
+    def _compact(self):
+        """Caller holds self._lock: rewrite the journal with the live entries only."""
+        if self._journal is not None:
+            self._journal.close()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            for key, (stored_at, value) in self._lru.items():
+                f.write(json.dumps({"k": key, "t": stored_at, "v": value}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)   # atomic: a crash leaves the old or the new journal
+        self._journal = self.path.open("a", encoding="utf-8")
+        self._journal_lines = len(self._lru)
+
+    # ---- stats -----------------------------------------------------------------
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            looked_up = self.hits + self.misses
+            return {
+                "entries": len(self._lru), "max_entries": self.max_entries, "hits": self.hits,
+                "misses": self.misses, "expired": self.expired, "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / looked_up, 4) if looked_up else 0.0,
+            }
+
+    def summary(self) -> str:
+        d = self.as_dict()
+        return (f"cache: hits={d['hits']} misses={d['misses']} ({100 * d['hit_rate']:.1f}% hit) "
+                f"expired={d['expired']} stores={d['stores']} evictions={d['evictions']} "
+                f"entries={d['entries']}/{d['max_entries']}")
@@ -0,0 +1,826 @@
+# -*- coding: utf-8 -*-
+"""
+The DX API of Medical_Assistant-final.ipynb (POST /api/diagnosis → DiagnosisOutput) as a
+module, with an async micro-batching scheduler (batch_scheduler.py) between the
+endpoint and the model.
+
+In the notebook the handler is a plain `def` that calls run_llm(): every request holds
+the GPU alone for its whole generation, concurrent users wait in FastAPI's thread
+pool and nothing bounds the backlog. Here the handler is `async`, submits its prompt
+to the scheduler and awaits its own text.
+
+— How it works —
+* Prompt, parsers (Step 3 differentials, Step 2 broad list, questions) and the final
+  decision are the notebook's, copied unchanged, so a response has the same shape and
+  content as before.
+* The scheduler collects requests for MAX_WAIT_MS, runs them as ONE left-padded
+  model.generate (HFBatchGenerator: greedy, max_new_tokens 1400, run_llm's
+  ASSISTANT-prefix strip per row) and resolves every request with its own answer.
+* Backpressure: more than MAX_QUEUE waiting requests → 503 with Retry-After (an
+  estimate from the recent batch time) instead of an ever-growing latency.
+* GET /api/health: queue depth, batches, mean batch size, latency percentiles.
+* POST /api/diagnosis/stream answers with Server-Sent Events instead of waiting for
+  the whole generation (~45 s for 1400 tokens):
+      event: token      {"text": ...}                      every decoded text delta
+      event: condition  {"name", "likelihood", "reason"}   as soon as its chunk is complete
+      event: question   {"text": ...}                      each clarifying question
+      event: done       {"result": DiagnosisOutput, "tokens", "finish", "seconds", "first_condition_s"}
+  The generation runs on the scheduler's worker thread between batches (a streamer
+  cannot share a padded batch) and pushes text deltas to the handler through the
+  event loop. DiagnosisStreamParser re-runs the notebook parsers on the completed
+  lines only; a condition is emitted once its Likelihood line has arrived (its Name
+  and Justification come before it) or its Step 3 block has ended, a question once
+  its line is complete. "done" carries build_output() of the whole text, i.e. exactly
+  what /api/diagnosis returns for that text. Stop criteria (stop_criteria.py) end the
+  stream as soon as the answer is complete, and a client that disconnects stops its
+  generation at the next token. The batched path applies the same criteria per row
+  (StructuredStop), so both endpoints parse the same text for the same symptoms.
+* Result cache (diagnosis_cache.py, --no-cache to disable): the symptoms are
+  canonicalised (case, whitespace, order, duplicates) and the prompt is built from the
+  canonical list, so equal symptom sets share one prompt and, decoding being greedy,
+  one answer. /api/diagnosis answers a repeated set from an LRU+TTL cache keyed by
+  (model, prompt version, max_new_tokens, symptoms), optionally journaled to disk
+  (--cache-file) across restarts. Identical requests in flight at the same time share
+  one generation. Hit rate etc. are in /api/health.
+* --stub replaces the model with StubGenerator (sleeps like a batched generate, returns
+  a canned answer) so the service can be load-tested on CPU; `python bench.py service`
+  does that in-process.
+
+Greedy decoding of a left-padded batch gives the same answers as one prompt at a time
+up to fp16 rounding in the padded matmuls.
+
+Usage:
+    python diagnosis_service.py --batch 8 --wait-ms 10 --queue 64          # Meerkat on DEVICE
+    python diagnosis_service.py --stub --port 8000                          # CPU stand-in
+    python diagnosis_service.py --cache-file dx_cache.jsonl --cache-ttl 86400   # cache kept across restarts
+    curl -X POST localhost:8000/api/diagnosis -H 'Content-Type: application/json' \
+         -d '{"symptoms": ["fever", "cough"]}'
+    curl -N -X POST localhost:8000/api/diagnosis/stream -H 'Content-Type: application/json' \
+         -d '{"symptoms": ["fever", "cough"]}'
+"""
+
+import re
+import json
+import math
+import time
+import asyncio
+import argparse
+import threading
+import traceback
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Dict, Tuple
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList
+from transformers.generation.streamers import BaseStreamer
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from fastapi.middleware.cors import CORSMiddleware
+
+from batch_scheduler import MicroBatchScheduler, Overloaded, MAX_BATCH, MAX_WAIT_MS, MAX_QUEUE
+from stop_criteria import StopChecker, StructuredStop, default_criteria
+from diagnosis_cache import DiagnosisCache, canonical_symptoms, text_version, CACHE_MAX_ENTRIES, CACHE_TTL_S
+
+
+# =============================================================================
+#                       ⚙️  EDITABLE CONSTANTS (TOP-OF-FILE)
+# =============================================================================
+
+MODEL_NAME     = "dmis-lab/meerkat-7b-v1.0"
+DEVICE         = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+MAX_NEW_TOKENS = 1400     # run_llm's default
+API_VERSION    = "1.4"
+
+STUB_BATCH_S   = 0.20     # --stub: seconds per generate call ...
+STUB_ROW_S     = 0.01     # ... plus this per prompt in the batch (decode is memory-bound)
+STUB_TOKEN_S   = 0.03     # --stub streaming: seconds per streamed piece (~Meerkat fp16 per token)
+
+STOP_EARLY     = True     # both endpoints end a generation once the answer is complete (stop_criteria.py)
+
+RESULT_CACHE   = True     # cache /api/diagnosis results by canonical symptom set (--no-cache)
+CACHE_FILE     = ""       # JSONL journal that keeps the cache across restarts ("" = memory only)
+
+DEBUG = False
+
+
+# =============================================================================
+#                      Schemas, prompt, parsers (notebook)
+# =============================================================================
+
+class DiagnosisInput(BaseModel):
+    symptoms: List[str] = Field(default_factory=list)
+
+class ConditionItem(BaseModel):
+    name: str
+    likelihood: Optional[float] = None   # 0..1
+    reason: Optional[str] = None
+
+class DiagnosisOutput(BaseModel):
+    conditions: List[ConditionItem]
+    clarifying_questions: List[str]
+
+
+# build prompt (single step CoT)
+def build_diagnosis_prompt(symptom):
+    return f"""
+Patient Symptoms:
+{symptom}
+
+You are a specialized medical AI assistant. Your responses must be:
+1.  Strictly based on established medical knowledge.
+2.  Confined to medical and healthcare-related topics only. If a query is not medical, state this and do not proceed with a medical assessment.
+3.  Aim to provide helpful, cautious information. Do not speculate beyond the provided symptoms or invent information. You should approach this task by thinking step-by-step.
+
+Task: Your goal is to analyze the patient symptoms methodically to determine potential conditions. Please follow these steps carefully:
+
+Step 1 – Symptom Categorization:
+For each symptom listed in \"Patient Symptoms\" (both explicit and implicit), categorize it by the primary affected bodily system(s). Present this as a clear list.
+
+Step 2 – Broad List of Potential Conditions:
+Based on the combination of symptoms and your categorizations in Step 1, generate a broad list of potential diseases or conditions (approximately 6-8 possibilities) that could initially be considered. Do not evaluate or rank them at this stage; simply list them.
+
+Step 3 – Differential Diagnoses with Detailed Evaluation:
+From your broad list in Step 2, critically evaluate the possibilities. Select the 5 most probable differential diagnoses that best align with the *entire* symptom set. For each of these selected diagnoses, you MUST provide the following details:
+    a.  **Diagnosis Name:** [Name of the potential disease]
+    b.  **Justification:** [Provide a clear and concise justification explaining why this diagnosis is a strong possibility. Specifically link this to the individual symptoms (Explicit and Implicit) and your system categorizations from Step 1. Explain how the symptom complex aligns with this condition.]
+    c.  **Likelihood:** [Estimate the likelihood of this diagnosis given the current information]
+    d.  **Confidence:** [State your confidence level in this assessment for this specific diagnosis]
+
+    If, after your analysis, you determine that the provided symptoms are too vague or insufficient to form a reliable list of 5 differential diagnoses with reasonable confidence, you must explicitly state this and explain why. However, still attempt to list any broad considerations from Step 2 that might be relevant if more information were available.
+
+Clarifying Questions to Ask:
+After completing Step 3 (your differential diagnoses and evaluations):
+* Identify and list 2-3 specific, targeted questions you would ask the patient or a clinician.
+* These questions should be aimed at gathering critical information that would best help to differentiate between the diagnoses listed in Step 3, or to significantly increase your confidence in those assessments.
+* Phrase these as direct questions.
+
+Output Structure:
+Ensure your entire response is clearly structured. Label and complete each step (Step 1, Step 2, Step 3) in order, followed by the \"Clarifying Questions to Ask\" section.
+ASSISTANT:
+"""
+
+
+def dprint(label, value=None, maxlen=800):
+    if not DEBUG:
+        return
+    try:
+        if isinstance(value, str):
+            print(f"\n[DBG] {label}  (len={len(value)}):\n{value[:maxlen]}\n---")
+        else:
+            print(f"\n[DBG] {label}: {value}\n---")
+    except Exception as _:
+        print(f"\n[DBG] {label}: <unprintable>\n---")
+
+
+LIKELIHOOD_MAP = {"high": 0.85, "medium": 0.55, "low": 0.25}
+
+def _to_num_likelihood(val: Optional[str]) -> Optional[float]:
+    if not val: return None
+    val = val.strip()
+    m = re.match(r"^(\d{1,3})\s*%$", val)  # 55% → 0.55
+    if m:
+        pct = int(m.group(1))
+        if 0 <= pct <= 100:
+            return round(pct/100.0, 2)
+    return LIKELIHOOD_MAP.get(val.lower(), None)
+
+
+def _looks_placeholder(text: Optional[str]) -> bool:
+    if not text: return True
+    t = text.lower()
+    if "[" in t and "]" in t:
+        return True
+    bad = [
+        "name of the potential disease",
+        "provide a clear and concise justification",
+        "reason for selection",
+    ]
+    return any(b in t for b in bad)
+
+
+def _get_block(full_text: str, step: int) -> str:
+    """
+    آخرین وقوع Step N را برمی‌گرداند (نه اولین) و تا قبل از Step N+1 یا
+    'Clarifying Questions' را برش می‌زند.
+    """
+    step_iter = list(re.finditer(rf"(?im)^\s*Step\s*{step}\s*[-–—]?.*$", full_text))
+    if not step_iter:
+        return full_text
+    start = step_iter[-1].end()
+    m2 = re.search(
+        rf"(?im)^\s*(?:Step\s*{step+1}\s*[-–—]?.*|Clarifying Questions)",
+        full_text[start:]
+    )
+    end = start + m2.start() if m2 else len(full_text)
+    return full_text[start:end]
+
+
+def parse_step2_broad_list(full_text: str) -> List[str]:
+    block = _get_block(full_text, 2)
+    dprint("STEP2_BLOCK", block, 600)
+    candidates = re.findall(r"^(?:\s*[-*\u2022]|\s*\d+\.)\s*(.+)$", block, flags=re.M)
+    dprint("STEP2_CANDIDATES_COUNT", len(candidates))
+    if not candidates:
+        candidates = re.findall(r"^(?:\s*[-*\u2022]|\s*\d+\.)\s*(.+)$", full_text, flags=re.M)
+
+    names, seen = [], set()
+    for line in candidates:
+        name = re.sub(r"\s*[:\-–—].*$", "", line).strip()
+        if name and name.lower() not in seen and not _looks_placeholder(name):
+            names.append(name); seen.add(name.lower())
+        if len(names) == 5: break
+    dprint("STEP2_NAMES", names)
+    return names
+
+
+def parse_step3_differentials(full_text: str) -> List[Dict]:
+    block = _get_block(full_text, 3)
+    dprint("STEP3_BLOCK", block, 800)
+    results: List[Dict] = []
+
+    # ---------- A) الگوی کلاسیک: "Diagnosis Name:" ----------
+    dn_iter = list(re.finditer(
+        r"(?im)^\s*(?:[a-z]\.|-|\d+\.)?\s*Diagnosis Name\s*:\s*(.+)$",
+        block
+    ))
+    dprint("STEP3_DIAGNAME_MATCHES", len(dn_iter))
+    for i, m0 in enumerate(dn_iter):
+        name = m0.group(1).strip()
+        start = m0.end()
+        end = dn_iter[i+1].start() if i+1 < len(dn_iter) else len(block)
+        chunk = block[start:end]
+
+        jm = re.search(
+            r"(?is)\bJustification\s*(?:[:\-–—])?\s*(.+?)(?=\n\s*(?:[-*•]|[a-d]\.|Likelihood|Confidence|Diagnosis Name\s*:)|\Z)",
+            chunk
+        )
+        # ⬅️ Likelihood با پشتیبانی از بولت اول خط و انواع جداکننده‌ها
+        lm = re.search(
+            r"(?i)(?:^|\n)\s*[-*•\u2022–—-]?\s*Likelihood\s*(?:[:\-–—])?\s*(High|Medium|Low|\d{1,3}\s*%)",
+            chunk
+        )
+
+        reason = re.sub(r"\s+", " ", jm.group(1).strip()) if jm else None
+        like = _to_num_likelihood(lm.group(1)) if lm else None
+
+        if like is None:
+            hit = re.findall(r"(?im)^.*Likelihood.*$", chunk)
+            dprint("LIKELIHOOD_LINE_DEBUG(A)", hit[:3])
+
+        if name and not _looks_placeholder(name) and not _looks_placeholder(reason):
+            results.append({"name": name, "likelihood": like, "reason": reason})
+
+    # ---------- B) کارت: "** Name\nLikelihood\n...\nReason for Selection:" ----------
+    card_re = re.compile(
+        r"\*\*\s*([^\n]+?)\s*\n"
+        r"\s*Likelihood\s*(?:[:\-–—]?)\s*\n"
+        r"\s*(High|Medium|Low|\d{1,3}\s*%)\s*\n"
+        r"\s*Reason\s*for\s*Selection\s*:\s*\n?"
+        r"\s*\*{0,2}\s*(.+?)(?=\n\*\*|\Z)",
+        flags=re.I | re.S
+    )
+    for name, like_val, reason in card_re.findall(block):
+        name = name.strip().strip("*")
+        reason = re.sub(r"\s+", " ", reason.strip().strip("*"))
+        like = _to_num_likelihood(like_val)
+        if name and not _looks_placeholder(name) and not _looks_placeholder(reason):
+            if all(name.lower() != r["name"].lower() for r in results):
+                results.append({"name": name, "likelihood": like, "reason": reason})
+
+    # ---------- C) شماره‌دار/بولتی: "1. Name" + خطوط شامل Justification/Likelihood ----------
+    enum_re = re.compile(
+        r"(?m)^\s*(?:\d+\.|[a-e]\.)\s*(?P<name>.+?)\s*\n"
+        r"(?P<rest>.*?)(?=\n\s*(?:\d+\.|[a-e]\.|\*\*|Diagnosis Name\s*:)|\Z)",
+        flags=re.M | re.S
+    )
+    for m in enum_re.finditer(block):
+        name = m.group("name").strip()
+        rest = m.group("rest") or ""
+
+        # Justification با هر جداکننده و تا انتهای خط/نکست‌لاین
+        jm = re.search(r"(?is)Justification\s*(?:[:\-–—])?\s*(.+?)(?:\n|$)", rest)
+        # ⬅️ Likelihood با آغاز خط/پس از newline و پوشش بولت‌ها + جداکننده‌ها
+        lm = re.search(
+            r"(?i)(?:^|\n)\s*[-*•\u2022–—-]?\s*Likelihood\s*(?:[:\-–—])?\s*(High|Medium|Low|\d{1,3}\s*%)",
+            rest
+        )
+
+        reason = re.sub(r"\s+", " ", jm.group(1).strip()) if jm else None
+        like = _to_num_likelihood(lm.group(1)) if lm else None
+
+        if like is None:
+            hit = re.findall(r"(?im)^.*Likelihood.*$", rest)
+            dprint("LIKELIHOOD_LINE_DEBUG(C)", hit[:3])
+
+        if name and not _looks_placeholder(name) and not _looks_placeholder(reason or ""):
+            if all(name.lower() != r["name"].lower() for r in results):
+                results.append({"name": name, "likelihood": like, "reason": reason})
+
+    # ---------- لاگ‌های آماری ----------
+    card_hits = list(card_re.findall(block))
+    dprint("STEP3_CARD_MATCHES", len(card_hits))
+    enum_hits = list(enum_re.finditer(block))
+    dprint("STEP3_ENUM_MATCHES", len(list(enum_hits)))
+    dprint("STEP3_RESULTS_COUNT", len(results))
+    dprint("STEP3_RESULTS_SAMPLE", results[:2])
+
+    return results[:7]
+
+
+def parse_questions(full_text: str) -> List[str]:
+    m = re.search(r"(?i)Clarifying Questions(?:\s*to\s*Ask)?\s*:\s*([\s\S]*)", full_text)
+    if not m:
+        return []
+    block = m.group(1)
+    lines = re.findall(r"(?m)^\s*(?:[-*•]|\d+\.)\s*(.+)$", block)
+    lines = [re.sub(r"\s+", " ", l).strip() for l in lines if l.strip()]
+    return lines[:5]
+
+
+def merge_conditions(step2_names: List[str], step3_items: List[Dict]) -> List[Dict]:
+    dmap = {d["name"].lower(): d for d in step3_items}
+    out: List[Dict] = []
+    for n in step2_names:
+        k = n.lower()
+        if k in dmap:
+            out.append({"name": n, "likelihood": dmap[k].get("likelihood"), "reason": dmap[k].get("reason")})
+        else:
+            out.append({"name": n, "likelihood": None, "reason": None})
+        if len(out) == 5: break
+    if len(out) < 5:
+        for d in step3_items:
+            if all(d["name"].lower() != x["name"].lower() for x in out):
+                out.append({"name": d["name"], "likelihood": d.get("likelihood"), "reason": d.get("reason")})
+                if len(out) == 5:
+                    break
+    return out[:5]
+
+
+# =============================================================================
+#                         Model answer → DiagnosisOutput
+# =============================================================================
+
+def strip_assistant(text: str) -> str:
+    """run_llm's post-processing: drop an echoed "ASSISTANT:" and leading whitespace."""
+    m = re.search(r"(?i)ASSISTANT\s*:\s*", text)
+    if m:
+        text = text[m.end():]
+    return text.lstrip()
+
+def symptom_lines(symptoms: List[str]) -> str:
+    return "\n".join(f"- {s.strip()}" for s in symptoms if s.strip())
+
+def build_output(raw: str) -> DiagnosisOutput:
+    """The notebook handler's parse + decision on one model answer."""
+    dprint("RAW_MODEL_OUTPUT", raw, 500000)
+
+    dprint("HAS Step 2 label", bool(re.search(r"Step\s*2", raw)))
+    dprint("HAS Step 3 label", bool(re.search(r"Step\s*3", raw)))
+    dprint("HAS Clarifying Questions label", bool(re.search(r"Clarifying Questions", raw, re.I)))
+
+    try:
+        step3 = parse_step3_differentials(raw)
+        step2 = parse_step2_broad_list(raw)
+        questions = parse_questions(raw)
+        dprint("PARSED Step3 count", len(step3))
+        dprint("PARSED Step2 names", step2)
+        dprint("PARSED Questions", questions)
+
+        # تصمیم نهایی: اگر Step3 داریم، مستقیم همون رو بده
+        if step3:
+            conditions = step3[:5]
+        elif step2:
+            conditions = [{"name": n, "likelihood": None, "reason": None} for n in step2][:5]
+        else:
+            quick = re.findall(
+                r"(?im)^\s*(?:[a-z]\.|-|\d+\.)?\s*(?:Diagnosis Name\s*:)?\s*([A-Z][^\n:]+)\s*\n\s*(?:[-*•]?\s*)?Likelihood\s*:",
+                raw
+            )
+            quick = [re.sub(r"\s+", " ", q).strip() for q in quick]
+            quick = list(dict.fromkeys([q for q in quick if q]))[:5]
+            if quick:
+                conditions = [{"name": n, "likelihood": None, "reason": None} for n in quick]
+            else:
+                conditions = []
+
+        dprint("FINAL_CONDITIONS", conditions)
+        dprint("FINAL_QUESTIONS", questions)
+        return DiagnosisOutput(
+            conditions=[ConditionItem(**c) for c in conditions],
+            clarifying_questions=questions
+        )
+
+    except Exception as e:
+        dprint("EXCEPTION", traceback.format_exc())
+        # به‌جای 422، پاسخ خالی برگردون تا فرانت کرش نکنه (ولی لاگ داری)
+        return DiagnosisOutput(conditions=[], clarifying_questions=[])
+
+
+# =============================================================================
+#                      Incremental parsing (streaming endpoint)
+# =============================================================================
+
+STEP3_START = re.compile(r"(?im)^\s*Step\s*3\s*[-–—]?.*$")                     # _get_block(…, 3)
+STEP3_END = re.compile(r"(?im)^\s*(?:Step\s*4\s*[-–—]?.*|Clarifying Questions)")
+QUESTIONS_START = re.compile(r"(?i)Clarifying Questions(?:\s*to\s*Ask)?\s*:")     # parse_questions
+
+class DiagnosisStreamParser:
+    """
+    feed() the answer as it is generated; get ("condition", item) / ("question", text)
+    events as soon as the notebook parsers can no longer change them. Only completed
+    lines are parsed, once per feed() that completes a line.
+    """
+
+    def __init__(self, max_conditions: int = 5, max_questions: int = 5):
+        self.max_conditions = max_conditions
+        self.max_questions = max_questions
+        self.text = ""
+        self.conditions: List[Dict] = []
+        self.questions: List[str] = []
+        self._parsed = 0     # length of the prefix (whole lines) parsed last
+        self._names = set()
+
+    def feed(self, delta: str) -> List[Tuple[str, Any]]:
+        self.text += delta
+        cut = self.text.rfind("\n", self._parsed) + 1
+        if cut <= self._parsed:
+            return []
+        self._parsed = cut
+        return self._scan(self.text[:cut], final=False)
+
+    def close(self) -> List[Tuple[str, Any]]:
+        """The last (possibly unterminated) line; every condition still held back is final now."""
+        self._parsed = len(self.text)
+        return self._scan(self.text, final=True)
+
+    def _scan(self, text: str, final: bool) -> List[Tuple[str, Any]]:
+        events: List[Tuple[str, Any]] = []
+        starts = list(STEP3_START.finditer(text))
+        if starts and len(self.conditions) < self.max_conditions:
+            closed = final or STEP3_END.search(text, starts[-1].end()) is not None
+            for item in parse_step3_differentials(text):
+                key = item["name"].lower()
+                if key in self._names or not (closed or item["likelihood"] is not None):
+                    continue
+                self._names.add(key)
+                self.conditions.append(item)
+                events.append(("condition", item))
+                if len(self.conditions) == self.max_conditions:
+                    break
+        if len(self.questions) < self.max_questions and QUESTIONS_START.search(text):
+            for q in parse_questions(text)[len(self.questions):self.max_questions]:
+                self.questions.append(q)
+                events.append(("question", q))
+        return events
+
+
+# =============================================================================
+#                          Batched generation backends
+# =============================================================================
+
+class HFBatchGenerator:
+    """generate_batch for the scheduler: one left-padded greedy model.generate over all prompts."""
+
+    def __init__(self, model, tokenizer, max_new_tokens: int = MAX_NEW_TOKENS, stop: bool = STOP_EARLY):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop
+        self.device = next(model.parameters()).device
+        tokenizer.padding_side = "left"   # new tokens must follow every prompt directly
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+    def __call__(self, prompts: List[str]) -> List[str]:
+        inputs = self.tokenizer(list(prompts), return_tensors="pt", padding=True).to(self.device)
+        width = inputs["input_ids"].shape[1]
+        # the same criteria as stream(): a row's text is cut exactly where the stream would end
+        stop = StructuredStop(self.tokenizer, width, default_criteria if self.stop else list)
+        with torch.inference_mode():
+            out = self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
+                stopping_criteria=StoppingCriteriaList([stop]),
+            )
+        texts = []
+        for i, row in enumerate(out):
+            cut = stop.answer(i)
+            texts.append(strip_assistant(cut if cut is not None else
+                                         self.tokenizer.decode(row[width:], skip_special_tokens=True)))
+        return texts
+
+    def stream(self, prompt: str, emit: Callable[[str], None], cancelled: Callable[[], bool],
+               stop: Optional[bool] = None) -> Dict[str, Any]:
+        """One greedy generation; emit(text delta) per decoded piece, cut where a stop criterion fires."""
+        stop = self.stop if stop is None else stop
+        streamer = _DeltaStreamer(StopChecker(self.tokenizer, default_criteria() if stop else []), emit, cancelled)
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        with torch.inference_mode():
+            self.model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                do_sample=False,
+                eos_token_id=self.tokenizer.eos_token_id,
+                pad_token_id=self.tokenizer.pad_token_id,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([_Halt(streamer)]),
+            )
+        hit = streamer.checker.hit
+        if hit is not None:
+            finish = hit.reason
+        elif cancelled():
+            finish = "cancelled"
+        else:
+            finish = "length" if streamer.tokens >= self.max_new_tokens else "eos"
+        # a line criterion fires once the line after the answer has begun, so a few characters past the
+        # cut may already have been emitted; "text" is the cut answer, the one __call__ would return
+        return {"tokens": streamer.tokens, "finish": finish, "text": streamer.checker.answer()}
+
+
+class _DeltaStreamer(BaseStreamer):
+    """TextIteratorStreamer-like: new tokens → incremental text deltas → emit(), on the generate thread."""
+
+    def __init__(self, checker: StopChecker, emit: Callable[[str], None], cancelled: Callable[[], bool]):
+        self.checker = checker
+        self.emit = emit
+        self.cancelled = cancelled
+        self.tokens = 0
+        self._prompt = True
+
+    @property
+    def halt(self) -> bool:
+        return self.checker.hit is not None or self.cancelled()
+
+    def put(self, value):
+        if self._prompt:   # generate() hands over the prompt first
+            self._prompt = False
+            return
+        for tok in value.reshape(-1).tolist():
+            if self.halt:
+                return
+            self.tokens += 1
+            before = len(self.checker.text)
+            hit = self.checker.feed(tok)
+            end = hit.end if hit is not None else len(self.checker.text)
+            if end > before:
+                self.emit(self.checker.text[before:end])
+
+    def end(self):
+        pass
+
+
+class _Halt(StoppingCriteria):
+    """Ends generate() once the streamer's stop criteria fired or the client went away."""
+
+    def __init__(self, streamer: _DeltaStreamer):
+        self.streamer = streamer
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.streamer.halt, dtype=torch.bool, device=input_ids.device)
+
+
+STUB_ANSWER = """Step 1 – Symptom Categorization:
+- Fever: systemic
+- Cough: respiratory
+
+Step 2 – Broad List of Potential Conditions:
+1. Community-acquired pneumonia
+2. Acute bronchitis
+3. Influenza
+4. COVID-19
+5. Pulmonary tuberculosis
+
+Step 3 – Differential Diagnoses with Detailed Evaluation:
+Diagnosis Name: Community-acquired pneumonia
+Justification: Fever with productive cough points to a lower respiratory infection.
+Likelihood: High
+Confidence: Medium
+
+Diagnosis Name: Influenza
+Justification: Abrupt fever and cough are typical during flu season.
+Likelihood: Medium
+Confidence: Medium
+
+Clarifying Questions to Ask:
+1. Is the cough productive, and what color is the sputum?
+2. Have you had shortness of breath or chest pain?
+"""
+
+class StubGenerator:
+    """CPU stand-in for load tests: sleeps like a batched generate (fixed + per-row cost), returns STUB_ANSWER."""
+
+    def __init__(self, batch_s: float = STUB_BATCH_S, row_s: float = STUB_ROW_S, answer: str = STUB_ANSWER,
+                 token_s: float = STUB_TOKEN_S):
+        self.batch_s = batch_s
+        self.row_s = row_s
+        self.answer = answer
+        self.token_s = token_s
+
+    def __call__(self, prompts: List[str]) -> List[str]:
+        time.sleep(self.batch_s + self.row_s * len(prompts))
+        return [self.answer] * len(prompts)
+
+    def stream(self, prompt: str, emit: Callable[[str], None], cancelled: Callable[[], bool]) -> Dict[str, Any]:
+        pieces = re.findall(r"\s*\S+|\s+", self.answer)
+        for i, piece in enumerate(pieces):
+            if cancelled():
+                return {"tokens": i, "finish": "cancelled"}
+            time.sleep(self.token_s)
+            emit(piece)
+        return {"tokens": len(pieces), "finish": "eos"}
+
+
+# =============================================================================
+#                                   App
+# =============================================================================
+
+def sse(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+PROMPT_VERSION = text_version(build_diagnosis_prompt("{symptoms}"))
+
+def create_app(scheduler: MicroBatchScheduler, cache: Optional[DiagnosisCache] = None,
+               model_tag: str = MODEL_NAME) -> FastAPI:
+    """`model_tag` identifies the weights behind the scheduler in cache keys."""
+    cache_params = {"max_new_tokens": getattr(scheduler.generate_batch, "max_new_tokens", None),
+                    "stop": getattr(scheduler.generate_batch, "stop", None)}
+    inflight: Dict[str, asyncio.Task] = {}   # cache key → generation shared by identical requests
+    coalesced = 0
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await scheduler.start()
+        yield
+        print(f"📈 {scheduler.stats.summary()}")
+        await scheduler.stop()
+        if cache is not None:
+            print(f"🗄  {cache.summary()} coalesced={coalesced}")
+            cache.close()
+
+    def prompt_symptoms(inp: DiagnosisInput) -> List[str]:
+        # with the cache on, equal symptom sets must give the same prompt (see diagnosis_cache.py)
+        return canonical_symptoms(inp.symptoms) if cache is not None else inp.symptoms
+
+    async def generate(prompt: str) -> DiagnosisOutput:
+        return build_output(await scheduler.submit(prompt))
+
+    def finished(key: str, task: asyncio.Task):
+        inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        out = task.result()
+        if out.conditions or out.clarifying_questions:   # never cache the empty fallback
+            cache.put(key, out.model_dump())
+
+    async def cached_generate(symptoms: List[str], prompt: str) -> DiagnosisOutput:
+        nonlocal coalesced
+        key = cache.key(symptoms, model_tag, PROMPT_VERSION, cache_params)
+        hit = cache.get(key)
+        if hit is not None:
+            return DiagnosisOutput(**hit)
+        task = inflight.get(key)
+        if task is not None:
+            coalesced += 1
+        else:
+            # a task, so the result is still cached when the first caller disconnects
+            task = inflight[key] = asyncio.ensure_future(generate(prompt))
+            task.add_done_callback(lambda t: finished(key, t))
+        return await asyncio.shield(task)
+
+    app = FastAPI(title="DX API", version=API_VERSION, lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # در تولید محدود کن
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    @app.post("/api/diagnosis", response_model=DiagnosisOutput)
+    async def diagnosis(inp: DiagnosisInput):
+        if not inp.symptoms:
+            raise HTTPException(status_code=400, detail="No symptoms provided.")
+
+        dprint("SYMPTOMS", inp.symptoms)
+        symptoms = prompt_symptoms(inp)
+        prompt = build_diagnosis_prompt(symptom_lines(symptoms))
+        dprint("PROMPT", prompt, 600)
+
+        try:
+            if cache is not None:
+                return await cached_generate(symptoms, prompt)
+            return await generate(prompt)
+        except Overloaded as e:
+            raise HTTPException(status_code=503, detail="Server busy, please retry.",
+                                headers={"Retry-After": str(math.ceil(e.retry_after))})
+
+    @app.post("/api/diagnosis/stream")
+    async def diagnosis_stream(inp: DiagnosisInput):
+        if not inp.symptoms:
+            raise HTTPException(status_code=400, detail="No symptoms provided.")
+        prompt = build_diagnosis_prompt(symptom_lines(prompt_symptoms(inp)))
+
+        loop = asyncio.get_running_loop()
+        deltas: asyncio.Queue = asyncio.Queue()
+        gone = threading.Event()
+
+        def emit(delta: str):   # generate thread → event loop
+            loop.call_soon_threadsafe(deltas.put_nowait, delta)
+
+        try:
+            job = scheduler.run_exclusive(scheduler.generate_batch.stream, prompt, emit, gone.is_set)
+        except Overloaded as e:
+            raise HTTPException(status_code=503, detail="Server busy, please retry.",
+                                headers={"Retry-After": str(math.ceil(e.retry_after))})
+        job.add_done_callback(lambda _: deltas.put_nowait(None))   # after every delta (same loop, FIFO)
+
+        async def events():
+            t0 = time.perf_counter()
+            first_condition = None
+            parser = DiagnosisStreamParser()
+
+            def parsed(items) -> str:
+                nonlocal first_condition
+                out = []
+                for kind, data in items:
+                    if kind == "condition" and first_condition is None:
+                        first_condition = round(time.perf_counter() - t0, 3)
+                    out.append(sse(kind, data if kind == "condition" else {"text": data}))
+                return "".join(out)
+
+            try:
+                while (delta := await deltas.get()) is not None:
+                    yield sse("token", {"text": delta}) + parsed(parser.feed(delta))
+                info = job.result()
+                yield parsed(parser.close())
+                result = build_output(strip_assistant(info.pop("text", parser.text)))
+                yield sse("done", {"result": result.model_dump(), **info,
+                                   "seconds": round(time.perf_counter() - t0, 3), "first_condition_s": first_condition})
+            except Exception as e:
+                dprint("STREAM_EXCEPTION", traceback.format_exc())
+                yield sse("error", {"detail": str(e)})
+            finally:
+                gone.set()   # client disconnected / stream over → the generation stops at its next token
+
+        return StreamingResponse(events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.get("/api/health")
+    async def health():
+        body = {"status": "ok", "queue_depth": scheduler.depth, **scheduler.stats.as_dict()}
+        if cache is not None:
+            body["cache"] = {**cache.as_dict(), "coalesced": coalesced}
+        return body
+
+    return app
+
+
+def load_model(model_id: str = MODEL_NAME):
+    """fp16 model on DEVICE + one warm-up generate, as in the notebook."""
+    torch.backends.cuda.matmul.allow_tf32 = False  # Ensuring determinism if needed
+    print("⏳ Loading model...")
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float16).to(DEVICE)
+    model.eval()
+    dummy = tokenizer("Warm-up", return_tensors="pt").to(DEVICE)
+    with torch.inference_mode():
+        model.generate(**dummy, max_new_tokens=1)
+    print("✅ Model loaded.")
+    return model, tokenizer
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DX API with micro-batched generation")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--stub", action="store_true", help="No model: StubGenerator (CPU load tests)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--batch", type=int, default=MAX_BATCH, help="Prompts per generate call")
+    parser.add_argument("--wait-ms", type=float, default=MAX_WAIT_MS, help="Batch collection window")
+    parser.add_argument("--queue", type=int, default=MAX_QUEUE, help="Waiting requests before 503")
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--no-cache", action="store_true", help="No result cache")
+    parser.add_argument("--cache-file", default=CACHE_FILE, help="JSONL journal to keep the cache across restarts")
+    parser.add_argument("--cache-size", type=int, default=CACHE_MAX_ENTRIES, help="Cached results (LRU)")
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL_S, help="Seconds a result stays valid (0 = forever)")
+    args = parser.parse_args()
+
+    import uvicorn
+
+    if args.stub:
+        generate_batch = StubGenerator()
+    else:
+        model, tokenizer = load_model(args.model)
+        generate_batch = HFBatchGenerator(model, tokenizer, args.max_new_tokens)
+    scheduler = MicroBatchScheduler(generate_batch, args.batch, args.wait_ms, args.queue)
+    cache = None
+    if RESULT_CACHE and not args.no_cache:
+        cache = DiagnosisCache(args.cache_size, args.cache_ttl, Path(args.cache_file) if args.cache_file else None)
+    uvicorn.run(create_app(scheduler, cache, "stub" if args.stub else args.model), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Deterministic fast-path judge for verification prompts (see generate.build_verification_prompt).
+
+Many assistant outputs are already a clean ranked list, e.g. the DRY_RUN / mock shape
+    {"BEST":"Example Dx","RANKED":[["Example Dx",0.62],["Alt Dx 1",0.23],...]}
+For those, TOP1/TOP3/TOP5 follow directly from the MATCHING rules the LLM judge is
+given, so they can be decided locally in microseconds; only the rest goes to Metis.
+
+— Normalisation (same rules as the judge prompt) —
+lowercase → drop parentheticals → punctuation to spaces → expand the listed synonyms
+(CVA↔stroke, MI/heart attack↔myocardial infarction, CHD↔coronary artery disease,
+PID, PCOS, UTI, DVT, eczema↔atopic dermatitis) → collapse whitespace.
+
+— When it decides (and when it defers) —
+* Only outputs that parse as JSON with a "BEST" string and/or a "RANKED" list.
+  Free text, narratives, malformed JSON → None (ask the LLM).
+* A diagnosis EQUAL to GT after normalisation, or naming the same concept of the
+  curated CONCEPTS vocabulary (GERD ↔ gastroesophageal reflux disease, varicella ↔
+  chickenpox…), is a match (YES).
+* NO only when GT and every candidate map to CONCEPTS and all candidates are other
+  concepts. Sharing no word proves nothing (high blood pressure vs hypertension).
+* Anything else (names outside the vocabulary, "acute pancreatitis" vs "chronic
+  pancreatitis", "MI" vs "STEMI"…) is a synonym or specificity call → None.
+* The verdict is returned only if TOP1, TOP3 AND TOP5 are all decided.
+
+Dedup: canonical_pair_key() gives the key under which identical (GT, output) pairs —
+e.g. the same best diagnosis from two methods or model variants — are judged once.
+
+Usage:
+    judge = FastJudge()
+    verdict = judge.judge_prompt(verification_text)   # dict or None
+    print(judge.summary())
+"""
+
+import re
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# =============================================================================
+#                               Normalisation
+# =============================================================================
+
+# abbreviation / lay term → canonical form (whole-word replacement, after lowercasing)
+SYNONYMS = {
+    "cva": "stroke",
+    "cerebrovascular accident": "stroke",
+    "mi": "myocardial infarction",
+    "heart attack": "myocardial infarction",
+    "chd": "coronary artery disease",
+    "coronary heart disease": "coronary artery disease",
+    "cad": "coronary artery disease",
+    "pid": "pelvic inflammatory disease",
+    "pcos": "polycystic ovary syndrome",
+    "polycystic ovarian syndrome": "polycystic ovary syndrome",
+    "uti": "urinary tract infection",
+    "dvt": "deep vein thrombosis",
+    "deep venous thrombosis": "deep vein thrombosis",
+    "eczema": "atopic dermatitis",
+}
+
+# Curated concept vocabulary: canonical name → other names of the SAME disease. Concepts are
+# pairwise distinct and none is a parent/child of another (no "pneumonia" next to
+# "community-acquired pneumonia", no "eczema" umbrella next to "contact dermatitis"), so two
+# names mapping to different concepts are a clear non-match. Names outside it are never NO.
+CONCEPTS = {
+    "stroke": ["cerebral infarction", "brain attack"],
+    "myocardial infarction": ["acute myocardial infarction", "ami"],
+    "coronary artery disease": ["ischemic heart disease", "ischaemic heart disease"],
+    "unstable angina": [],
+    "heart failure": ["chf", "congestive heart failure", "cardiac failure"],
+    "hypertension": ["high blood pressure", "htn", "arterial hypertension"],
+    "atrial fibrillation": ["af", "afib"],
+    "pericarditis": [],
+    "pulmonary embolism": ["pe"],
+    "deep vein thrombosis": [],
+    "transient ischemic attack": ["tia", "transient ischaemic attack", "mini stroke"],
+    "gastroesophageal reflux disease": ["gerd", "gord", "gastro oesophageal reflux disease",
+                                        "gastroesophageal reflux", "acid reflux"],
+    "irritable bowel syndrome": ["ibs"],
+    "celiac disease": ["coeliac disease"],
+    "crohn s disease": ["crohn disease"],
+    "ulcerative colitis": [],
+    "appendicitis": [],
+    "cholecystitis": [],
+    "ectopic pregnancy": [],
+    "ovarian torsion": [],
+    "endometriosis": [],
+    "pelvic inflammatory disease": [],
+    "polycystic ovary syndrome": [],
+    "urinary tract infection": [],
+    "nephrolithiasis": ["kidney stone", "kidney stones", "renal calculi", "renal calculus"],
+    "asthma": ["bronchial asthma"],
+    "chronic obstructive pulmonary disease": ["copd"],
+    "pneumonia": [],
+    "bronchiolitis": [],
+    "croup": ["laryngotracheobronchitis"],
+    "influenza": ["flu"],
+    "tuberculosis": ["tb"],
+    "infectious mononucleosis": ["mononucleosis", "glandular fever", "mono"],
+    "chickenpox": ["varicella", "chicken pox"],
+    "herpes zoster": ["shingles"],
+    "measles": ["rubeola"],
+    "rubella": ["german measles"],
+    "mumps": [],
+    "atopic dermatitis": ["atopic eczema"],
+    "psoriasis": [],
+    "lichen planus": [],
+    "tinea corporis": ["ringworm"],
+    "tinea pedis": ["athlete s foot", "athletes foot"],
+    "scabies": [],
+    "impetigo": [],
+    "migraine": [],
+    "tension headache": ["tension type headache"],
+    "cluster headache": [],
+    "gout": [],
+    "pseudogout": ["calcium pyrophosphate deposition disease", "cppd"],
+    "septic arthritis": [],
+    "rheumatoid arthritis": ["ra"],
+    "osteoarthritis": ["oa", "degenerative joint disease"],
+    "cellulitis": [],
+    "hypothyroidism": [],
+    "allergic rhinitis": ["hay fever"],
+    "otitis media": [],
+    "conjunctivitis": ["pink eye"],
+    "lyme disease": [],
+}
+
+PARENS = re.compile(r"\([^)]*\)|\[[^\]]*\]")
+NON_WORD = re.compile(r"[^\w\s]+")
+SPACES = re.compile(r"\s+")
+SYNONYM_RE = re.compile(r"\b(" + "|".join(sorted(map(re.escape, SYNONYMS), key=len, reverse=True)) + r")\b")
+FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+
+
+def normalize_dx(text: str) -> str:
+    s = PARENS.sub(" ", str(text).lower())
+    s = NON_WORD.sub(" ", s).replace("_", " ")
+    s = SPACES.sub(" ", s).strip()
+    return SYNONYM_RE.sub(lambda m: SYNONYMS[m.group(1)], s)
+
+# normalised name → canonical concept (built through normalize_dx, so "Athlete's foot" → "athlete s foot")
+_CONCEPT_OF = {normalize_dx(name): canonical for canonical, names in CONCEPTS.items()
+               for name in [canonical] + names}
+
+def concept(norm: str) -> Optional[str]:
+    """Canonical concept of a NORMALISED diagnosis, or None if it is not in CONCEPTS."""
+    return _CONCEPT_OF.get(norm)
+
+
+# =============================================================================
+#                              Output parsing
+# =============================================================================
+
+VERIF_GT = re.compile(r"^GROUND-TRUTH DIAGNOSIS:[ \t]*(.*)$", re.MULTILINE)
+VERIF_OUTPUT = re.compile(r"^Assistant_output:\n<<<\n(.*?)\n>>>$", re.MULTILINE | re.DOTALL)
+
+
+def split_verification_prompt(text: str) -> Optional[Tuple[str, str]]:
+    """(gt, assistant_output) from a build_verification_prompt() text, or None."""
+    g = VERIF_GT.search(text)
+    o = VERIF_OUTPUT.search(text)
+    if not g or not o:
+        return None
+    return g.group(1).strip(), o.group(1)
+
+# markdown decoration only — '_', '*', '#', '>' inside the content (a_b, >6.5%, C#) are kept
+MD_FENCE_LINE = re.compile(r"^[ \t]*```[\w+-]*[ \t]*$", re.MULTILINE)              # ``` / ```json lines
+MD_LINE_MARK = re.compile(r"^[ \t]*(?:>[ \t]+)*(?:#{1,6}[ \t]+)?", re.MULTILINE)    # "> " quotes, "## " headings
+MD_EMPHASIS = re.compile(r"(?<!\w)(\*\*|__)(?=\S)(.+?)(?<=\S)\1(?!\w)")          # **bold** / __bold__
+
+def _strip_markdown(text: str) -> str:
+    text = MD_FENCE_LINE.sub("", text)
+    text = MD_LINE_MARK.sub("", text)
+    return MD_EMPHASIS.sub(r"\2", text)
+
+def canonical_pair_key(text: str) -> str:
+    """
+    Dedup key of a verification prompt: (GT, assistant output) with whitespace and
+    markdown decoration (fence lines, leading "#"/">" markers, paired **/__ emphasis)
+    removed, so prompts that differ only in formatting (or in their ID line) are
+    judged once; any other character is content and stays in the key. Texts that are not verification prompts are
+    keyed by their whitespace-normalised content.
+    """
+    parts = split_verification_prompt(text)
+    if parts is None:
+        return "raw\x00" + SPACES.sub(" ", text).strip()
+    gt, output = parts
+    return SPACES.sub(" ", gt).strip() + "\x00" + SPACES.sub(" ", _strip_markdown(output)).strip()
+
+def parse_ranked_output(output: str) -> Optional[Tuple[Optional[str], List[str]]]:
+    """
+    Clean JSON output → (BEST or None, ranked names best-first). None if the output is
+    not clean JSON of that shape (the LLM judge handles it then).
+    """
+    s = FENCE.sub("", output.strip()).strip()
+    if not (s.startswith("{") and s.endswith("}")):
+        return None
+    try:
+        obj = json.loads(s)
+    except ValueError:
+        return None
+    if not isinstance(obj, dict):
+        return None
+
+    best = obj.get("BEST")
+    if best is not None and not (isinstance(best, str) and best.strip()):
+        return None
+
+    ranked_raw = obj.get("RANKED")
+    items: List[Tuple[str, Optional[float]]] = []
+    if ranked_raw is not None:
+        if not isinstance(ranked_raw, list):
+            return None
+        for it in ranked_raw:
+            if isinstance(it, str):
+                items.append((it, None))
+            elif (isinstance(it, (list, tuple)) and it and isinstance(it[0], str)
+                  and (len(it) == 1 or isinstance(it[1], (int, float)))):
+                items.append((it[0], float(it[1]) if len(it) > 1 else None))
+            else:
+                return None
+    if best is None and not items:
+        return None
+
+    # highest probability first; ties keep their original order (stable sort)
+    if items and all(p is not None for _, p in items):
+        items.sort(key=lambda t: -t[1])
+    return best, [name for name, _ in items]
+
+
+# =============================================================================
+#                                  Judge
+# =============================================================================
+
+def judge(gt: str, output: str) -> Optional[Dict[str, str]]:
+    """
+    {"TOP1","TOP3","TOP5","BEST"} in the LLM judge's output format, or None when any
+    of the three is not clear-cut.
+    """
+    if not gt or gt.startswith("<UNKNOWN"):
+        return None
+    parsed = parse_ranked_output(output)
+    if parsed is None:
+        return None
+    best, ranked = parsed
+    n_gt = normalize_dx(gt)
+    if not n_gt:
+        return None
+    if best is None:
+        best = ranked[0]
+    if not ranked:
+        ranked = [best]
+
+    gt_concept = concept(n_gt)
+
+    def decide(cands: List[str]) -> Optional[str]:
+        norms = [normalize_dx(c) for c in cands]
+        if any(n == n_gt or (gt_concept is not None and concept(n) == gt_concept) for n in norms):
+            return "YES"
+        if gt_concept is not None and all(concept(n) is not None for n in norms):
+            return "NO"   # every candidate is a known, different disease
+        return None       # unknown names may still be synonyms / specificity calls → LLM
+
+    top1 = decide([best])
+    top3 = decide(ranked[:3])
+    top5 = decide(ranked[:5])
+    if top1 is None or top3 is None or top5 is None:
+        return None
+    if top1 == "YES" and top3 == "NO":
+        return None   # BEST disagrees with the ranking → let the LLM weigh it
+    return {"TOP1": top1, "TOP3": top3, "TOP5": top5, "BEST": best}
+
+
+class FastJudge:
+    """Thread-safe wrapper around judge() that counts decided vs deferred prompts."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.decided = 0
+        self.deferred = 0
+
+    def judge_prompt(self, text: str) -> Optional[Dict[str, str]]:
+        parts = split_verification_prompt(text)
+        verdict = judge(*parts) if parts is not None else None
+        with self._lock:
+            if verdict is None:
+                self.deferred += 1
+            else:
+                self.decided += 1
+        return verdict
+
+    def summary(self) -> str:
+        with self._lock:
+            n = self.decided + self.deferred
+            pct = 100.0 * self.decided / n if n else 0.0
+            return (f"fast judge: {self.decided}/{n} decided locally ({pct:.1f}%, API calls saved), "
+                    f"{self.deferred} sent to the LLM judge")
+
+
+def agreement(pairs) -> Dict[str, Any]:
+    """
+    Compare fast verdicts with LLM verdicts on a labelled sample.
+    pairs: iterable of (verification_text, llm_verdict_dict). Returns counts per field.
+    """
+    out = {"total": 0, "decided": 0, "TOP1": [0, 0], "TOP3": [0, 0], "TOP5": [0, 0], "disagreements": []}
+    for text, llm in pairs:
+        out["total"] += 1
+        parts = split_verification_prompt(text)
+        fast = judge(*parts) if parts is not None else None
+        if fast is None or not isinstance(llm, dict):
+            continue
+        out["decided"] += 1
+        for field in ("TOP1", "TOP3", "TOP5"):
+            same = fast[field] == str(llm.get(field) or "").strip().upper()
+            out[field][0] += same
+            out[field][1] += 1
+            if not same and len(out["disagreements"]) < 20:
+                out["disagreements"].append((field, parts[0], fast["BEST"], fast[field], llm.get(field)))
+    return out
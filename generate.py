@@ -11,16 +11,59 @@ while REDACTING DxBench ID and GT from the content sent to the API.
        Then:   Patient Symptoms / Clinical Notes / ...
 2) For API: removes the ID line and the first non-empty header line after it (GT).
 3) Calls Metis (unless DRY_RUN=True) and stores raw assistant outputs in <OUTPUT_ROOT>/results/<METHOD>.jsonl
-4) Builds a Verification Prompt per case at:
-       <OUTPUT_ROOT>/results/verification/<METHOD>/<dxbench_id>.txt
-   and also appends all cases to:
+4) Builds a Verification Prompt per case and appends it to the packed archive
+       <OUTPUT_ROOT>/results/verification/<METHOD>.vpack   (+ .vpack.idx, see verification_archive.py)
+   which test-api-final.py reads directly (by id or streamed through mmap). With
+   VERIFICATION_PACK = False the old separator-delimited bundle is written instead:
        <OUTPUT_ROOT>/results/verification/<METHOD>.all.txt
+   Per-case files <OUTPUT_ROOT>/results/verification/<METHOD>/<dxbench_id>.txt are
+   written only with WRITE_CASE_FILES; otherwise export them on demand:
+       python verification_archive.py export <METHOD>.vpack <METHOD>/
+   Outputs are buffered and committed in groups (COMMIT_EVERY / COMMIT_INTERVAL /
+   DURABILITY, see result_writer.py).
 
 Test offline (no API calls):
     DRY_RUN = True
 Run online:
     DRY_RUN = False and set METIS_API_KEY / METIS_BOT_ID constants below.
 
+Concurrency:
+    CONCURRENCY cases are in flight at once (bounded thread pool). Workers only
+    talk to the API; every file write happens on the main thread as results come
+    back, so each case lands in <METHOD>.jsonl and the verification files exactly
+    once, and resume (skip ids already in <METHOD>.jsonl) works as before.
+    CONCURRENCY = 1 reproduces the old one-case-at-a-time behaviour.
+    All workers share one pooled keep-alive client (metis_client.py); with
+    SESSION_POOL > 0 chat sessions are created ahead of time in the background.
+    Calls are paced by an adaptive (AIMD) rate limiter starting at RATE_START req/s
+    that honours Retry-After on 429s (rate_limit.py).
+
+Response cache:
+    Replies are cached on disk under CACHE_DIR (outside OUTPUT_ROOT), keyed by
+    sha256(bot id, redacted prompt, endpoint) — see response_cache.py. Re-running into
+    a new output root, or after deleting a broken <METHOD>.jsonl, costs no API calls
+    for prompts already answered. --no-cache forces fresh calls.
+
+Result store:
+    Every result / failure is also written to an indexed SQLite store (STORE_PATH,
+    default <OUTPUT_ROOT>/results/results.sqlite; see result_store.py) keyed by
+    (model, method, DxBench number), which test-api-final.py and pipeline.py fill
+    with the verdicts and dep-analyze.py --store reads.
+
+Instrumentation:
+    Every API call (header wait vs body read, retries, size) and every case is logged
+    to <OUTPUT_ROOT>/results/calls.metrics.jsonl; p50/p95/p99 and cases/min are printed
+    at the end. --progress adds a live status line (metrics.py).
+
+Several methods in one pass (cases interleaved through one shared pool):
+    python generate.py --job zero_shot_direct=prompts_zero_shot_direct.txt \\
+                       --job single_step_cot=prompts_single_step_cot.txt \\
+                       --job least_to_most=prompts_least_to_most.txt
+
+Local stand-in server (simulated latency, no quota used):
+    python mock_metis_server.py --port 8765 --latency 1 3
+    python generate.py --api-base http://127.0.0.1:8765 --api-key x --bot-id x --workers 16
+
 Author: you :)
 """
 
@@ -28,11 +71,23 @@ import os
 import re
 import json
 import time
+import sqlite3
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 
-import requests
+from metis_client import MetisClient, shared_client, close_clients
+from rate_limit import AdaptiveRateLimiter
+from response_cache import ResponseCache
+from metrics import Metrics
+from checkpoint import Checkpoint
+from result_writer import ResultWriter
+from verification_archive import SUFFIX as ARCHIVE_SUFFIX
+from result_store import ResultStore
+from judgments import run_model
+from structured_output import assistant_text
+from prompt_blocks import iter_blocks, parse_case, CaseHeader, ID_LINE, STOP_RE
 
 
 # =============================================================================
@@ -54,7 +109,28 @@ DRY_RUN            = False   # True → بدون تماس با API (فقط سا
 CONNECT_TIMEOUT    = 10
 READ_TIMEOUT       = 120
 MAX_RETRIES        = 5
-SLEEP_BETWEEN_MSGS = 0.2
+RATE_START         = 2.0     # req/s اولیه؛ نرخ به‌صورت تطبیقی (AIMD) بالا/پایین می‌رود
+RATE_MAX           = 20.0    # سقف نرخ (req/s) — جایگزین SLEEP_BETWEEN_MSGS ثابت
+CONCURRENCY        = 4       # تعداد کیس‌های هم‌زمان (1 → ترتیبی مثل قبل)
+SESSION_POOL       = 0       # >0 → این تعداد سشن از قبل (در پس‌زمینه) ساخته می‌شود
+
+# --- Response cache (see response_cache.py) ---
+CACHE_DIR          = "~/.cache/dx-metis"   # "" → بدون کش؛ بیرون از OUTPUT_ROOT تا بین اجراها بماند
+CACHE_MAX_MB       = 512                   # سقف حجم کش؛ قدیمی‌ترین (LRU) حذف می‌شود
+
+# --- Output writing (group commit, see result_writer.py) ---
+VERIFICATION_PACK  = True    # True → <METHOD>.vpack (آرشیو فشرده + ایندکس)؛ False → <METHOD>.all.txt مثل قبل
+WRITE_CASE_FILES   = False   # True → هزاران فایل کوچک <id>.txt هم نوشته می‌شود (وگرنه export از آرشیو)
+COMMIT_EVERY       = 32      # تعداد کیس در هر commit گروهی
+COMMIT_INTERVAL    = 2.0     # حداکثر ثانیه‌ای که یک کیس در حافظه می‌ماند
+DURABILITY         = "flush" # "flush" | "fsync"
+
+# --- Indexed result store (see result_store.py) ---
+STORE_PATH         = "results.sqlite"   # نسبی → زیر <OUTPUT_ROOT>/results؛ مطلق → یک فایل مشترک برای چند مدل؛ "" → خاموش
+STORE_MODEL        = ""                 # برچسب مدل در store؛ "" → نام پوشهٔ OUTPUT_ROOT (judgments.run_model)
+
+# --- Instrumentation (see metrics.py) ---
+PROGRESS           = False   # True → خط وضعیت زنده (cases/min، p50/p95، retry) روی stderr
 
 # --- Input block separator (exactly 22 '=' signs on a line) ---
 SEP = "=" * 22
@@ -65,7 +141,7 @@ SEP = "=" * 22
 # =============================================================================
 
 def split_blocks(text: str) -> List[str]:
-    """Split by a line that is exactly 22 '=' characters."""
+    """Split by a line that is exactly 22 '=' characters (in-memory; process_file streams via iter_blocks)."""
     return [b for b in re.split(rf"(?m)^{re.escape(SEP)}\s*$", text) if b.strip()]
 
 def safe_mkdir(p: Path):
@@ -76,38 +152,14 @@ def append_jsonl(path: Path, obj: Dict[str, Any]):
         f.write(json.dumps(obj, ensure_ascii=False) + "\n")
         f.flush()
 
-def load_done_ids(jsonl_path: Path) -> set:
-    done = set()
-    if jsonl_path.exists():
-        with jsonl_path.open("r", encoding="utf-8") as f:
-            for line in f:
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    o = json.loads(line)
-                    if "id" in o:
-                        done.add(str(o["id"]))
-                except Exception:
-                    pass
-    return done
-
-
 # =============================================================================
 #                        Parse ID / GT, and REDACT for API
 # =============================================================================
 
-ID_LINE = re.compile(r"^\s*(dxbench|DxBench)[_\- ]?(\d+)\s*$", re.IGNORECASE)
-
-STOP_HEADERS = [
-    r"^\s*Patient\s+Symptoms\s*:?",
-    r"^\s*Explicit\s+Symptoms\s*:?",
-    r"^\s*Implicit\s+Symptoms\s*:?",
-    r"^\s*Symptoms\s*:?",
-    r"^\s*Clinical\s+Notes\s*:?",
-    r"^\s*Case\s*:?",
-]
-STOP_RE = re.compile("|".join(STOP_HEADERS), re.IGNORECASE)
+# ID_LINE / STOP_HEADERS / STOP_RE live in prompt_blocks.py (shared with parse_case).
+# extract_id / extract_gt / redact_id_and_gt_for_api below are the reference
+# implementations; process_file uses the single-pass prompt_blocks.parse_case,
+# which bench.py checks to be byte-identical to them.
 
 def extract_id(block: str) -> Optional[str]:
     for ln in block.splitlines():
@@ -254,139 +306,315 @@ def build_verification_prompt(idx: str, gt: str, assistant_output: str) -> str:
 #                                Metis API
 # =============================================================================
 
-def make_session(api_key: str, bot_id: str) -> str:
-    r = requests.post(
-        f"{API_BASE}/api/v1/chat/session",
-        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-        json={"botId": bot_id, "user": None, "initialMessages": None},
-        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
+_CACHE: Optional[ResponseCache] = None
+_METRICS: Optional[Metrics] = None   # set per run by process_files()
+
+def _response_cache() -> Optional[ResponseCache]:
+    global _CACHE
+    if _CACHE is None and CACHE_DIR:
+        _CACHE = ResponseCache(Path(CACHE_DIR).expanduser(), max_bytes=CACHE_MAX_MB << 20)
+    return _CACHE
+
+_LIMITER: Optional[AdaptiveRateLimiter] = None
+
+def _rate_limiter() -> AdaptiveRateLimiter:
+    # one AIMD state per run: every call (and every retry) backs off the same limiter
+    global _LIMITER
+    if _LIMITER is None:
+        _LIMITER = AdaptiveRateLimiter(RATE_START, max_rate=RATE_MAX)
+    return _LIMITER
+
+_STORE: Optional[ResultStore] = None
+
+def _result_store(out_root: Path) -> Optional[ResultStore]:
+    global _STORE
+    if _STORE is None and STORE_PATH:
+        _STORE = ResultStore(out_root / "results" / Path(STORE_PATH).expanduser())   # absolute STORE_PATH wins
+    return _STORE
+
+def close_result_store():
+    global _STORE
+    if _STORE is not None:
+        print(f"🗃  {_STORE.summary()}")
+        _STORE.close()
+        _STORE = None
+
+def store_model(out_root: Path) -> str:
+    return STORE_MODEL or run_model(out_root / "results" / "_.jsonl")
+
+def _client(api_key: str, bot_id: str) -> MetisClient:
+    # Shared across worker threads → one keep-alive connection pool per run.
+    return shared_client(
+        api_key, bot_id, base_url=API_BASE,
+        connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+        max_retries=MAX_RETRIES, session_pool=SESSION_POOL,
+        limiter=_rate_limiter(),
+        cache=_response_cache(),
     )
-    r.raise_for_status()
-    return r.json()["id"]
+
+def make_session(api_key: str, bot_id: str) -> str:
+    return _client(api_key, bot_id).make_session()
 
 def send_message(api_key: str, session_id: str, content: str) -> Dict[str, Any]:
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            r = requests.post(
-                f"{API_BASE}/api/v1/chat/session/{session_id}/message",
-                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-                json={"message": {"content": content, "type": "USER"}},
-                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
-            )
-            if r.status_code == 429 or 500 <= r.status_code < 600:
-                if attempt < MAX_RETRIES:
-                    time.sleep(0.5 * (2 ** attempt))
-                    continue
-            r.raise_for_status()
-            return r.json()
-        except requests.RequestException:
-            if attempt < MAX_RETRIES:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            raise
+    return _client(api_key, METIS_BOT_ID).send_message(session_id, content)
 
 def extract_assistant_text(api_response: Dict[str, Any]) -> str:
-    """
-    Try common shapes:
-      - {"messages":[{"role":"ASSISTANT","content": "..."} , ...], ...}
-      - {"content":"..."} or {"answer":{"content":"..."}}
-    Fallback to str(api_response)
-    """
-    msgs = api_response.get("messages") or api_response.get("data") or None
-    if isinstance(msgs, list):
-        for msg in reversed(msgs):
-            role = str(msg.get("role", "")).upper()
-            if role in ("ASSISTANT", "AI"):
-                c = msg.get("content")
-                if isinstance(c, str) and c.strip():
-                    return c.strip()
-                if isinstance(c, dict) and isinstance(c.get("content"), str):
-                    return c["content"].strip()
-    ans = api_response.get("answer")
-    if isinstance(ans, dict) and isinstance(ans.get("content"), str):
-        return ans["content"].strip()
-    if isinstance(api_response.get("content"), str):
-        return api_response["content"].strip()
-    return json.dumps(api_response, ensure_ascii=False)
+    """Assistant reply text from a Metis response (shapes handled in structured_output.assistant_text)."""
+    return assistant_text(api_response)
 
 
 # =============================================================================
 #                                 Main
 # =============================================================================
 
-def process_file(method: str, prompt_path: Path, out_root: Path):
-    # Prepare outputs
-    out_dir = out_root / "results"
-    verif_dir = out_dir / "verification" / method
-    ok_jsonl   = out_dir / f"{method}.jsonl"
-    fail_jsonl = out_dir / f"{method}.failures.jsonl"
-    bundle_path = out_dir / "verification" / f"{method}.all.txt"
-
-    safe_mkdir(out_dir)
-    safe_mkdir(verif_dir)
-    safe_mkdir(bundle_path.parent)
-
-    done_ids = load_done_ids(ok_jsonl)
-
-    text = prompt_path.read_text(encoding="utf-8")
-    blocks = split_blocks(text)
-    print(f"▶ {method}: {len(blocks)} prompts")
-
-    for idx, block in enumerate(blocks):
-        cid = extract_id(block) or f"{method}_{idx:04d}"
-        if cid in done_ids:
-            continue
+def run_case(cid: str, case: CaseHeader) -> Dict[str, Any]:
+    """
+    Worker side of one case: call the API (or mock) with the redacted body.
+    Does NOT touch the output files; returns a result dict for the main thread:
+        {"id", "gt", "output", "elapsed", "cached"}  on success
+        {"id", "error", "elapsed"}                   on API failure
+    """
+    t0 = time.perf_counter()
+    cached = False
+    gt = case.gt.strip() or "<UNKNOWN_GT>"
+
+    # --- Content for API (REDACTED: no ID, no GT) ---
+    content_for_api = case.body
+
+    # --- Call API or Mock ---
+    if DRY_RUN:
+        assistant_text = (
+            '{"BEST":"Example Dx",'
+            '"RANKED":[["Example Dx",0.62],["Alt Dx 1",0.23],["Alt Dx 2",0.15],["Alt Dx 3",0.07],["Alt Dx 4",0.03]]}'
+        )
+    else:
+        try:
+            # cache hit, or fresh session per case (pre-created when SESSION_POOL > 0) + message
+            client = _client(METIS_API_KEY, METIS_BOT_ID)
+            api_resp = client.cached(content_for_api)
+            cached = api_resp is not None
+            if not cached:
+                api_resp = client.send_message(client.acquire_session(), content_for_api)
+            assistant_text = extract_assistant_text(api_resp)
+        except Exception as e:
+            return {"id": cid, "error": repr(e), "elapsed": time.perf_counter() - t0}
+
+    return {"id": cid, "gt": gt, "output": assistant_text,
+            "elapsed": time.perf_counter() - t0, "cached": cached}
+
+class MethodJob:
+    """
+    Output side of one (method, prompt file) pair: its resume checkpoint, its group-commit
+    writer and the round-robin cursor over its prompt blocks. Only the main thread touches it.
+    """
 
-        gt = extract_gt(block).strip() or "<UNKNOWN_GT>"
-
-        # --- Content for API (REDACTED: no ID, no GT) ---
-        content_for_api = redact_id_and_gt_for_api(block)
-
-        # --- Call API or Mock ---
-        if DRY_RUN:
-            assistant_text = (
-                '{"BEST":"Example Dx",'
-                '"RANKED":[["Example Dx",0.62],["Alt Dx 1",0.23],["Alt Dx 2",0.15],["Alt Dx 3",0.07],["Alt Dx 4",0.03]]}'
-            )
-        else:
-            if not METIS_API_KEY or not METIS_BOT_ID:
-                raise RuntimeError("Missing METIS_API_KEY or METIS_BOT_ID constants.")
-            try:
-                session_id = make_session(METIS_API_KEY, METIS_BOT_ID)
-                api_resp = send_message(METIS_API_KEY, session_id, content_for_api)
-                assistant_text = extract_assistant_text(api_resp)
-            except Exception as e:
-                append_jsonl(fail_jsonl, {"id": cid, "error": repr(e)})
+    def __init__(self, method: str, prompt_path: Path, out_root: Path):
+        self.method = method
+        self.prompt_path = prompt_path
+        out_dir = out_root / "results"
+        verif_dir = out_dir / "verification" / method
+        ok_jsonl   = out_dir / f"{method}.jsonl"
+        fail_jsonl = out_dir / f"{method}.failures.jsonl"
+        bundle_path = out_dir / "verification" / f"{method}.all.txt"
+        archive_path = out_dir / "verification" / f"{method}{ARCHIVE_SUFFIX}"
+
+        safe_mkdir(out_dir)
+        if WRITE_CASE_FILES:
+            safe_mkdir(verif_dir)
+        safe_mkdir(bundle_path.parent)
+
+        # Resume: done ids come from the <method>.jsonl.ckpt sidecar, not a full JSONL scan.
+        self.ckpt = Checkpoint(ok_jsonl, key_field="id")
+        self.done_ids = set(self.ckpt.load())
+        self.store = _result_store(out_root)
+        self.model = store_model(out_root)
+        self.writer = ResultWriter(
+            self.ckpt, None if VERIFICATION_PACK else bundle_path, fail_jsonl,
+            case_dir=verif_dir if WRITE_CASE_FILES else None,
+            commit_every=COMMIT_EVERY, commit_interval=COMMIT_INTERVAL, durability=DURABILITY,
+            store=self._store_rows if self.store is not None else None,
+            archive_path=archive_path if VERIFICATION_PACK else None,
+        )
+        # Streamed: blocks are read one at a time, work starts on the first case.
+        self.blocks = enumerate(iter_blocks(prompt_path, separators=(SEP,)))
+        self.total = 0
+
+    def _store_rows(self, records: List[Dict[str, Any]]):
+        # The JSONL + checkpoint stay authoritative for resume; a store error must not stop the run.
+        try:
+            self.store.add(self.model, self.method, "generate", records, key_field="id")
+        except sqlite3.Error as e:
+            print(f"⚠️ result store write failed ({e}); JSONL outputs are unaffected")
+
+    def next_case(self):
+        """Next (cid, CaseHeader) still to run, or None when the prompt file is exhausted."""
+        for idx, block in self.blocks:
+            self.total += 1
+            case = parse_case(block)
+            cid = case.id or f"{self.method}_{idx:04d}"
+            if cid in self.done_ids:
                 continue
-            time.sleep(SLEEP_BETWEEN_MSGS)
-
-        # --- Save raw assistant output for traceability ---
-        append_jsonl(ok_jsonl, {"id": cid, "output": assistant_text})
+            self.done_ids.add(cid)  # duplicate ids in the input are sent once
+            return cid, case
+        return None
+
+    def write_result(self, res: Dict[str, Any]):
+        # Buffered: ResultWriter commits JSONL + checkpoint + verification files in groups.
+        cid = res["id"]
+        if _METRICS is not None:
+            _METRICS.case(self.method, cid, ok="error" not in res, total_s=res["elapsed"],
+                          cached=res.get("cached", False))
+        if "error" in res:
+            self.writer.add_failure({"id": cid, "error": res["error"], "elapsed_s": round(res["elapsed"], 3)})
+            return
+
+        # --- Raw assistant output (traceability) + Verification Prompt (with ID & GT at top) ---
+        verif_text = build_verification_prompt(idx=cid, gt=res["gt"], assistant_output=res["output"])
+        self.writer.add({"id": cid, "output": res["output"]}, verif_text,
+                        stored={"id": cid, "gt": res["gt"], "output": res["output"]})
+
+    def close(self):
+        self.writer.close()   # commits whatever is still buffered
+        self.ckpt.close()
+
+def interleave_cases(jobs: List[MethodJob]):
+    """Round-robin over the jobs' prompt files: yields (job, cid, case) until all are exhausted."""
+    active = list(jobs)
+    while active:
+        for job in list(active):
+            nxt = job.next_case()
+            if nxt is None:
+                active.remove(job)
+                continue
+            yield (job,) + nxt
 
-        # --- Build Verification Prompt file (with ID & GT at top) ---
-        verif_text = build_verification_prompt(idx=cid, gt=gt, assistant_output=assistant_text)
-        (verif_dir / f"{cid}.txt").write_text(verif_text, encoding="utf-8")
-        with bundle_path.open("a", encoding="utf-8") as bf:
-            bf.write(verif_text + "\n" + ("-" * 80) + "\n\n")
+def process_files(jobs: List[tuple], out_root: Path, workers: int = CONCURRENCY):
+    """
+    Fan-out: run several (method, prompt_path) jobs in ONE pass. Their cases are
+    interleaved round-robin through one shared worker pool, API client, rate limiter
+    and response cache, so wall-clock time is bounded by API throughput rather than
+    methods × cases. Each method keeps its own outputs and resume checkpoint.
+    """
+    global _METRICS
+    if not DRY_RUN and (not METIS_API_KEY or not METIS_BOT_ID):
+        raise RuntimeError("Missing METIS_API_KEY or METIS_BOT_ID constants.")
+
+    # Per-call / per-case records → <OUTPUT_ROOT>/results/calls.metrics.jsonl (see metrics.py)
+    safe_mkdir(out_root / "results")
+    _METRICS = Metrics(out_root / "results" / "calls.metrics.jsonl", progress=PROGRESS)
+    if not DRY_RUN:
+        _client(METIS_API_KEY, METIS_BOT_ID).metrics = _METRICS
+
+    method_jobs: List[MethodJob] = []
+    try:
+        for method, prompt_path in jobs:
+            method_jobs.append(MethodJob(method, prompt_path, out_root))
+        _run_jobs(method_jobs, workers)
+    finally:
+        for job in method_jobs:
+            job.close()
+        _METRICS.close()
+        close_result_store()
+    if not DRY_RUN:
+        print(f"⏱  {_client(METIS_API_KEY, METIS_BOT_ID).limiter.summary()}")
+        if _response_cache() is not None:
+            print(f"🗄  {_response_cache().summary()}")
+    print(f"📈 {_METRICS.summary()}")
+    close_clients()
+    for job in method_jobs:
+        print(f"✔ {job.method}: {job.total} prompts")
+
+def _run_jobs(jobs: List[MethodJob], workers: int):
+    workers = max(1, workers)
+    for job in jobs:
+        print(f"▶ {job.method}: streaming prompts from {job.prompt_path.name} ({workers} workers)")
+
+    # Bounded window: at most 2×workers cases queued/in flight at any time (all methods together).
+    window = 2 * workers
+    pending = {}   # future → job
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gen")
+
+    def drain(finished):
+        for fut in finished:
+            pending.pop(fut).write_result(fut.result())
+
+    try:
+        for job, cid, case in interleave_cases(jobs):
+            if len(pending) >= window:
+                drain(wait(pending, return_when=FIRST_COMPLETED).done)
+            pending[pool.submit(run_case, cid, case)] = job
+
+        drain(wait(pending).done)
+    except KeyboardInterrupt:
+        print("\n🛑 Interrupted by user. Finished cases are committed before exit.")
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown(wait=True)
+
+def process_file(method: str, prompt_path: Path, out_root: Path, workers: int = CONCURRENCY):
+    """Single method (the original mode) = a fan-out with one job."""
+    process_files([(method, prompt_path)], out_root, workers)
+
+def parse_job(spec: str) -> tuple:
+    """'--job METHOD=PATH' → (method, resolved Path)."""
+    method, sep, path = spec.partition("=")
+    if not sep or not method.strip() or not path.strip():
+        raise argparse.ArgumentTypeError(f"expected METHOD=PATH, got {spec!r}")
+    return method.strip(), Path(path.strip()).expanduser().resolve()
 
 def main():
+    global DRY_RUN, API_BASE, METIS_API_KEY, METIS_BOT_ID, SESSION_POOL, DURABILITY, WRITE_CASE_FILES, CACHE_DIR
+    global PROGRESS, STORE_PATH, STORE_MODEL, VERIFICATION_PACK
+
     # Optional CLI overrides (kept minimal since you asked for constants at top)
     parser = argparse.ArgumentParser()
     parser.add_argument("--input",  default=INPUT_FILE,  help="Path to prompts file")
     parser.add_argument("--out",    default=OUTPUT_ROOT, help="Output root dir")
     parser.add_argument("--method", default=METHOD,      help="Method name")
+    parser.add_argument("--job", action="append", type=parse_job, metavar="METHOD=PATH",
+                        help="Repeatable; run several methods in one interleaved pass (overrides --input/--method)")
     parser.add_argument("--dry",    action="store_true", help="Force dry-run (overrides DRY_RUN=True)")
+    parser.add_argument("--workers", type=int, default=CONCURRENCY, help="Concurrent cases in flight")
+    parser.add_argument("--api-base", default=API_BASE, help="Metis base URL (e.g. a local mock server)")
+    parser.add_argument("--api-key",  default=METIS_API_KEY, help="Overrides METIS_API_KEY")
+    parser.add_argument("--bot-id",   default=METIS_BOT_ID,  help="Overrides METIS_BOT_ID")
+    parser.add_argument("--session-pool", type=int, default=SESSION_POOL,
+                        help="Pre-create this many chat sessions in the background (0 = off)")
+    parser.add_argument("--durability", choices=("flush", "fsync"), default=DURABILITY,
+                        help="Group-commit durability of the output files")
+    parser.add_argument("--case-files", action="store_true",
+                        help="Also write verification/<method>/<id>.txt (default: export from the archive on demand)")
+    parser.add_argument("--no-case-files", action="store_true",
+                        help="Skip verification/<method>/<id>.txt (overrides WRITE_CASE_FILES=True)")
+    parser.add_argument("--text-bundle", action="store_true",
+                        help="Write the legacy verification/<method>.all.txt instead of <method>.vpack")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="On-disk response cache directory")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API (no response cache)")
+    parser.add_argument("--progress", action="store_true", help="Live progress line on stderr")
+    parser.add_argument("--store", default=STORE_PATH,
+                        help="Result store file (relative → under <out>/results; '' = off)")
+    parser.add_argument("--model", default=STORE_MODEL, help="Model label in the result store (default: out dir name)")
     args = parser.parse_args()
 
-    global DRY_RUN
     if args.dry:
         DRY_RUN = True
-
-    process_file(
-        method=args.method,
-        prompt_path=Path(args.input).expanduser().resolve(),
-        out_root=Path(args.out).expanduser().resolve()
-    )
+    API_BASE = args.api_base.rstrip("/")
+    METIS_API_KEY = args.api_key
+    METIS_BOT_ID = args.bot_id
+    SESSION_POOL = args.session_pool
+    DURABILITY = args.durability
+    if args.case_files:
+        WRITE_CASE_FILES = True
+    if args.no_case_files:
+        WRITE_CASE_FILES = False
+    if args.text_bundle:
+        VERIFICATION_PACK = False
+    CACHE_DIR = "" if args.no_cache else args.cache_dir
+    PROGRESS = PROGRESS or args.progress
+    STORE_PATH, STORE_MODEL = args.store, args.model
+
+    jobs = args.job or [(args.method, Path(args.input).expanduser().resolve())]
+    process_files(jobs, out_root=Path(args.out).expanduser().resolve(), workers=args.workers)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar (NumPy) form of judgement results, for recomputing metrics over many runs.
+
+Each JSONL file is parsed once into small integer arrays, one entry per record:
+    case_no  int32   trailing number of dataset_id (-1 if none)
+    dept     int16   index into judgments.DEPARTMENTS, DEPT_UNMATCHED if outside the table
+    top1     int8    YES / NO / UNSCORABLE / invalid   (TOP1_CODES)
+    top3     int8    YES / NO / invalid                (TOP35_CODES)
+    top5     int8    YES / NO / invalid
+    run      int16   index of the file in the list it was loaded from
+
+— How it works —
+* The department of every case comes from one np.searchsorted over the sorted range
+  starts (plus a check against the range ends) instead of a scan of DEPARTMENTS per record.
+* Every table (overall, per department, per run, per run × department) is one
+  np.bincount over (group * n_codes + code); the counting rules are exactly those of
+  judgments.count_judgment, so the rows are identical to RunningTally's.
+* Parsing is the only per-record Python work; files are parsed in parallel processes
+  and the arrays are concatenated, so re-tabulating dozens of runs is milliseconds.
+
+Usage:
+    cols = load_many(paths, jobs=8)
+    overall = overall_row(cols)
+    by_dept = department_rows(cols)
+    runs    = run_rows(cols, labels)          # [(label, overall row, department rows), ...]
+
+    cols, labels = columns_from_verdicts(ResultStore(db).verdicts())   # same tables from the result store
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from judgments import (COUNT_FIELDS, DEPARTMENTS, extract_dataset_number, iter_jsonl,
+                       parse_content)
+
+
+# =============================================================================
+#                                  Encoding
+# =============================================================================
+
+TOP1_CODES  = ("YES", "NO", "UNSCORABLE")   # code = position; len() = invalid
+TOP35_CODES = ("YES", "NO")
+_TOP1  = {v: i for i, v in enumerate(TOP1_CODES)}
+_TOP35 = {v: i for i, v in enumerate(TOP35_CODES)}
+TOP1_INVALID  = len(TOP1_CODES)
+TOP35_INVALID = len(TOP35_CODES)
+
+DEPT_NAMES = [dept for dept, _, _ in DEPARTMENTS] + ["_UNMATCHED"]
+DEPT_UNMATCHED = len(DEPARTMENTS)
+
+# range index: starts sorted ascending (the table is), ends aligned with them
+_ORDER  = np.argsort([start for _, start, _ in DEPARTMENTS], kind="stable")
+_STARTS = np.array([DEPARTMENTS[i][1] for i in _ORDER], dtype=np.int64)
+_ENDS   = np.array([DEPARTMENTS[i][2] for i in _ORDER], dtype=np.int64)
+
+
+def dept_codes(case_no: np.ndarray) -> np.ndarray:
+    """Department index for every case number (DEPT_UNMATCHED outside all ranges or < 0)."""
+    case_no = np.asarray(case_no, dtype=np.int64)
+    pos = np.searchsorted(_STARTS, case_no, side="right") - 1
+    hit = (pos >= 0) & (case_no >= 0)
+    hit[hit] = case_no[hit] <= _ENDS[pos[hit]]
+    out = np.full(case_no.shape, DEPT_UNMATCHED, dtype=np.int16)
+    out[hit] = _ORDER[pos[hit]]
+    return out
+
+def _code(inner: Optional[Any], field: str, table: Dict[str, int], invalid: int) -> int:
+    if not isinstance(inner, dict):
+        return invalid
+    return table.get((inner.get(field) or "").strip().upper(), invalid)
+
+
+# =============================================================================
+#                                  Columns
+# =============================================================================
+
+class JudgmentColumns(NamedTuple):
+    case_no: np.ndarray
+    dept: np.ndarray
+    top1: np.ndarray
+    top3: np.ndarray
+    top5: np.ndarray
+    run: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.case_no)
+
+
+def _columns(case_no: List[int], top1: List[int], top3: List[int], top5: List[int], run) -> JudgmentColumns:
+    case_arr = np.array(case_no, dtype=np.int64)
+    return JudgmentColumns(
+        case_no=case_arr.astype(np.int32),
+        dept=dept_codes(case_arr),
+        top1=np.array(top1, dtype=np.int8),
+        top3=np.array(top3, dtype=np.int8),
+        top5=np.array(top5, dtype=np.int8),
+        run=np.broadcast_to(np.asarray(run, dtype=np.int16), case_arr.shape).copy(),
+    )
+
+def columns_from_records(records: Iterable[Dict[str, Any]], run: int = 0) -> JudgmentColumns:
+    """One parse of answer.content per record → JudgmentColumns."""
+    case_no, top1, top3, top5 = [], [], [], []
+    for rec in records:
+        inner = parse_content((rec.get("answer") or {}).get("content"))
+        num = extract_dataset_number(rec)
+        case_no.append(-1 if num is None else num)
+        top1.append(_code(inner, "TOP1", _TOP1, TOP1_INVALID))
+        top3.append(_code(inner, "TOP3", _TOP35, TOP35_INVALID))
+        top5.append(_code(inner, "TOP5", _TOP35, TOP35_INVALID))
+    return _columns(case_no, top1, top3, top5, run)
+
+def columns_from_verdicts(rows: Iterable[Tuple[str, str, Optional[int], Any, Any, Any]]) -> Tuple[JudgmentColumns, List[str]]:
+    """
+    result_store.ResultStore.verdicts() rows (model, method, dxbench_id, TOP1, TOP3, TOP5 —
+    already parsed on write) → columns with one run per model/method, and the run labels.
+    """
+    labels: List[str] = []
+    run_of: Dict[str, int] = {}
+    case_no, top1, top3, top5, run = [], [], [], [], []
+    for model, method, num, t1, t3, t5 in rows:
+        label = f"{model}/{method}" if model else method
+        if label not in run_of:
+            run_of[label] = len(labels)
+            labels.append(label)
+        case_no.append(-1 if num is None else num)
+        top1.append(_TOP1.get(t1, TOP1_INVALID))
+        top3.append(_TOP35.get(t3, TOP35_INVALID))
+        top5.append(_TOP35.get(t5, TOP35_INVALID))
+        run.append(run_of[label])
+    return _columns(case_no, top1, top3, top5, run), labels
+
+def load_columns(path: Path, run: int = 0) -> JudgmentColumns:
+    return columns_from_records(iter_jsonl(Path(path)), run)
+
+def _load_indexed(arg: Tuple[int, Path]) -> JudgmentColumns:
+    run, path = arg
+    return load_columns(path, run)
+
+def concat(parts: Sequence[JudgmentColumns]) -> JudgmentColumns:
+    if not parts:
+        return columns_from_records([])
+    return JudgmentColumns(*(np.concatenate(arrs) for arrs in zip(*parts)))
+
+def load_many(paths: Iterable[Path], jobs: int = 0) -> JudgmentColumns:
+    """All files into one set of columns (run = position in paths); with jobs > 1 parsed in parallel processes."""
+    indexed = list(enumerate(paths))
+    jobs = min(jobs or os.cpu_count() or 1, len(indexed))
+    if jobs <= 1:
+        return concat([_load_indexed(a) for a in indexed])
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        return concat(list(ex.map(_load_indexed, indexed)))
+
+
+# =============================================================================
+#                                  Group-bys
+# =============================================================================
+
+def _bincount2(group: np.ndarray, n_groups: int, code: np.ndarray, n_codes: int) -> np.ndarray:
+    """(n_groups, n_codes) counts of every (group, code) pair."""
+    flat = group.astype(np.int64) * n_codes + code
+    return np.bincount(flat, minlength=n_groups * n_codes).reshape(n_groups, n_codes)
+
+def count_table(cols: JudgmentColumns, group: np.ndarray, n_groups: int) -> np.ndarray:
+    """(n_groups, len(COUNT_FIELDS)) count matrix, columns in COUNT_FIELDS order."""
+    t1 = _bincount2(group, n_groups, cols.top1, TOP1_INVALID + 1)
+    t3 = _bincount2(group, n_groups, cols.top3, TOP35_INVALID + 1)
+    t5 = _bincount2(group, n_groups, cols.top5, TOP35_INVALID + 1)
+    total = np.bincount(group.astype(np.int64), minlength=n_groups)
+    return np.column_stack([total, t1, t3, t5]).astype(np.int64)
+
+def _row(counts: np.ndarray) -> Dict[str, int]:
+    return {k: int(v) for k, v in zip(COUNT_FIELDS, counts)}
+
+def _dept_rows(table: np.ndarray) -> List[Dict[str, Any]]:
+    """Same order as RunningTally.department_rows(); _UNMATCHED only if it has records."""
+    n = len(DEPARTMENTS) + (1 if table[DEPT_UNMATCHED, 0] > 0 else 0)
+    return [{"department": DEPT_NAMES[i], **_row(table[i])} for i in range(n)]
+
+def overall_row(cols: JudgmentColumns) -> Dict[str, int]:
+    return _row(count_table(cols, np.zeros(len(cols), dtype=np.int64), 1)[0])
+
+def department_rows(cols: JudgmentColumns) -> List[Dict[str, Any]]:
+    return _dept_rows(count_table(cols, cols.dept, len(DEPT_NAMES)))
+
+def run_rows(cols: JudgmentColumns, labels: Sequence[str]) -> List[Tuple[str, Dict[str, int], List[Dict[str, Any]]]]:
+    """(label, overall row, department rows) for every run, from two group-bys."""
+    n_runs, n_dept = len(labels), len(DEPT_NAMES)
+    by_run = count_table(cols, cols.run, n_runs)
+    by_run_dept = count_table(cols, cols.run.astype(np.int64) * n_dept + cols.dept, n_runs * n_dept)
+    by_run_dept = by_run_dept.reshape(n_runs, n_dept, len(COUNT_FIELDS))
+    return [(label, _row(by_run[r]), _dept_rows(by_run_dept[r])) for r, label in enumerate(labels)]
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Bootstrap confidence intervals and paired method comparisons for judgement results,
+on top of judgment_columns.JudgmentColumns (used by dep-analyze.py).
+
+Rates are the ones of the *_with_rates CSV: TOP1 accuracy = YES / (YES + NO),
+TOP3/TOP5 hit rate = YES / (YES + NO); UNSCORABLE and invalid answers are excluded
+from the denominator but stay in the resampled population.
+
+— How it works —
+* A rate only depends on how many resampled cases fall in each category, so
+  resampling n cases with replacement is exactly a Multinomial(n, observed
+  proportions) draw. One Generator.multinomial call per run and metric draws all
+  B resamples of every department at once: (B, departments, categories) counts,
+  no Python loop over resamples. The overall CI resamples all cases of the run.
+* Paired comparison of runs A and B (e.g. CoT vs zero-shot) on the cases both
+  judged: each case falls into one of 3 × 3 joint categories (A's outcome, B's
+  outcome), and the paired bootstrap is the same multinomial trick over those 9
+  cells, giving a CI for rate(A) − rate(B).
+* McNemar's exact test on the cases both decided (YES/NO) gives the p-value:
+  only the discordant pairs (A YES & B NO vs A NO & B YES) carry information.
+
+Usage:
+    rows  = bootstrap_rows(cols, labels, n_boot=10_000)         # CI per run × department × metric
+    tests = paired_rows(cols, labels, n_boot=10_000)            # every pair of runs
+    write_stats_csvs(rows, tests, out_dir)
+"""
+
+import csv
+import math
+import warnings
+from itertools import combinations
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from judgment_columns import DEPT_NAMES, JudgmentColumns
+
+
+BOOTSTRAP = 10_000   # resamples
+CI_LEVEL  = 0.95
+METRICS   = (("TOP1", "top1"), ("TOP3", "top3"), ("TOP5", "top5"))
+ALL       = "ALL"    # department label of the overall rows
+
+_YES, _NO, _OTHER = 0, 1, 2   # UNSCORABLE / invalid → _OTHER
+
+
+def _categories(codes: np.ndarray) -> np.ndarray:
+    return np.minimum(codes, _OTHER).astype(np.int64)
+
+def _rate(yes, no):
+    """YES / (YES + NO) as %, NaN where nothing was decided (arrays or scalars)."""
+    yes, no = np.asarray(yes, dtype=np.float64), np.asarray(no, dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(yes + no > 0, 100.0 * yes / (yes + no), np.nan)
+
+def _draw(rng: np.random.Generator, counts: np.ndarray, n_boot: int) -> np.ndarray:
+    """(G, K) observed category counts → (n_boot, G, K) bootstrap counts."""
+    n = counts.sum(axis=1)
+    p = np.where(n[:, None] > 0, counts / np.maximum(n, 1)[:, None], 0.0)
+    p[n == 0, 0] = 1.0   # n = 0 draws nothing anyway; pvals only has to be valid
+    return rng.multinomial(n, p, size=(n_boot, len(counts)))
+
+def _ci(samples: np.ndarray, level: float):
+    """Percentile interval along axis 0 (NaN-safe: resamples with nothing decided are dropped)."""
+    lo, hi = 50.0 * (1 - level), 50.0 * (1 + level)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # all-NaN slices (nothing decided) → NaN
+        return np.nanpercentile(samples, lo, axis=0), np.nanpercentile(samples, hi, axis=0)
+
+def mcnemar_exact(b: int, c: int) -> float:
+    """Two-sided exact McNemar p-value for b / c discordant pairs."""
+    n = b + c
+    if n == 0:
+        return 1.0
+    tail = sum(math.comb(n, k) for k in range(min(b, c) + 1))
+    return min(1.0, 2 * tail / 2 ** n)
+
+def _pct(x) -> Any:
+    return "" if x is None or (isinstance(x, float) and math.isnan(x)) else round(float(x), 2)
+
+
+# =============================================================================
+#                        CIs per run × department × metric
+# =============================================================================
+
+def bootstrap_rows(cols: JudgmentColumns, labels: Sequence[str], n_boot: int = BOOTSTRAP,
+                   level: float = CI_LEVEL, seed: Optional[int] = 0) -> List[Dict[str, Any]]:
+    rng = np.random.default_rng(seed)
+    n_dept = len(DEPT_NAMES)
+    rows = []
+    for r, label in enumerate(labels):
+        in_run = cols.run == r
+        dept = cols.dept[in_run].astype(np.int64)
+        for metric, field in METRICS:
+            cat = _categories(getattr(cols, field)[in_run])
+            by_dept = np.bincount(dept * 3 + cat, minlength=n_dept * 3).reshape(n_dept, 3)
+            counts = np.vstack([by_dept.sum(axis=0, keepdims=True), by_dept])   # row 0 = ALL
+            draws = _draw(rng, counts, n_boot)
+            lo, hi = _ci(_rate(draws[..., _YES], draws[..., _NO]), level)
+            point = _rate(counts[:, _YES], counts[:, _NO])
+            for g, name in enumerate([ALL] + DEPT_NAMES):
+                if counts[g].sum() == 0:
+                    continue
+                rows.append({"run": label, "department": name, "metric": metric,
+                             "n": int(counts[g].sum()), "decided": int(counts[g, _YES] + counts[g, _NO]),
+                             "rate_%": _pct(point[g]), "ci_low_%": _pct(lo[g]), "ci_high_%": _pct(hi[g])})
+    return rows
+
+
+# =============================================================================
+#                       Paired comparison of two runs
+# =============================================================================
+
+def _first_index(case_no: np.ndarray, in_run: np.ndarray):
+    """Case numbers of a run (duplicates → first record, unnumbered cases dropped) and their row indices."""
+    rows = np.flatnonzero(in_run & (case_no >= 0))
+    uniq, first = np.unique(case_no[rows], return_index=True)
+    return uniq, rows[first]
+
+def paired_rows(cols: JudgmentColumns, labels: Sequence[str], n_boot: int = BOOTSTRAP,
+                level: float = CI_LEVEL, seed: Optional[int] = 0) -> List[Dict[str, Any]]:
+    """rate(A) − rate(B) with paired-bootstrap CI and McNemar p, for every pair of runs with shared cases."""
+    rng = np.random.default_rng(seed)
+    n_dept = len(DEPT_NAMES)
+    index = [_first_index(cols.case_no, cols.run == r) for r in range(len(labels))]
+    rows = []
+    for a, b in combinations(range(len(labels)), 2):
+        _, ia, ib = np.intersect1d(index[a][0], index[b][0], assume_unique=True, return_indices=True)
+        if not len(ia):
+            continue
+        ra, rb = index[a][1][ia], index[b][1][ib]
+        dept = cols.dept[ra].astype(np.int64)
+        for metric, field in METRICS:
+            codes = getattr(cols, field)
+            joint = _categories(codes[ra]) * 3 + _categories(codes[rb])
+            by_dept = np.bincount(dept * 9 + joint, minlength=n_dept * 9).reshape(n_dept, 9)
+            counts = np.vstack([by_dept.sum(axis=0, keepdims=True), by_dept])
+            draws = _draw(rng, counts, n_boot).reshape(n_boot, len(counts), 3, 3)
+            diff = (_rate(draws[..., _YES, :].sum(-1), draws[..., _NO, :].sum(-1))
+                    - _rate(draws[..., :, _YES].sum(-1), draws[..., :, _NO].sum(-1)))
+            lo, hi = _ci(diff, level)
+            cells = counts.reshape(len(counts), 3, 3)
+            rate_a = _rate(cells[:, _YES, :].sum(-1), cells[:, _NO, :].sum(-1))
+            rate_b = _rate(cells[:, :, _YES].sum(-1), cells[:, :, _NO].sum(-1))
+            for g, name in enumerate([ALL] + DEPT_NAMES):
+                if counts[g].sum() == 0:
+                    continue
+                only_a, only_b = int(cells[g, _YES, _NO]), int(cells[g, _NO, _YES])
+                rows.append({"run_a": labels[a], "run_b": labels[b], "department": name, "metric": metric,
+                             "n_paired": int(counts[g].sum()),
+                             "rate_a_%": _pct(rate_a[g]), "rate_b_%": _pct(rate_b[g]),
+                             "diff_pp": _pct(rate_a[g] - rate_b[g]),
+                             "ci_low_pp": _pct(lo[g]), "ci_high_pp": _pct(hi[g]),
+                             "a_only_yes": only_a, "b_only_yes": only_b,
+                             "p_mcnemar": round(mcnemar_exact(only_a, only_b), 4)})
+    return rows
+
+
+# =============================================================================
+#                                   Output
+# =============================================================================
+
+def _write(rows: List[Dict[str, Any]], path: Path, what: str):
+    with path.open("w", encoding="utf-8", newline="") as f:
+        w = csv.DictWriter(f, fieldnames=list(rows[0]))
+        w.writeheader()
+        w.writerows(rows)
+    print(f"CSV ({what}) saved to: {path.resolve()}")
+
+def write_stats_csvs(ci_rows: List[Dict[str, Any]], paired: List[Dict[str, Any]], out_dir: Path):
+    """judgment_ci_by_run_department.csv و judgment_paired_tests.csv (اگر جفتی باشد)."""
+    if ci_rows:
+        _write(ci_rows, out_dir / "judgment_ci_by_run_department.csv", "bootstrap CI by run × department")
+    if paired:
+        _write(paired, out_dir / "judgment_paired_tests.csv", "paired run comparisons")
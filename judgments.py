@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Shared judgement aggregation: parsing of the judge's answer.content, the DxBench
+department table and TOP1/TOP3/TOP5 counting, used by dep-analyze.py (files on disk)
+and pipeline.py (running totals while judgements stream in).
+
+Counting rules (unchanged from dep-analyze.py):
+    TOP1 ∈ YES / NO / UNSCORABLE, TOP3/TOP5 ∈ YES / NO, anything else → invalid_*;
+    an answer whose content is not a JSON object counts as invalid for all three.
+
+Usage:
+    tally = RunningTally()
+    for rec in records:                    # {"dataset_id": ..., "answer": {"content": ...}}
+        tally.add(rec)
+    write_count_csvs(tally.overall_row(), tally.department_rows(), out_dir)
+
+    tallies = tally_files(paths, jobs=8)   # one pass per file, files in parallel processes
+
+For many runs at once see judgment_columns.py (same counts from NumPy group-bys).
+"""
+
+import os
+import re
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# پاک‌سازی و پارس JSON در answer.content (آخرین {...} متوازن، با orjson اگر نصب باشد)
+from structured_output import parse_content, loads
+
+
+# ---------- نگاشت دپارتمان‌ها بر اساس جدول شما ----------
+DEPARTMENTS = [
+    ("Surgery", 1, 93),
+    ("Obstetrics and Gynecology", 94, 189),
+    ("Internal Medicine", 190, 288),
+    ("Dentistry", 289, 360),
+    ("Neurology", 361, 436),
+    ("Oncology", 437, 492),
+    ("Orthopedics", 493, 581),
+    ("Pediatrics", 582, 640),
+    ("Otorhinolaryngology", 641, 724),
+    ("Reproductive and Men's Health", 725, 797),
+    ("Dermatovenereology", 798, 918),
+    ("Other", 919, 989),
+    ("Psychology", 990, 1073),
+    ("Hematology", 1074, 1121),
+    ("Infectious Diseases and Immunology", 1122, 1148),
+]
+
+def dept_for_number(n: int):
+    for dept, start, end in DEPARTMENTS:
+        if start <= n <= end:
+            return dept
+    return None
+
+ID_KEYS = ("dataset_id","id","sample_id","case_id","qid","question_id","dx_id")
+
+def extract_dataset_number(rec: dict):
+    """
+    فایل فعلی شما فیلد 'dataset_id' دارد مثل 'dxbench_241'.
+    این تابع عدد انتهایی را برمی‌گرداند (241).
+    """
+    # ترتیب جست‌وجو شامل dataset_id هم باشد
+    for key in ID_KEYS:
+        if key in rec and rec[key] is not None:
+            s = str(rec[key])
+            m = re.findall(r"(\d+)", s)
+            if m:
+                return int(m[-1])
+    meta = rec.get("meta") or rec.get("metadata") or {}
+    for key in ID_KEYS:
+        if key in meta and meta[key] is not None:
+            s = str(meta[key])
+            m = re.findall(r"(\d+)", s)
+            if m:
+                return int(m[-1])
+    return None
+
+
+# ---------- شمارش ----------
+COUNT_FIELDS = [
+    "total_rows",
+    "TOP1_YES", "TOP1_NO", "TOP1_UNSCORABLE", "invalid_TOP1",
+    "TOP3_YES", "TOP3_NO", "invalid_TOP3",
+    "TOP5_YES", "TOP5_NO", "invalid_TOP5",
+]
+
+def empty_counts() -> Dict[str, int]:
+    return {k: 0 for k in COUNT_FIELDS}
+
+def count_judgment(bucket: Dict[str, int], inner: Optional[Any]):
+    """یک رکورد (inner = parse_content(answer.content)) را به bucket اضافه می‌کند."""
+    bucket["total_rows"] += 1
+    if not isinstance(inner, dict):
+        bucket["invalid_TOP1"] += 1
+        bucket["invalid_TOP3"] += 1
+        bucket["invalid_TOP5"] += 1
+        return
+
+    t1 = (inner.get("TOP1") or "").strip().upper()
+    t3 = (inner.get("TOP3") or "").strip().upper()
+    t5 = (inner.get("TOP5") or "").strip().upper()
+
+    if t1 in ("YES","NO","UNSCORABLE"):
+        bucket["TOP1_" + t1] += 1
+    else:
+        bucket["invalid_TOP1"] += 1
+
+    if t3 in ("YES","NO"):
+        bucket["TOP3_" + t3] += 1
+    else:
+        bucket["invalid_TOP3"] += 1
+
+    if t5 in ("YES","NO"):
+        bucket["TOP5_" + t5] += 1
+    else:
+        bucket["invalid_TOP5"] += 1
+
+
+class RunningTally:
+    """Overall + per-department counts, filled one judgement record at a time (one parse per record)."""
+
+    def __init__(self):
+        self.overall = empty_counts()
+        self.by_dept: Dict[str, Dict[str, int]] = {dept: empty_counts() for dept, _, _ in DEPARTMENTS}
+        self.by_dept["_UNMATCHED"] = empty_counts()
+
+    def add(self, rec: Dict[str, Any]):
+        inner = parse_content((rec.get("answer") or {}).get("content"))
+        num = extract_dataset_number(rec)
+        dept = dept_for_number(num) if num is not None else None
+        count_judgment(self.overall, inner)
+        count_judgment(self.by_dept[dept if dept in self.by_dept else "_UNMATCHED"], inner)
+
+    def overall_row(self) -> Dict[str, int]:
+        return dict(self.overall)
+
+    def department_rows(self) -> List[Dict[str, Any]]:
+        """ترتیب خروجی مطابق سورت جدول شما؛ _UNMATCHED فقط اگر رکوردی داشته باشد."""
+        names = [dept for dept, _, _ in DEPARTMENTS]
+        if self.by_dept["_UNMATCHED"]["total_rows"] > 0:
+            names.append("_UNMATCHED")
+        return [{"department": d, **self.by_dept[d]} for d in names]
+
+    def merge(self, other: "RunningTally"):
+        for dst, src in [(self.overall, other.overall)] + [(self.by_dept[d], other.by_dept[d]) for d in self.by_dept]:
+            for k in COUNT_FIELDS:
+                dst[k] += src[k]
+
+    def line(self) -> str:
+        return summary_line(self.overall)
+
+
+def summary_line(o: Dict[str, int]) -> str:
+    """One-line summary of an overall row (progress / per-run printout)."""
+    return (f"{o['total_rows']} judged | TOP1 YES {o['TOP1_YES']} NO {o['TOP1_NO']} UNS {o['TOP1_UNSCORABLE']}"
+            f" | TOP3 YES {o['TOP3_YES']} | TOP5 YES {o['TOP5_YES']}")
+
+
+# ---------- فایل‌ها ----------
+def iter_jsonl(path: Path):
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield loads(line)
+            except Exception:
+                # خط خراب را رد کن
+                continue
+
+class JsonlTail:
+    """
+    دنبال کردن فایل JSONL در حال نوشتن (مثلاً خروجی test-api-final.py در حین اجرا):
+    read_new() فقط خطوط کامل‌شده از آخرین آفست بایتی را برمی‌گرداند؛ خط نیمه‌نوشته‌ی آخر
+    تا رسیدن '\n' منتظر می‌ماند. اگر فایل کوتاه‌تر شود (اجرای تازه) از ابتدا خوانده می‌شود
+    و reset=True برمی‌گردد تا شمارش آن فایل صفر شود.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.offset = 0
+
+    def read_new(self) -> Tuple[List[Dict[str, Any]], bool]:
+        try:
+            size = self.path.stat().st_size
+        except FileNotFoundError:
+            return [], False
+        reset = size < self.offset
+        if reset:
+            self.offset = 0
+        if size == self.offset:
+            return [], reset
+        with self.path.open("rb") as f:
+            f.seek(self.offset)
+            chunk = f.read(size - self.offset)
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            return [], reset
+        self.offset += end + 1
+        recs = []
+        for line in chunk[:end].split(b"\n"):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                recs.append(loads(line))
+            except ValueError:
+                # خط خراب را رد کن
+                continue
+        return recs, reset
+
+def tally_file(path: Path) -> RunningTally:
+    """یک گذر روی فایل: هر رکورد یک بار پارس می‌شود و شمارش کلی و دپارتمانی با هم پر می‌شوند."""
+    tally = RunningTally()
+    for rec in iter_jsonl(Path(path)):
+        tally.add(rec)
+    return tally
+
+def tally_files(paths: Iterable[Path], jobs: int = 0) -> List[RunningTally]:
+    """tally_file برای چند فایل؛ با jobs > 1 فایل‌ها در پردازه‌های موازی (یک هسته برای هر فایل)."""
+    paths = list(paths)
+    jobs = min(jobs or os.cpu_count() or 1, len(paths))
+    if jobs <= 1:
+        return [tally_file(p) for p in paths]
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        return list(ex.map(tally_file, paths))
+
+def run_model(path: Path) -> str:
+    """مدلِ یک فایل نتایج: نزدیک‌ترین پوشهٔ والد که results/judged نباشد (مثل «meerkat - full dataset»)."""
+    return next((p.name for p in Path(path).resolve().parents if p.name.lower() not in ("results", "judged")), "")
+
+def run_label(path: Path) -> str:
+    """
+    برچسب «مدل/روش» برای یک فایل نتایج: نام فایل = روش، و run_model = مدل
+    (مثل «meerkat - full dataset/single_step_cot»).
+    """
+    model = run_model(path)
+    return f"{model}/{Path(path).stem}" if model else Path(path).stem
+
+
+# ---------- خروجی CSV ----------
+def write_count_csvs(overall: Dict[str, int], by_dept: List[Dict[str, Any]], out_dir: Path, verbose: bool = True):
+    """judgment_counts_overall.csv / judgment_counts_by_department(_with_rates).csv در out_dir (verbose=False: بدون چاپ مسیرها)."""
+    out_csv_overall = out_dir / "judgment_counts_overall.csv"
+    with out_csv_overall.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(COUNT_FIELDS)
+        w.writerow([overall[k] for k in COUNT_FIELDS])
+    if verbose:
+        print(f"CSV (overall) saved to: {out_csv_overall.resolve()}")
+
+    out_csv_by_dept = out_dir / "judgment_counts_by_department.csv"
+    with out_csv_by_dept.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["department"] + COUNT_FIELDS)
+        for row in by_dept:
+            w.writerow([row["department"]] + [row[k] for k in COUNT_FIELDS])
+    if verbose:
+        print(f"CSV (by department) saved to: {out_csv_by_dept.resolve()}")
+
+    # (اختیاری) CSV با نرخ‌ها هم بسازیم — ستونی، بدون apply سطر به سطر
+    try:
+        import pandas as pd
+        df = pd.DataFrame(by_dept)
+        for col, top in (("TOP1_ACC_%", "TOP1"), ("TOP3_HIT_%", "TOP3"), ("TOP5_HIT_%", "TOP5")):
+            yes, no = df[top + "_YES"], df[top + "_NO"]
+            df[col] = (100.0 * yes / (yes + no).where(yes + no > 0)).round(2).fillna(0.0)
+        out_csv_rates = out_dir / "judgment_counts_by_department_with_rates.csv"
+        df.to_csv(out_csv_rates, index=False)
+        if verbose:
+            print(f"CSV (by department with rates) saved to: {out_csv_rates.resolve()}")
+    except Exception as e:
+        if verbose:
+            print("Skipping rates CSV (pandas not available?):", e)
+
+def write_run_csvs(runs: List[Tuple[str, Dict[str, int], List[Dict[str, Any]]]], out_dir: Path, verbose: bool = True):
+    """
+    مقایسهٔ اجراها: judgment_counts_by_run.csv و judgment_counts_by_run_department.csv.
+    runs = [(label, overall row, department rows), ...] (judgment_columns.run_rows یا از RunningTally).
+    """
+    out_csv_runs = out_dir / "judgment_counts_by_run.csv"
+    with out_csv_runs.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["run"] + COUNT_FIELDS)
+        for label, overall, _ in runs:
+            w.writerow([label] + [overall[k] for k in COUNT_FIELDS])
+    if verbose:
+        print(f"CSV (by run) saved to: {out_csv_runs.resolve()}")
+
+    out_csv_run_dept = out_dir / "judgment_counts_by_run_department.csv"
+    with out_csv_run_dept.open("w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(["run", "department"] + COUNT_FIELDS)
+        for label, _, by_dept in runs:
+            for row in by_dept:
+                w.writerow([label, row["department"]] + [row[k] for k in COUNT_FIELDS])
+    if verbose:
+        print(f"CSV (by run × department) saved to: {out_csv_run_dept.resolve()}")
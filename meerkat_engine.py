@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+Dynamic-batching greedy generation for a local Hugging Face causal LM (the Meerkat
+evaluation loop, see meerkat_eval.py).
+
+The notebooks call model.generate() on one prompt at a time, so the GPU decodes a
+batch of one for up to 4000 tokens per case. Static batching (one padded
+model.generate over N prompts) helps only until the first sequences finish: every
+batch runs as long as its longest answer. This engine keeps the batch full instead.
+
+— How it works —
+* Requests are queued sorted by prompt length in buckets of BUCKET_WIDTH tokens. A
+  prefill takes up to the free slots from the bucket at the head of the queue, so
+  prompts padded together differ by less than BUCKET_WIDTH tokens.
+* Prompts are left-padded; position ids come from the attention mask (cumsum − 1),
+  as in model.generate, so padding does not shift positions.
+* One decode step = one forward pass of the whole active batch over its KV cache.
+  A sequence that emits EOS or reaches its max_new_tokens leaves the batch at once
+  (its cache rows are dropped). When REFILL_AT of the slots are free the next bucket
+  is prefilled and its cache is merged into the running one (the shorter side
+  left-padded with masked zeros); columns that are padding for every remaining row
+  are cut off on the way.
+* Optional stop criteria (stop_criteria.py, `stop=default_criteria`): every slot decodes
+  its tokens incrementally and the sequence leaves the batch as soon as the structured
+  answer is complete (JSON closed, Clarifying Questions list ended, a section header
+  repeated). Its text is cut there; the unused token budget and an estimate of the
+  time it would have cost (at the sequence's own seconds per token) are reported.
+* Greedy decoding, like the notebooks (do_sample=False). In float32 the tokens are
+  those of model.generate per prompt; `python bench.py engine` checks this and
+  measures throughput on CPU with a tiny randomly initialised Llama.
+
+Usage:
+    engine = BatchEngine(model, tokenizer, max_batch=16, stop=default_criteria)
+    for i, gen in engine.generate_iter(prompts, max_new_tokens=4000):   # in finishing order
+        print(i, gen.finish, gen.text)
+    engine.generate(prompts)          # list, input order
+    engine.generate_ids(token_lists)  # no tokenizer needed
+    print(engine.stats.summary())
+"""
+
+import time
+from collections import deque
+from typing import Callable, Deque, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+from transformers import DynamicCache
+
+from stop_criteria import StopChecker, StopCriterion
+
+
+MAX_BATCH      = 8      # sequences decoded together
+BUCKET_WIDTH   = 64     # prompt-length bucket (tokens)
+REFILL_AT      = 0.25   # refill once this fraction of the slots (at least one) is free
+MAX_NEW_TOKENS = 4000   # the notebooks' BASE_GEN_KWARGS
+
+
+class Generation(NamedTuple):
+    token_ids: List[int]   # new tokens, EOS excluded
+    text: str              # decoded token_ids ("" without a tokenizer); cut at the stop point
+    prompt_tokens: int
+    finish: str            # "eos" | "length" | name of the stop criterion that fired
+    seconds: float         # prefill → finish (time spent queued excluded)
+    budget_left: int = 0   # max_new_tokens not used because a stop criterion fired
+    saved_s: float = 0.0   # budget_left × this sequence's seconds per token (upper-bound estimate)
+
+    @property
+    def stopped(self) -> bool:
+        return self.finish not in ("eos", "length")
+
+
+class EngineStats:
+    """Counters of one engine; summary() is printed at the end of a run."""
+
+    def __init__(self):
+        self.sequences = 0
+        self.prefill_tokens = 0
+        self.prefill_padding = 0
+        self.new_tokens = 0
+        self.steps = 0
+        self.slot_steps = 0      # Σ active rows over decode steps
+        self.seconds = 0.0
+        self.stopped = 0         # sequences ended by a stop criterion
+        self.budget_left = 0     # their unused max_new_tokens
+        self.saved_s = 0.0
+
+    def summary(self, max_batch: int = 0) -> str:
+        rate = self.new_tokens / self.seconds if self.seconds else 0.0
+        occ = self.slot_steps / self.steps if self.steps else 0.0
+        pad = self.prefill_padding / max(1, self.prefill_tokens + self.prefill_padding)
+        line = (f"engine: {self.sequences} seqs, {self.new_tokens} new tokens in {self.seconds:.1f}s "
+                f"→ {rate:.1f} tok/s | mean batch {occ:.1f}" + (f"/{max_batch}" if max_batch else "") +
+                f" over {self.steps} steps | prefill padding {100 * pad:.1f}%")
+        if self.stopped:
+            line += (f" | early stop {self.stopped} seqs: ≤ {self.budget_left} tokens / "
+                     f"≈ {self.saved_s:.1f}s of budget unused")
+        return line
+
+
+class _Slot:
+    __slots__ = ("req", "prompt_tokens", "max_new", "tokens", "t0", "checker")
+
+    def __init__(self, req: int, prompt_tokens: int, max_new: int, t0: float, checker: Optional[StopChecker]):
+        self.req = req
+        self.prompt_tokens = prompt_tokens
+        self.max_new = max_new
+        self.tokens: List[int] = []
+        self.t0 = t0
+        self.checker = checker
+
+
+def _kv(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """Per-layer (keys, values) of a DynamicCache, (batch, heads, seq, dim)."""
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))   # transformers < 4.56
+
+
+class BatchEngine:
+    """Continuous-batching greedy decoder over one model (not thread-safe: one caller at a time)."""
+
+    def __init__(self, model, tokenizer=None, max_batch: int = MAX_BATCH, bucket_width: int = BUCKET_WIDTH,
+                 refill_at: float = REFILL_AT, eos_token_id: Union[int, Sequence[int], None] = None,
+                 pad_token_id: Optional[int] = None, stop: Optional[Callable[[], List[StopCriterion]]] = None):
+        if stop is not None and tokenizer is None:
+            raise ValueError("stop criteria need the tokenizer (they look at the decoded text)")
+        self.model = model
+        self.tokenizer = tokenizer
+        self.stop = stop
+        self.max_batch = max(1, max_batch)
+        self.bucket_width = max(1, bucket_width)
+        self.refill_slots = max(1, int(round(refill_at * self.max_batch)))
+        self.device = next(model.parameters()).device
+
+        if eos_token_id is None:
+            eos_token_id = tokenizer.eos_token_id if tokenizer is not None else model.generation_config.eos_token_id
+        eos = eos_token_id if isinstance(eos_token_id, (list, tuple, set)) else [eos_token_id]
+        self.eos = {int(e) for e in eos if e is not None}
+        if pad_token_id is None and tokenizer is not None:
+            pad_token_id = tokenizer.pad_token_id
+        self.pad = pad_token_id if pad_token_id is not None else (min(self.eos) if self.eos else 0)
+        self.stats = EngineStats()
+
+        self._slots: List[_Slot] = []
+        self._mask: Optional[torch.Tensor] = None    # (B, L) attention mask of the cache + fed tokens
+        self._next: Optional[torch.Tensor] = None    # (B, 1) last generated token, not fed yet
+        self._cache = None
+
+    # ---- public ----------------------------------------------------------------
+
+    def generate_iter(self, prompts: Sequence[str], max_new_tokens: Union[int, Sequence[int]] = MAX_NEW_TOKENS
+                      ) -> Iterator[Tuple[int, Generation]]:
+        """Text prompts (tokenised like tokenizer(prompt)) → (prompt index, Generation) as they finish."""
+        if self.tokenizer is None:
+            raise ValueError("BatchEngine needs a tokenizer for text prompts (use generate_ids)")
+        ids = [self.tokenizer(p)["input_ids"] for p in prompts]
+        for i, gen in self.generate_ids_iter(ids, max_new_tokens):
+            if not gen.stopped:
+                gen = gen._replace(text=self.tokenizer.decode(gen.token_ids, skip_special_tokens=True))
+            yield i, gen
+
+    def generate(self, prompts: Sequence[str], max_new_tokens: Union[int, Sequence[int]] = MAX_NEW_TOKENS
+                 ) -> List[Generation]:
+        return _in_order(self.generate_iter(prompts, max_new_tokens), len(prompts))
+
+    def generate_ids(self, prompts: Sequence[Sequence[int]], max_new_tokens: Union[int, Sequence[int]] = MAX_NEW_TOKENS
+                     ) -> List[Generation]:
+        return _in_order(self.generate_ids_iter(prompts, max_new_tokens), len(prompts))
+
+    def generate_ids_iter(self, prompts: Sequence[Sequence[int]],
+                          max_new_tokens: Union[int, Sequence[int]] = MAX_NEW_TOKENS
+                          ) -> Iterator[Tuple[int, Generation]]:
+        """Token-id prompts → (prompt index, Generation) in finishing order."""
+        n = len(prompts)
+        limits = [int(max_new_tokens)] * n if isinstance(max_new_tokens, int) else [int(m) for m in max_new_tokens]
+        if len(limits) != n:
+            raise ValueError(f"{len(limits)} max_new_tokens values for {n} prompts")
+        if any(not len(p) for p in prompts):
+            raise ValueError("empty prompt")
+        queue: Deque[int] = deque(sorted(range(n), key=lambda i: (len(prompts[i]) // self.bucket_width, i)))
+
+        t_start = time.perf_counter()
+        try:
+            with torch.no_grad():
+                while queue or self._slots:
+                    free = self.max_batch - len(self._slots)
+                    if queue and (not self._slots or free >= self.refill_slots):
+                        yield from self._admit(self._take(queue, prompts, free), prompts, limits)
+                    if self._slots:
+                        yield from self._step()
+        finally:
+            self._slots, self._mask, self._next, self._cache = [], None, None, None
+            self.stats.seconds += time.perf_counter() - t_start
+
+    # ---- scheduling --------------------------------------------------------------
+
+    def _take(self, queue: Deque[int], prompts, free: int) -> List[int]:
+        """Up to `free` requests from the bucket at the head of the queue."""
+        bucket = len(prompts[queue[0]]) // self.bucket_width
+        taken = []
+        while queue and len(taken) < free and len(prompts[queue[0]]) // self.bucket_width == bucket:
+            taken.append(queue.popleft())
+        return taken
+
+    def _admit(self, reqs: List[int], prompts, limits) -> Iterator[Tuple[int, Generation]]:
+        """Prefill a group of requests and merge it into the running batch."""
+        t0 = time.perf_counter()
+        width = max(len(prompts[r]) for r in reqs)
+        ids = torch.full((len(reqs), width), self.pad, dtype=torch.long)
+        mask = torch.zeros((len(reqs), width), dtype=torch.long)
+        for row, r in enumerate(reqs):
+            p = prompts[r]
+            ids[row, width - len(p):] = torch.as_tensor(list(p), dtype=torch.long)
+            mask[row, width - len(p):] = 1
+        ids, mask = ids.to(self.device), mask.to(self.device)
+        positions = (mask.cumsum(-1) - 1).clamp(min=0)
+
+        out = self.model(input_ids=ids, attention_mask=mask, position_ids=positions,
+                         past_key_values=DynamicCache(), use_cache=True)
+        first = out.logits[:, -1, :].argmax(-1, keepdim=True)
+        self.stats.prefill_tokens += int(mask.sum())
+        self.stats.prefill_padding += mask.numel() - int(mask.sum())
+        self.stats.sequences += len(reqs)
+
+        slots = [_Slot(r, len(prompts[r]), limits[r], t0,
+                       StopChecker(self.tokenizer, self.stop()) if self.stop is not None else None)
+                 for r in reqs]
+        self._merge(slots, out.past_key_values, mask, first)
+        yield from self._record(first[-len(reqs):, 0].tolist(), start=len(self._slots) - len(reqs))
+
+    def _step(self) -> Iterator[Tuple[int, Generation]]:
+        """One decode step of the whole active batch."""
+        positions = self._mask.sum(-1, keepdim=True)   # real tokens before the one fed now
+        self._mask = F.pad(self._mask, (0, 1), value=1)
+        out = self.model(input_ids=self._next, attention_mask=self._mask, position_ids=positions,
+                         past_key_values=self._cache, use_cache=True)
+        self._cache = out.past_key_values
+        self._next = out.logits[:, -1, :].argmax(-1, keepdim=True)
+        self.stats.steps += 1
+        self.stats.slot_steps += len(self._slots)
+        yield from self._record(self._next[:, 0].tolist(), start=0)
+
+    def _record(self, tokens: List[int], start: int) -> Iterator[Tuple[int, Generation]]:
+        """Append the new token of rows start.. and retire finished rows."""
+        keep = list(range(start))
+        now = time.perf_counter()
+        for row, tok in enumerate(tokens, start):
+            slot = self._slots[row]
+            finish = hit = None
+            if tok in self.eos:
+                finish = "eos"
+            else:
+                slot.tokens.append(tok)
+                self.stats.new_tokens += 1
+                hit = slot.checker.feed(tok) if slot.checker is not None else None
+                if hit is not None:
+                    finish = hit.reason
+                elif len(slot.tokens) >= slot.max_new:
+                    finish = "length"
+            if finish is None:
+                keep.append(row)
+                continue
+            seconds = now - slot.t0
+            if hit is None:
+                yield slot.req, Generation(slot.tokens, "", slot.prompt_tokens, finish, seconds)
+                continue
+            left = slot.max_new - len(slot.tokens)
+            saved = left * seconds / len(slot.tokens)
+            self.stats.stopped += 1
+            self.stats.budget_left += left
+            self.stats.saved_s += saved
+            yield slot.req, Generation(slot.tokens, slot.checker.answer(), slot.prompt_tokens, finish,
+                                       seconds, left, saved)
+        if len(keep) < len(self._slots):
+            self._select(keep)
+
+    # ---- batch / cache surgery ---------------------------------------------------
+
+    def _merge(self, slots: List[_Slot], cache, mask: torch.Tensor, first: torch.Tensor):
+        if not self._slots:
+            self._slots, self._cache, self._mask, self._next = slots, cache, mask, first
+            return
+        width = max(self._mask.shape[1], mask.shape[1])
+        layers = []
+        for (ka, va), (kb, vb) in zip(_kv(self._cache), _kv(cache)):
+            layers.append((torch.cat([_left_pad(ka, width), _left_pad(kb, width)]),
+                           torch.cat([_left_pad(va, width), _left_pad(vb, width)])))
+        self._mask = torch.cat([F.pad(self._mask, (width - self._mask.shape[1], 0)),
+                                F.pad(mask, (width - mask.shape[1], 0))])
+        self._next = torch.cat([self._next, first])
+        self._slots = self._slots + slots
+        self._cache = DynamicCache(layers)
+        self._trim(0)
+
+    def _select(self, keep: List[int]):
+        self._slots = [self._slots[i] for i in keep]
+        if not keep:
+            self._mask = self._next = self._cache = None
+            return
+        index = torch.as_tensor(keep, dtype=torch.long, device=self.device)
+        self._cache.batch_select_indices(index)
+        self._mask, self._next = self._mask[index], self._next[index]
+        self._trim(self.bucket_width)
+
+    def _trim(self, min_cols: int):
+        """Drop leading columns that are padding for every row (only if more than min_cols)."""
+        used = self._mask.any(0)
+        lead = int(used.to(torch.int8).argmax()) if bool(used.any()) else 0
+        if lead <= min_cols:
+            return
+        self._mask = self._mask[:, lead:]
+        self._cache = DynamicCache([(k[:, :, lead:], v[:, :, lead:]) for k, v in _kv(self._cache)])
+
+
+def _left_pad(t: torch.Tensor, width: int) -> torch.Tensor:
+    return F.pad(t, (0, 0, width - t.shape[-2], 0))
+
+def _in_order(pairs: Iterator[Tuple[int, Generation]], n: int) -> List[Generation]:
+    out: List[Optional[Generation]] = [None] * n
+    for i, gen in pairs:
+        out[i] = gen
+    return out
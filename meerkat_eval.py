@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Meerkat evaluation loop of Meerkat_Model.ipynb / bnb_4bit_smash_Meerkat_Model.ipynb as
+an importable module, running every (case, technique) prompt through the
+dynamic-batching engine (meerkat_engine.py) instead of one model.generate per prompt.
+
+— How it works —
+1) DxBench (FreedomIntelligence/DxBench, "en") → clean_and_map → optional id
+   selection / random sample, exactly as in the notebooks.
+2) Every case × technique prompt (PROMPT_TEMPLATES) is queued at once; the engine
+   buckets them by length and keeps MAX_BATCH sequences decoding, refilling slots
+   as answers finish.
+3) Each answer is written as soon as it finishes, in the notebooks' formats:
+       <out_dir>/results_<technique>.txt   (method / inference_time / id / symptom line / label / assistant_output)
+       <out_dir>/verify_<technique>.txt    (test-api-final.py input)
+       <out_dir>/prompts_<technique>.txt
+   so the rest of the flow (test-api-final.py → dep-analyze.py) is unchanged. The
+   order inside a file is finishing order; inference_time is the seconds the case
+   spent in the engine (prefill → last token), with other cases sharing the batch.
+4) STOP_EARLY: stop criteria (stop_criteria.py) end an answer as soon as its structure
+   is complete (Clarifying Questions list ended, a section header repeated, JSON
+   closed) instead of decoding the repeated "Step 3" blocks up to 4000 tokens. Per
+   case <out_dir>/generation_stats.jsonl records tokens, finish reason, seconds, the
+   unused token budget and the time that budget would have taken (estimate at the
+   case's own seconds per token).
+
+Usage:
+    python meerkat_eval.py --out per_method_outputs --batch 16
+    python meerkat_eval.py --bnb --ids DxBench_481 DxBench_577 --batch 8      # 4-bit twin
+    python meerkat_eval.py --sample 115 --seed 0 --techniques single_step_cot
+    python meerkat_eval.py --no-stop                                           # decode to EOS / limit
+
+    from meerkat_eval import load_model, load_cases, run_eval
+    model, tokenizer = load_model(MODEL_NAME)
+    run_eval(model, tokenizer, load_cases(), out_dir=Path("per_method_outputs"))
+"""
+
+import os
+import json
+import random
+import argparse
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+from meerkat_engine import BatchEngine, MAX_BATCH, BUCKET_WIDTH
+from stop_criteria import default_criteria
+
+
+# =============================================================================
+#                       ⚙️  EDITABLE CONSTANTS (TOP-OF-FILE)
+# =============================================================================
+
+MODEL_NAME     = "dmis-lab/meerkat-7b-v1.0"
+BNB_MODEL_ID   = "PrunaAI/dmis-lab-meerkat-7b-v1.0-bnb-4bit-smashed"   # --bnb (tokenizer: MODEL_NAME)
+DATASET        = ("FreedomIntelligence/DxBench", "DxBench")
+OUT_DIR        = "per_method_outputs"
+STOP_EARLY     = True   # end answers once their structure is complete (--no-stop)
+STATS_FILE     = "generation_stats.jsonl"
+
+BASE_GEN_KWARGS = {
+    'max_new_tokens':       4000,   # from the sample code
+    'do_sample':            False,  # the engine decodes greedily
+}
+
+DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+
+# =============================================================================
+#                         Prompt templates (notebooks)
+# =============================================================================
+
+TEMPLATE_LEAST_TO_MOST = """
+Patient Symptoms:
+{symptom_line}
+
+You are a specialized medical AI assistant. Your responses must be:
+1.  Strictly based on established medical knowledge.
+2.  Confined to medical and healthcare-related topics only. If a query is not medical, state this and do not proceed with a medical assessment.
+3.  Aim to provide helpful, cautious information. Do not speculate beyond the provided symptoms or invent information. You should approach this task by methodically thinking through the specified internal questions.
+
+Task: Your goal is to analyze the patient symptoms methodically by following an internal sequence of questions to determine potential conditions and formulate clarifying questions.
+
+Internal Reasoning Process (Follow this sequence of questions internally, using the answers to inform subsequent steps):
+
+Internal Question 1 (Easy – Symptom Systems):
+Mentally answer: \"Which organ systems are primarily involved based on the 'Patient Symptoms' (Explicit and Implicit) provided?\"
+
+Internal Question 2 (Medium – Broad Disease List):
+Mentally answer: \"Based on the involved organ systems identified in Internal Question 1 and the specific 'Patient Symptoms,' list diseases (approximately 6-8) that commonly affect these systems with such a presentation.\"
+
+Internal Question 3 (Hard – Top 5 Candidates & Key Findings Analysis):
+Mentally answer: \"From the broad list generated in Internal Question 2, which are *exactly 5 diseases* that best fit *all* the 'Patient Symptoms'? For each of these 5 candidate diseases, critically note:
+    a) Key findings from the 'Patient Symptoms' list that strongly support it.
+    b) Any typical key findings/symptoms for that disease that are missing from the provided 'Patient Symptoms' or seem contradicted by them.\"
+    (This detailed analysis will inform your justifications and confidence scores in the output.)
+
+Internal Question 4 (Very Hard – Most Plausible Single Candidate & Comparative Rationale):
+Mentally answer: \"Of the 5 candidate diseases selected in Internal Question 3, which single disease appears to be the most plausible overall explanation for the *entire* symptom complex? Develop a rationale explaining why this one might be more plausible than the other two, specifically considering how well it accounts for all presented symptoms and the supporting, missing, or contradictory findings noted in Internal Question 3.\"
+    (This deeper rationale will help refine the likelihood/confidence scores and justifications for the output. Even if one is most plausible, you will still present all 5-6 candidates in the final output as requested below.)
+
+---
+Final Output Structure:
+After completing your internal reasoning process (Internal Questions 1-4), present your entire response by first providing \"Output Section I: Differential Diagnoses\" and then \"Output Section II: Clarifying Questions to Ask\". Do not explicitly narrate or output the direct answers to \"Internal Question 1,\" \"Internal Question 2,\" or the detailed comparative rationale from \"Internal Question 4\" as standalone sections; instead, use this internal reasoning to construct the required output sections.
+
+Output Section I: Differential Diagnoses:a
+Present the 5 to 6 most probable differential diagnoses (derived from your analysis in Internal Question 3 and refined by Internal Question 4). For each diagnosis, provide the following:
+    a.  **Diagnosis Name:** [Name of the potential disease]
+    b.  **Justification:** [Provide a clear and concise justification. This should be informed by your analysis in Internal Question 3 (supporting, missing, or contradictory findings) and Internal Question 4. Explain how the symptom complex aligns with this condition.]
+    c.  **Likelihood:** [Estimate the likelihood of this diagnosis given the current information. This should reflect insights from Internal Question 4.]
+    d.  **Confidence:** [State your confidence level. This should also reflect insights from Internal Question 4.]
+
+    If, after your analysis, you determine that the provided symptoms are too vague or insufficient to form a reliable list of 5-6 differential diagnoses with reasonable confidence, you must explicitly state this under this section and explain why. However, still attempt to list any broad considerations (derived from your internal \"Internal Question 2\") that might be relevant if more information were available.
+
+Output Section II: Clarifying Questions to Ask:
+List 2-3 specific, targeted questions you would ask the patient or a clinician.
+* These questions should be aimed at gathering critical information that would best help to differentiate between the diagnoses listed in Section I, or to significantly increase your confidence in those assessments, informed by your entire internal reasoning process.
+* Phrase them as direct questions.
+ASSISTANT:
+"""
+
+TEMPLATE_ZERO_SHOT_DIRECT = """
+Patient Symptoms:
+{symptom_line}
+
+You are a specialized medical AI assistant. Your responses must be:
+1.  Strictly based on established medical knowledge.
+2.  Confined to medical and healthcare-related topics only. If a query is not medical, state this and do not proceed with a medical assessment.
+3.  Aim to provide helpful, cautious information. Do not speculate beyond the provided symptoms or invent information.
+
+Task:
+Based *only* on the symptoms listed above:
+1.  Provide a list of 5 to 6 most probable differential diagnoses. Follow the \"Output Instructions for Each Diagnosis\" below.
+2.  If you determine that the provided symptoms are too vague or insufficient to form a reliable list of diagnoses with reasonable confidence, explicitly state this and explain why. However, still attempt to list any broad considerations if possible, or state if not.
+3.  Regardless of your confidence in the initial assessment, after providing your diagnostic considerations (or stating insufficiency), you MUST then list \"Clarifying Questions to Ask\" as detailed below.
+
+Output Instructions for Each Diagnosis:
+1.  **Diagnosis Name:** [Name of the potential disease]
+2.  **Justification:** [Briefly explain why this diagnosis is considered, linking to specific explicit or implicit symptoms provided.]
+3.  **Likelihood:** [Estimate the likelihood]
+4.  **Confidence:** [State your confidence level for this specific diagnosis]
+
+Clarifying Questions to Ask:
+* After your diagnostic assessment, list 2-3 specific, targeted questions.
+* These questions should be what you, as a medical AI assistant, would ask the patient or a clinician to gather critical details.
+* The primary goal of these questions is to help differentiate more clearly between the potential diagnoses you\'ve listed, or to significantly increase your confidence in a particular diagnosis.
+* Phrase them as direct questions
+
+Structure your entire response by first providing the differential diagnoses as per the instructions, and then list the \"Clarifying Questions to Ask\".
+ASSISTANT:
+"""
+
+TEMPLATE_SINGLE_STEP_COT  = """
+Patient Symptoms:
+{symptom_line}
+
+You are a specialized medical AI assistant. Your responses must be:
+1.  Strictly based on established medical knowledge.
+2.  Confined to medical and healthcare-related topics only. If a query is not medical, state this and do not proceed with a medical assessment.
+3.  Aim to provide helpful, cautious information. Do not speculate beyond the provided symptoms or invent information. You should approach this task by thinking step-by-step.
+
+Task: Your goal is to analyze the patient symptoms methodically to determine potential conditions. Please follow these steps carefully:
+
+Step 1 – Symptom Categorization:
+For each symptom listed in \"Patient Symptoms\" (both explicit and implicit), categorize it by the primary affected bodily system(s). Present this as a clear list.
+
+Step 2 – Broad List of Potential Conditions:
+Based on the combination of symptoms and your categorizations in Step 1, generate a broad list of potential diseases or conditions (approximately 6-8 possibilities) that could initially be considered. Do not evaluate or rank them at this stage; simply list them.
+
+Step 3 – Differential Diagnoses with Detailed Evaluation:
+From your broad list in Step 2, critically evaluate the possibilities. Select the 5 most probable differential diagnoses that best align with the *entire* symptom set. For each of these selected diagnoses, you MUST provide the following details:
+    a.  **Diagnosis Name:** [Name of the potential disease]
+    b.  **Justification:** [Provide a clear and concise justification explaining why this diagnosis is a strong possibility. Specifically link this to the individual symptoms (Explicit and Implicit) and your system categorizations from Step 1. Explain how the symptom complex aligns with this condition.]
+    c.  **Likelihood:** [Estimate the likelihood of this diagnosis given the current information]
+    d.  **Confidence:** [State your confidence level in this assessment for this specific diagnosis]
+
+    If, after your analysis, you determine that the provided symptoms are too vague or insufficient to form a reliable list of 5 differential diagnoses with reasonable confidence, you must explicitly state this and explain why. However, still attempt to list any broad considerations from Step 2 that might be relevant if more information were available.
+
+Clarifying Questions to Ask:
+After completing Step 3 (your differential diagnoses and evaluations):
+* Identify and list 2-3 specific, targeted questions you would ask the patient or a clinician.
+* These questions should be aimed at gathering critical information that would best help to differentiate between the diagnoses listed in Step 3, or to significantly increase your confidence in those assessments.
+* Phrase these as direct questions.
+
+Output Structure:
+Ensure your entire response is clearly structured. Label and complete each step (Step 1, Step 2, Step 3) in order, followed by the \"Clarifying Questions to Ask\" section.
+ASSISTANT:
+"""
+
+PROMPT_TEMPLATES = {
+    "least_to_most":     TEMPLATE_LEAST_TO_MOST,
+    "zero_shot_direct":  TEMPLATE_ZERO_SHOT_DIRECT,
+    "single_step_cot":   TEMPLATE_SINGLE_STEP_COT
+}
+
+
+# =============================================================================
+#                                  Dataset
+# =============================================================================
+
+def clean_and_map(example):
+    def format_symptoms(symptom_list):
+        # Build JSON-style dict: {"Symptom": "True"/"False"}
+        sym_dict = {
+            sym[0]: sym[1]
+            for sym in symptom_list
+            if isinstance(sym, list) and len(sym) == 2
+        }
+        return json.dumps(sym_dict, ensure_ascii=False)
+
+    explicit_str = format_symptoms(example.get('explicit_symptoms', [])) or "Not provided"
+    implicit_str = format_symptoms(example.get('implicit_symptoms', [])) or "Not provided"
+
+    symptom_line = f"Explicit: {explicit_str} \nImplicit: {implicit_str}"
+    return {
+        "symptom_line": symptom_line,
+        "label": example.get('disease'),
+        "id": example.get('id')  # Used for logging
+    }
+
+def load_cases(selected_ids: Optional[Sequence[str]] = None, sample: int = 0, seed: Optional[int] = None
+               ) -> List[Dict[str, Any]]:
+    """Cleaned DxBench rows (id, label, symptom_line); selected ids keep their given order."""
+    from datasets import load_dataset   # only needed here
+
+    raw_dataset = load_dataset(*DATASET)["en"]
+    print(f"Original dataset size: {len(raw_dataset)} rows")
+    cleaned = raw_dataset.map(clean_and_map)
+    cleaned = cleaned.filter(lambda x: x['symptom_line'] and x['label'])
+    print(f"After cleaning: {len(cleaned)} rows")
+
+    if selected_ids:
+        index_by_id = {v: i for i, v in enumerate(cleaned["id"])}
+        cleaned = cleaned.select([index_by_id[i] for i in selected_ids if i in index_by_id])
+        print(f"Selected {len(cleaned)} rows for evaluation")
+    elif sample:
+        rng = random.Random(seed)
+        cleaned = cleaned.select(rng.sample(range(len(cleaned)), min(sample, len(cleaned))))
+        print(f"Selected {len(cleaned)} random rows for evaluation")
+    return [{"id": ex["id"], "label": ex["label"], "symptom_line": ex["symptom_line"]} for ex in cleaned]
+
+
+# =============================================================================
+#                                  Outputs
+# =============================================================================
+
+def extract_diagnosis_block(output_text):
+    parts = output_text.rsplit("ASSISTANT:", maxsplit=1)
+    if len(parts) == 2:
+        return parts[1].strip()
+
+    return output_text.strip()
+
+VERIFICATION_TEXT = """You are a strict medical judge.
+
+INPUT:
+• GT: the ground-truth diagnosis (string)
+• Assistant_output: free text (may be narrative, lists, or mixed)
+
+TASK:
+Decide whether the assistant’s BEST diagnosis (Top-1) matches GT, and also whether GT appears within the assistant’s Top-3 and Top-5 diagnoses.
+
+HOW TO FIND THE SINGLE BEST DIAGNOSIS (“BEST”) — priority order:
+1) If the text explicitly names a final/primary/most-likely/definitive diagnosis, use that.
+2) Else if any diagnoses are ranked, numbered, or given probabilities/likelihoods,
+   pick the highest-ranked/probability item; ties → pick the one appearing earliest.
+3) Else if multiple diagnoses are discussed narratively, pick the one the text argues
+   FOR most strongly (most supportive reasons, least hedging), not merely mentioned.
+4) Else if only one diagnosis is meaningfully proposed, use it.
+5) If you cannot extract any diagnosis the assistant endorses → UNSCORABLE.
+
+MATCHING (normalize before comparing):
+• Lowercase; remove punctuation and parentheticals.
+• Accept common clinical synonyms (non-exhaustive): CVA↔stroke; MI/heart attack↔myocardial infarction;
+  CHD↔coronary artery disease; PID↔pelvic inflammatory disease; PCOS↔polycystic ovary syndrome;
+  UTI↔urinary tract infection; DVT↔deep vein thrombosis; eczema↔atopic dermatitis.
+• Do NOT credit broader categories unless clearly meant as the specific disease (no parent/child credit).
+
+SECONDARY CHECKS:
+Also note whether GT appears among the assistant’s Top-3 diagnoses, and whether it appears among the Top-5 diagnoses. Mentions only for exclusion do NOT count.
+
+OUTPUT — single JSON line, no prose:
+{"TOP1":"YES|NO|UNSCORABLE","TOP3":"YES|NO","TOP5":"YES|NO","BEST":"<assistant_best_dx>"}"""
+
+def _append(path: Path, text: str):
+    with path.open("a", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+
+def write_outputs(out_dir: Path, technique: str, ex: Dict[str, Any], prompt: str,
+                  assistant_only: str, elapsed_s: float):
+    """One finished case → results_/verify_/prompts_<technique>.txt (notebook formats)."""
+    sep = "=" * 22 + "\n"
+    _append(out_dir / f"results_{technique}.txt",
+            f"method: {technique}\n"
+            f"inference_time: {elapsed_s}\n"
+            f"id: {ex['id']}\n"
+            f"symptom line: {ex['symptom_line']}\n"
+            f"label: {ex['label']}\n"
+            "assistant_output:\n"
+            f"{assistant_only}\n\n" + sep)
+    _append(out_dir / f"verify_{technique}.txt",
+            f"ID: {ex['id']}\n"
+            ">> VERIFICATION PROMPT:\n"
+            f"GROUND-TRUTH DIAGNOSIS: {ex['label']}\n\n"
+            "Assistant_output:\n"
+            "<<<\n"
+            f"{assistant_only}\n"
+            ">>>\n\n" +
+            VERIFICATION_TEXT.strip() + "\n\n" + sep)
+    _append(out_dir / f"prompts_{technique}.txt", f"{ex['id']}\n{prompt}\n" + sep)
+
+
+# =============================================================================
+#                               Evaluation loop
+# =============================================================================
+
+def load_model(model_id: str = MODEL_NAME, tokenizer_id: Optional[str] = None, bnb: bool = False):
+    """fp16 model on DEVICE (Meerkat_Model.ipynb) or the 4-bit twin with device_map="auto"."""
+    print(f"Loading model {model_id} on device {DEVICE}...")
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_id or model_id, use_fast=True)
+    if bnb:
+        model = AutoModelForCausalLM.from_pretrained(model_id, trust_remote_code=True, device_map="auto")
+    else:
+        model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float16).to(DEVICE)
+    model.eval()
+    return model, tokenizer
+
+def run_eval(model, tokenizer, cases: List[Dict[str, Any]], out_dir: Path = Path(OUT_DIR),
+             techniques: Optional[Sequence[str]] = None, max_batch: int = MAX_BATCH,
+             bucket_width: int = BUCKET_WIDTH, max_new_tokens: int = BASE_GEN_KWARGS['max_new_tokens'],
+             stop_early: bool = STOP_EARLY) -> BatchEngine:
+    """All case × technique prompts through one BatchEngine; outputs written as answers finish."""
+    techniques = list(techniques or PROMPT_TEMPLATES)
+    out_dir = Path(out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    for tech in techniques:
+        for kind in ("results", "verify", "prompts"):
+            (out_dir / f"{kind}_{tech}.txt").write_text("", encoding="utf-8")
+    (out_dir / STATS_FILE).write_text("", encoding="utf-8")
+
+    jobs = [(ex, tech, PROMPT_TEMPLATES[tech].format(symptom_line=ex["symptom_line"]))
+            for ex in cases for tech in techniques]
+    engine = BatchEngine(model, tokenizer, max_batch=max_batch, bucket_width=bucket_width,
+                         stop=default_criteria if stop_early else None)
+    print(f"▶ {len(cases)} cases × {len(techniques)} methods = {len(jobs)} prompts, batch {max_batch}")
+    for i, gen in engine.generate_iter([prompt for _, _, prompt in jobs], max_new_tokens):
+        ex, technique, prompt = jobs[i]
+        elapsed_s = round(gen.seconds, 2)
+        write_outputs(out_dir, technique, ex, prompt, extract_diagnosis_block(gen.text), elapsed_s)
+        _append(out_dir / STATS_FILE, json.dumps({
+            "id": ex["id"], "method": technique, "tokens": len(gen.token_ids), "finish": gen.finish,
+            "seconds": elapsed_s, "budget_left": gen.budget_left, "est_saved_s": round(gen.saved_s, 2),
+        }, ensure_ascii=False) + "\n")
+        saved = f" | stopped, {gen.budget_left} tokens ≈ {gen.saved_s:.1f}s unused" if gen.stopped else ""
+        print(f"[LOG] id={ex['id']} | method={technique} | time={elapsed_s}s | tokens={len(gen.token_ids)} ({gen.finish}){saved}")
+    print(f"📈 {engine.stats.summary(max_batch)}")
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched Meerkat evaluation on DxBench")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--tokenizer", default=None, help="Defaults to --model (--bnb: MODEL_NAME)")
+    parser.add_argument("--bnb", action="store_true", help=f"4-bit twin ({BNB_MODEL_ID})")
+    parser.add_argument("--out", default=OUT_DIR)
+    parser.add_argument("--ids", nargs="+", help="Only these DxBench ids (e.g. DxBench_481)")
+    parser.add_argument("--sample", type=int, default=0, help="Random sample of N cases")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--techniques", nargs="+", choices=list(PROMPT_TEMPLATES), default=None)
+    parser.add_argument("--batch", type=int, default=MAX_BATCH, help="Sequences decoded together")
+    parser.add_argument("--bucket", type=int, default=BUCKET_WIDTH, help="Prompt-length bucket (tokens)")
+    parser.add_argument("--max-new-tokens", type=int, default=BASE_GEN_KWARGS['max_new_tokens'])
+    parser.add_argument("--no-stop", action="store_true", help="No stop criteria: decode to EOS / max-new-tokens")
+    args = parser.parse_args()
+
+    if args.bnb:
+        model, tokenizer = load_model(BNB_MODEL_ID if args.model == MODEL_NAME else args.model,
+                                      args.tokenizer or MODEL_NAME, bnb=True)
+    else:
+        model, tokenizer = load_model(args.model, args.tokenizer)
+    cases = load_cases(args.ids, args.sample, args.seed)
+    run_eval(model, tokenizer, cases, Path(args.out), args.techniques, args.batch, args.bucket, args.max_new_tokens,
+             stop_early=STOP_EARLY and not args.no_stop)
+
+if __name__ == "__main__":
+    main()
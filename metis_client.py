@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Shared Metis chat-API client for generate.py and test-api-final.py.
+
+— What it gives you —
+1) MetisClient: one requests.Session per client with a keep-alive connection pool,
+   so consecutive calls reuse the same TCP+TLS connection instead of paying a fresh
+   handshake on every `requests.post`. Auth/JSON headers are set once.
+2) SessionPool (optional): creates chat sessions ahead of time on a background
+   thread, so `POST /chat/session` is no longer on each case's critical path.
+3) Rate control (optional, rate_limit.AdaptiveRateLimiter): every call is paced by
+   a shared AIMD limiter; 429/5xx retries (session AND message calls) honour
+   Retry-After and use jittered backoff instead of a fixed 0.5·2^attempt.
+4) Response cache (optional, response_cache.ResponseCache): send_message stores
+   every successful reply under sha256(bot id, content, params); ask() and
+   cached() look it up BEFORE a session is created, so a hit costs no API call.
+5) Instrumentation (optional, metrics.Metrics): set `client.metrics` and every call
+   is recorded with its header wait vs body read time, attempt number and size.
+
+Sessions are SINGLE-USE on purpose: a Metis chat session keeps its message history,
+so sending a second case into a used session would leak the previous case into the
+prompt. The pool only moves session creation off the critical path; it never hands
+out a session twice.
+
+Usage:
+    client = shared_client(api_key, bot_id, session_pool=4)
+    resp = client.ask(content)        # cache hit, or session (pre-created if pooled) + message
+    close_clients()
+"""
+
+import time
+import queue
+import threading
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limit import AdaptiveRateLimiter, parse_retry_after
+from response_cache import ResponseCache
+from metrics import Metrics
+
+
+# =============================================================================
+#                                 Defaults
+# =============================================================================
+
+API_BASE        = "https://api.metisai.ir"
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT    = 120
+MAX_RETRIES     = 5
+POOL_MAXSIZE    = 32     # keep-alive connections kept per host
+
+
+# =============================================================================
+#                                  Client
+# =============================================================================
+
+class MetisClient:
+    """Pooled HTTP client for the Metis chat endpoints (thread-safe)."""
+
+    def __init__(self, api_key: str, bot_id: str, base_url: str = API_BASE,
+                 connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 max_retries: int = MAX_RETRIES, pool_maxsize: int = POOL_MAXSIZE,
+                 session_pool: int = 0, limiter: Optional[AdaptiveRateLimiter] = None,
+                 cache: Optional[ResponseCache] = None, cache_params: Optional[Dict[str, Any]] = None):
+        self.api_key = api_key
+        self.bot_id = bot_id
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.limiter = limiter
+        self.cache = cache
+        # anything besides bot + content that changes the answer (the bot's model
+        # settings live server-side, so by default only the endpoint is included)
+        self.cache_params = {"base_url": self.base_url, **(cache_params or {})}
+        self.metrics: Optional[Metrics] = None   # attached by the scripts per run
+
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        self.http.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        })
+
+        self.sessions = SessionPool(self, session_pool) if session_pool > 0 else None
+
+    # ---- raw endpoints -------------------------------------------------------
+
+    def _post(self, url: str, payload: Dict[str, Any], kind: str, attempt: int = 0) -> requests.Response:
+        """One paced POST; feeds the outcome back into the rate limiter (and metrics)."""
+        if self.limiter is not None:
+            self.limiter.acquire()
+        t0 = time.perf_counter()
+        try:
+            r = self.http.post(url, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            if self.metrics is not None:
+                dt = time.perf_counter() - t0
+                self.metrics.call(kind, None, attempt, dt, 0.0, dt, 0, error=type(e).__name__)
+            raise
+        if self.metrics is not None:
+            # r.elapsed stops at the response headers; the body is read after that
+            total = time.perf_counter() - t0
+            wait = min(total, r.elapsed.total_seconds())
+            self.metrics.call(kind, r.status_code, attempt, wait, total - wait, total, len(r.content))
+        if self.limiter is not None:
+            if r.status_code == 429 or (r.status_code == 503 and "Retry-After" in r.headers):
+                self.limiter.on_throttle(parse_retry_after(r.headers.get("Retry-After")))
+            elif r.status_code < 400:
+                self.limiter.on_success()
+        return r
+
+    def _post_retrying(self, url: str, payload: Dict[str, Any], kind: str) -> requests.Response:
+        """
+        _post with retries on 429/5xx (Retry-After honoured) and connection errors. Any
+        other 4xx (bad key, unknown bot/session) is raised at once: retrying cannot fix it.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                r = self._post(url, payload, kind=kind, attempt=attempt)
+                if r.status_code == 429 or 500 <= r.status_code < 600:
+                    if attempt < self.max_retries:
+                        time.sleep(AdaptiveRateLimiter.retry_delay(
+                            attempt, parse_retry_after(r.headers.get("Retry-After"))))
+                        continue
+                r.raise_for_status()
+                return r
+            except requests.HTTPError:
+                raise   # status already retried above, or not retryable
+            except requests.RequestException:
+                if attempt < self.max_retries:
+                    time.sleep(AdaptiveRateLimiter.retry_delay(attempt))
+                    continue
+                raise
+
+    def make_session(self) -> str:
+        r = self._post_retrying(
+            f"{self.base_url}/api/v1/chat/session",
+            {"botId": self.bot_id, "user": None, "initialMessages": None},
+            kind="session",
+        )
+        return r.json()["id"]
+
+    def send_message(self, session_id: str, content: str) -> Dict[str, Any]:
+        resp = self._send_message(session_id, content)
+        if self.cache is not None:
+            self.cache.put(self._cache_key(content), resp)
+        return resp
+
+    def _send_message(self, session_id: str, content: str) -> Dict[str, Any]:
+        r = self._post_retrying(
+            f"{self.base_url}/api/v1/chat/session/{session_id}/message",
+            {"message": {"content": content, "type": "USER"}},
+            kind="message",
+        )
+        return r.json()
+
+    # ---- cache -----------------------------------------------------------------
+
+    def _cache_key(self, content: str) -> str:
+        return ResponseCache.key(self.bot_id, content, self.cache_params)
+
+    def cached(self, content: str) -> Optional[Dict[str, Any]]:
+        """Cached reply for this content, or None (also None when caching is off)."""
+        if self.cache is None:
+            return None
+        return self.cache.get(self._cache_key(content))
+
+    # ---- convenience -----------------------------------------------------------
+
+    def acquire_session(self) -> str:
+        """A fresh, never-used session id (from the pool if enabled)."""
+        if self.sessions is not None:
+            return self.sessions.acquire()
+        return self.make_session()
+
+    def ask(self, content: str) -> Dict[str, Any]:
+        """One case = cached reply, or one fresh session + one message."""
+        resp = self.cached(content)
+        if resp is not None:
+            return resp
+        return self.send_message(self.acquire_session(), content)
+
+    def close(self):
+        if self.sessions is not None:
+            self.sessions.close()
+        self.http.close()
+
+
+# =============================================================================
+#                               Session pool
+# =============================================================================
+
+class SessionPool:
+    """
+    Keeps up to `size` fresh chat sessions ready. A daemon thread refills the
+    queue as sessions are taken; if the queue is empty, acquire() falls back to
+    creating one inline so callers never stall on the pool.
+    """
+
+    def __init__(self, client: MetisClient, size: int):
+        self.client = client
+        self.ready: "queue.Queue[str]" = queue.Queue(maxsize=size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fill, name="metis-session-pool", daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        backoff = 0.5
+        while not self._stop.is_set():
+            try:
+                sid = self.client.make_session()
+            except Exception:
+                # API hiccup: back off, acquire() still works inline meanwhile
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 0.5
+            while not self._stop.is_set():
+                try:
+                    self.ready.put(sid, timeout=0.5)
+                    break
+                except queue.Full:
+                    continue
+
+    def acquire(self) -> str:
+        try:
+            return self.ready.get_nowait()
+        except queue.Empty:
+            return self.client.make_session()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+
+_CLIENTS: Dict[tuple, MetisClient] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+def shared_client(api_key: str, bot_id: str, base_url: str = API_BASE, **kwargs) -> MetisClient:
+    """
+    One MetisClient per (key, bot, base URL) per process, so every worker thread
+    shares the same connection pool. kwargs only apply on first creation.
+    """
+    key = (api_key, bot_id, base_url.rstrip("/"))
+    with _CLIENTS_LOCK:
+        client: Optional[MetisClient] = _CLIENTS.get(key)
+        if client is None:
+            client = _CLIENTS[key] = MetisClient(api_key, bot_id, base_url=base_url, **kwargs)
+        return client
+
+def close_clients():
+    with _CLIENTS_LOCK:
+        for client in _CLIENTS.values():
+            client.close()
+        _CLIENTS.clear()
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Run instrumentation for generate.py / test-api-final.py.
+
+— What is recorded —
+Every HTTP call made by metis_client.MetisClient becomes one structured record:
+    {"ts", "kind": "session"|"message", "status", "attempt",
+     "wait_s":  send → response headers (includes connect/TLS on a new connection),
+     "read_s":  headers → body fully read,
+     "total_s", "bytes": response size, "error": exception name (network errors only)}
+and every finished case one record:
+    {"ts", "kind": "case", "method", "id", "ok", "cached", "total_s"}
+
+Records are appended to <output dir>/calls.metrics.jsonl (one line each) so runs can
+be compared afterwards; summary() gives p50/p95/p99 per call kind, retry/error
+counts, response sizes and cases/minute at the end of a run. With progress=True a
+background thread rewrites one status line on stderr every PROGRESS_EVERY seconds.
+
+Usage:
+    metrics = Metrics(out_dir / "calls.metrics.jsonl", progress=True)
+    client.metrics = metrics          # MetisClient feeds the call records
+    metrics.case(method, cid, ok=True, total_s=3.2)
+    print(metrics.summary()); metrics.close()
+"""
+
+import sys
+import math
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+
+PROGRESS_EVERY = 1.0   # seconds between progress-line refreshes
+PERCENTILES    = (50, 95, 99)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an already sorted list (0.0 if empty)."""
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(p / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+def _pcts(values: List[float], unit: str = "s", fmt: str = "{:.2f}") -> str:
+    vs = sorted(values)
+    return " ".join(f"p{p}={fmt.format(percentile(vs, p))}{unit}" for p in PERCENTILES)
+
+
+class Metrics:
+    """Thread-safe collector of call/case records with a JSONL sink and optional progress line."""
+
+    def __init__(self, path: Optional[Path] = None, progress: bool = False):
+        self.path = Path(path) if path is not None else None
+        self._f = self.path.open("a", encoding="utf-8") if self.path is not None else None
+        self._lock = threading.Lock()
+        self.calls: List[Dict[str, Any]] = []
+        self.cases: List[Dict[str, Any]] = []
+        self.started = time.monotonic()
+
+        self._stop = threading.Event()
+        self._progress = None
+        if progress:
+            self._progress = threading.Thread(target=self._tick, name="metrics-progress", daemon=True)
+            self._progress.start()
+
+    # ---- recording -------------------------------------------------------------
+
+    def _emit(self, rec: Dict[str, Any]):
+        """Caller holds self._lock."""
+        if self._f is not None:
+            self._f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def call(self, kind: str, status: Optional[int], attempt: int, wait_s: float, read_s: float,
+             total_s: float, nbytes: int, error: Optional[str] = None):
+        rec = {"ts": round(time.time(), 3), "kind": kind, "status": status, "attempt": attempt,
+               "wait_s": round(wait_s, 4), "read_s": round(read_s, 4), "total_s": round(total_s, 4),
+               "bytes": nbytes}
+        if error:
+            rec["error"] = error
+        with self._lock:
+            self.calls.append(rec)
+            self._emit(rec)
+
+    def case(self, method: str, cid: Any, ok: bool, total_s: float, cached: bool = False):
+        rec = {"ts": round(time.time(), 3), "kind": "case", "method": method, "id": cid,
+               "ok": ok, "cached": cached, "total_s": round(total_s, 4)}
+        with self._lock:
+            self.cases.append(rec)
+            self._emit(rec)
+
+    # ---- reporting -------------------------------------------------------------
+
+    def _rate(self, n: int) -> float:
+        elapsed = time.monotonic() - self.started
+        return 60.0 * n / elapsed if elapsed > 0 else 0.0
+
+    def progress_line(self) -> str:
+        with self._lock:
+            done = len(self.cases)
+            failed = sum(1 for c in self.cases if not c["ok"])
+            recent = sorted(c["total_s"] for c in self.cases[-200:])
+            retries = sum(1 for c in self.calls if c["attempt"] > 0)
+        return (f"{done} cases ({failed} failed) | {self._rate(done):.1f} cases/min | "
+                f"case p50={percentile(recent, 50):.2f}s p95={percentile(recent, 95):.2f}s | retries={retries}")
+
+    def summary(self) -> str:
+        with self._lock:
+            calls, cases = list(self.calls), list(self.cases)
+        elapsed = time.monotonic() - self.started
+        lines = []
+        for kind in ("session", "message"):
+            rs = [c for c in calls if c["kind"] == kind]
+            if not rs:
+                continue
+            ok = [c for c in rs if c["status"] is not None and c["status"] < 400]
+            lines.append(
+                f"{kind:<8} n={len(rs)} retries={sum(1 for c in rs if c['attempt'] > 0)} "
+                f"errors={len(rs) - len(ok)}\n"
+                f"         total {_pcts([c['total_s'] for c in ok])}\n"
+                f"         wait  {_pcts([c['wait_s'] for c in ok])}   read {_pcts([c['read_s'] for c in ok])}\n"
+                f"         size  {_pcts([c['bytes'] / 1024 for c in ok], unit='KiB', fmt='{:.1f}')}"
+            )
+        if cases:
+            n_ok = sum(1 for c in cases if c["ok"])
+            n_cached = sum(1 for c in cases if c["cached"])
+            lines.append(
+                f"cases    n={len(cases)} ok={n_ok} failed={len(cases) - n_ok} cached={n_cached} "
+                f"in {elapsed:.1f}s → {self._rate(len(cases)):.1f} cases/min\n"
+                f"         total {_pcts([c['total_s'] for c in cases])}"
+            )
+        return "\n".join(lines) if lines else "no calls recorded"
+
+    def _tick(self):
+        while not self._stop.wait(PROGRESS_EVERY):
+            sys.stderr.write("\r" + self.progress_line() + "  ")
+            sys.stderr.flush()
+
+    def close(self):
+        self._stop.set()
+        if self._progress is not None:
+            self._progress.join(timeout=2)
+            sys.stderr.write("\r" + self.progress_line() + "\n")
+            sys.stderr.flush()
+        with self._lock:
+            if self._f is not None:
+                self._f.close()
+                self._f = None
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Metis chat API, for exercising generate.py / test-api-final.py
+without spending quota.
+
+— Endpoints (same shapes the scripts use) —
+    POST /api/v1/chat/session                      → {"id": "<session id>"}
+    POST /api/v1/chat/session/<id>/message         → {"id": ..., "messages": [USER, ASSISTANT]}
+
+Every message call sleeps a random latency in [--latency MIN MAX] seconds before
+answering, so concurrency settings can be sized against a realistic 20–120 s API
+(scaled down). The assistant reply is the same JSON line DRY_RUN produces.
+
+Quota simulation (for the rate limiter):
+    --max-rps R        more than R message calls in any 1 s window → 429 + Retry-After
+    --script 200,429   status codes returned by successive message calls, cycled
+    --session-script 429,200   same for session calls (POST /chat/session)
+    --retry-after S    Retry-After value sent with scripted/quota 429s
+
+Usage:
+    python mock_metis_server.py --port 8765 --latency 0.5 2
+    python generate.py --api-base http://127.0.0.1:8765 --api-key x --bot-id x --workers 8
+
+Stats (sessions, messages, 429s, peak concurrent messages) are printed on Ctrl+C.
+"""
+
+import re
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# =============================================================================
+#                       ⚙️  EDITABLE CONSTANTS (TOP-OF-FILE)
+# =============================================================================
+
+HOST        = "127.0.0.1"
+PORT        = 8765
+LATENCY_MIN = 0.5    # seconds per message call
+LATENCY_MAX = 2.0
+
+ASSISTANT_REPLY = (
+    '{"BEST":"Example Dx",'
+    '"RANKED":[["Example Dx",0.62],["Alt Dx 1",0.23],["Alt Dx 2",0.15],["Alt Dx 3",0.07],["Alt Dx 4",0.03]]}'
+)
+
+MESSAGE_PATH = re.compile(r"^/api/v1/chat/session/([^/]+)/message/?$")
+
+
+# =============================================================================
+#                                  Server
+# =============================================================================
+
+class MockState:
+    """Counters shared by all handler threads."""
+
+    def __init__(self, latency=(LATENCY_MIN, LATENCY_MAX), max_rps: float = 0,
+                 script=None, retry_after: float = 1.0, session_script=None):
+        self.latency = latency
+        self.max_rps = max_rps
+        self.script = list(script or [])
+        self.session_script = list(session_script or [])
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.messages = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._recent = deque()   # accepted message timestamps (last 1 s)
+        self._script_pos = 0
+        self._session_script_pos = 0
+
+    def admit(self) -> int:
+        """Status for the next message call: scripted code, quota 429, or 200."""
+        with self.lock:
+            if self.script:
+                code = self.script[self._script_pos % len(self.script)]
+                self._script_pos += 1
+                if code != 200:
+                    self.throttled += code == 429
+                    return code
+            if self.max_rps > 0:
+                now = time.monotonic()
+                while self._recent and now - self._recent[0] >= 1.0:
+                    self._recent.popleft()
+                if len(self._recent) >= self.max_rps:
+                    self.throttled += 1
+                    return 429
+                self._recent.append(now)
+            return 200
+
+    def admit_session(self) -> int:
+        """Status for the next session call: scripted code or 200."""
+        with self.lock:
+            if not self.session_script:
+                return 200
+            code = self.session_script[self._session_script_pos % len(self.session_script)]
+            self._session_script_pos += 1
+            self.throttled += code == 429
+            return code
+
+    def enter(self):
+        with self.lock:
+            self.messages += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f"sessions={len(self.sessions)} messages={self.messages} "
+                    f"throttled={self.throttled} peak_concurrent_messages={self.peak_in_flight}")
+
+
+class MockMetisHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive, like the real API
+    state: MockState = None         # set by make_server()
+
+    def log_message(self, fmt, *args):
+        pass  # quiet; stats are printed on shutdown
+
+    def _read_json(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(n) if n else b""
+        try:
+            return json.loads(raw.decode("utf-8") or "null")
+        except ValueError:
+            return None
+
+    def _send_json(self, status: int, obj, headers=None):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int):
+        headers = {"Retry-After": f"{self.state.retry_after:g}"} if status in (429, 503) else None
+        self._send_json(status, {"error": "scripted" if status != 429 else "rate limited"}, headers)
+
+    def do_POST(self):
+        payload = self._read_json()
+        path = self.path.split("?", 1)[0]
+
+        if path.rstrip("/") == "/api/v1/chat/session":
+            status = self.state.admit_session()
+            if status != 200:
+                self._send_error(status)
+                return
+            sid = uuid.uuid4().hex
+            with self.state.lock:
+                self.state.sessions.add(sid)
+            self._send_json(200, {"id": sid, "botId": (payload or {}).get("botId")})
+            return
+
+        m = MESSAGE_PATH.match(path)
+        if m:
+            sid = m.group(1)
+            with self.state.lock:
+                known = sid in self.state.sessions
+            if not known:
+                self._send_json(404, {"error": "unknown session"})
+                return
+            content = (((payload or {}).get("message") or {}).get("content")) or ""
+            status = self.state.admit()
+            if status != 200:
+                self._send_error(status)
+                return
+            self.state.enter()
+            try:
+                time.sleep(random.uniform(*self.state.latency))
+            finally:
+                self.state.leave()
+            self._send_json(200, {
+                "id": sid,
+                "messages": [
+                    {"role": "USER", "content": content},
+                    {"role": "ASSISTANT", "content": ASSISTANT_REPLY},
+                ],
+            })
+            return
+
+        self._send_json(404, {"error": f"no route for {path}"})
+
+
+def make_server(host: str = HOST, port: int = PORT, latency=(LATENCY_MIN, LATENCY_MAX),
+                max_rps: float = 0, script=None, retry_after: float = 1.0,
+                session_script=None) -> ThreadingHTTPServer:
+    """Build (but do not start) a mock server; port=0 picks a free port."""
+    state = MockState(latency, max_rps=max_rps, script=script, retry_after=retry_after,
+                      session_script=session_script)
+    handler = type("BoundMockMetisHandler", (MockMetisHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--latency", type=float, nargs=2, default=(LATENCY_MIN, LATENCY_MAX),
+                        metavar=("MIN", "MAX"), help="Per-message latency range in seconds")
+    parser.add_argument("--max-rps", type=float, default=0, help="Quota: message calls per second (0 = unlimited)")
+    parser.add_argument("--script", default="", help="Comma-separated status codes for successive message calls")
+    parser.add_argument("--session-script", default="", help="Comma-separated status codes for successive session calls")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with 429/503")
+    args = parser.parse_args()
+
+    script = [int(c) for c in args.script.split(",") if c.strip()]
+    session_script = [int(c) for c in args.session_script.split(",") if c.strip()]
+    server = make_server(args.host, args.port, tuple(args.latency), max_rps=args.max_rps, script=script,
+                         retry_after=args.retry_after, session_script=session_script)
+    print(f"🧪 Mock Metis on http://{args.host}:{server.server_address[1]}  latency={tuple(args.latency)}s")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print("\n📊", server.RequestHandlerClass.state.summary())
+
+if __name__ == "__main__":
+    main()
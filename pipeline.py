@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming generate → judge → aggregate pipeline (one command instead of
+generate.py → verification/<METHOD>.vpack → test-api-final.py → dep-analyze.py).
+
+— How it works —
+1) Generation workers: the same run_case() as generate.py (redacted prompt → Metis
+   generation bot), cases of every --job interleaved round-robin.
+2) As soon as a generation result comes back, its verification prompt
+   (generate.build_verification_prompt) goes straight to the judge worker pool:
+   with --fast-judge, fast_judge.py decides clear-cut cases locally; the rest go to the Metis judge bot
+   with exactly the text test-api-final.py would send (so the response cache is
+   shared between the two flows).
+3) Every judgement is appended to <OUTPUT_ROOT>/results/judged/<METHOD>.jsonl (same
+   record shape as test-api-final.py, so dep-analyze.py still reads it) and feeds a
+   running judgments.RunningTally; CSVs are written to results/judged/<METHOD>/.
+   Generations and judgements also go to generate.py's result store (result_store.py).
+
+Stages overlap: while case N is being judged, later cases are still generating.
+Backpressure: at most 2×workers cases are in flight per stage, so memory stays flat.
+Nothing is re-read from disk. With WRITE_AUDIT the usual generate.py outputs
+(<METHOD>.jsonl, verification archive / per-case files) are still written as an audit trail.
+
+Resume: cases already in judged/<METHOD>.jsonl are skipped; generated-but-unjudged
+cases are generated again, which is free when the response cache is on.
+
+Usage:
+    python pipeline.py --job zero_shot_direct=prompts_zero_shot_direct.txt \\
+                       --job single_step_cot=prompts_single_step_cot.txt \\
+                       --out run_out --api-key K --bot-id GEN_BOT --judge-bot-id JUDGE_BOT
+    python pipeline.py --dry --input prompts_zero_shot_direct.txt    # no API calls
+"""
+
+import json
+import time
+import sqlite3
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import generate
+from generate import MethodJob, run_case, build_verification_prompt, parse_job, safe_mkdir, append_jsonl
+from metis_client import MetisClient, shared_client, close_clients
+from rate_limit import AdaptiveRateLimiter
+from checkpoint import Checkpoint
+from prompt_blocks import iter_blocks, parse_case, CaseHeader
+from fast_judge import FastJudge
+from judgments import RunningTally, write_count_csvs
+from metrics import Metrics
+
+
+# =============================================================================
+#                       ⚙️  EDITABLE CONSTANTS (TOP-OF-FILE)
+# =============================================================================
+
+# --- Judge bot (test-api-final.py's API_KEY / BOT_ID); key defaults to the generation key ---
+JUDGE_API_KEY   = ""
+JUDGE_BOT_ID    = ""
+
+GEN_WORKERS     = 4       # هم‌زمانی مرحلهٔ تولید
+JUDGE_WORKERS   = 4       # هم‌زمانی مرحلهٔ داوری
+WRITE_AUDIT     = True    # True → خروجی‌های معمول generate.py هم نوشته می‌شوند (برای ممیزی)
+FAST_JUDGE      = False   # True → موارد واضح محلی داوری می‌شوند (fast_judge.py)، پس از bench.py judge --verify
+PROGRESS_EVERY  = 25      # هر چند داوری یک خط وضعیت چاپ شود
+
+DRY_RUN_VERDICT = '{"TOP1":"UNSCORABLE","TOP3":"NO","TOP5":"NO","BEST":""}'
+
+
+# =============================================================================
+#                                 Judge stage
+# =============================================================================
+
+_FAST: Optional[FastJudge] = None
+_JUDGE_LIMITER: Optional[AdaptiveRateLimiter] = None   # the judge bot's own quota, one per run
+
+def _judge_client() -> MetisClient:
+    global _JUDGE_LIMITER
+    if _JUDGE_LIMITER is None:
+        _JUDGE_LIMITER = AdaptiveRateLimiter(generate.RATE_START, max_rate=generate.RATE_MAX)
+    return shared_client(
+        JUDGE_API_KEY or generate.METIS_API_KEY, JUDGE_BOT_ID, base_url=generate.API_BASE,
+        connect_timeout=generate.CONNECT_TIMEOUT, read_timeout=generate.READ_TIMEOUT,
+        max_retries=generate.MAX_RETRIES, session_pool=generate.SESSION_POOL,
+        limiter=_JUDGE_LIMITER,
+        cache=generate._response_cache(),
+    )
+
+def judge_result(idx: int, res: Dict[str, Any]) -> Tuple[str, Dict[str, Any], float]:
+    """
+    Worker side of the judge stage. Returns (status, record, seconds) with status
+    "ok" (record = test-api-final.py result shape) or "fail".
+    """
+    t0 = time.perf_counter()
+    cid = res["id"]
+    verif_text = build_verification_prompt(idx=cid, gt=res["gt"], assistant_output=res["output"])
+    # what test-api-final.py sends after extract_id_and_body(): everything below the ID line
+    body = verif_text.split("\n", 1)[1].lstrip("\n")
+
+    verdict = _FAST.judge_prompt(body) if _FAST is not None else None
+    if verdict is not None:
+        answer = {"content": json.dumps(verdict, ensure_ascii=False), "source": "fast_judge"}
+    elif generate.DRY_RUN:
+        answer = {"content": DRY_RUN_VERDICT, "source": "dry_run"}
+    else:
+        try:
+            client = _judge_client()
+            answer = client.cached(body)
+            if answer is None:
+                answer = client.send_message(client.acquire_session(), body)
+        except Exception as e:
+            return "fail", {"idx": idx, "dataset_id": cid, "error": f"judge_exc: {e!r}"}, time.perf_counter() - t0
+    return "ok", {"idx": idx, "dataset_id": cid, "answer": answer}, time.perf_counter() - t0
+
+
+# =============================================================================
+#                                  Pipeline
+# =============================================================================
+
+class PipelineJob:
+    """Per-method state: judged results + checkpoint, running tally, optional audit outputs."""
+
+    def __init__(self, method: str, prompt_path: Path, out_root: Path):
+        self.method = method
+        self.prompt_path = prompt_path
+        self.judged_dir = out_root / "results" / "judged"
+        safe_mkdir(self.judged_dir)
+        self.judged_path = self.judged_dir / f"{method}.jsonl"
+        self.fail_path = self.judged_dir / f"{method}.failures.jsonl"
+
+        self.ckpt = Checkpoint(self.judged_path, key_field="dataset_id")
+        self.done = set(self.ckpt.load())
+        self.tally = RunningTally()
+        if self.judged_path.exists():   # resumed run: totals include earlier judgements
+            with self.judged_path.open("r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.tally.add(json.loads(line))
+                    except ValueError:
+                        continue
+
+        self.store = generate._result_store(out_root)
+        self.model = generate.store_model(out_root)
+        self.audit = MethodJob(method, prompt_path, out_root) if WRITE_AUDIT else None
+        self.blocks = enumerate(iter_blocks(prompt_path, separators=(generate.SEP,)))
+        self.total = 0
+
+    def next_case(self) -> Optional[Tuple[int, str, CaseHeader]]:
+        for idx, block in self.blocks:
+            self.total += 1
+            case = parse_case(block)
+            cid = case.id or f"{self.method}_{idx:04d}"
+            if cid in self.done:
+                continue
+            self.done.add(cid)
+            return idx, cid, case
+        return None
+
+    def on_generated(self, res: Dict[str, Any]):
+        if self.audit is not None and res["id"] not in self.audit.done_ids:
+            if "error" not in res:
+                self.audit.done_ids.add(res["id"])
+            self.audit.write_result(res)
+        if self.audit is None:   # otherwise the audit MethodJob stores the generation row
+            self._store("generate", {"id": res["id"], "error": res["error"]} if "error" in res
+                        else {"id": res["id"], "gt": res["gt"], "output": res["output"]}, "id")
+        if "error" in res:
+            append_jsonl(self.fail_path, {"dataset_id": res["id"], "error": f"generate_exc: {res['error']}"})
+
+    def on_judged(self, status: str, record: Dict[str, Any]):
+        if status == "ok":
+            self.ckpt.append_result(record)
+            self.tally.add(record)
+        else:
+            append_jsonl(self.fail_path, record)
+        self._store("judge", record, "dataset_id")
+
+    def _store(self, stage: str, record: Dict[str, Any], key_field: str):
+        if self.store is None:
+            return
+        try:
+            self.store.add(self.model, self.method, stage, [record], key_field=key_field)
+        except sqlite3.Error as e:
+            print(f"⚠️ result store write failed ({e}); JSONL outputs are unaffected")
+
+    def close(self):
+        self.ckpt.close()
+        if self.audit is not None:
+            self.audit.close()
+        out_dir = self.judged_dir / self.method
+        safe_mkdir(out_dir)
+        write_count_csvs(self.tally.overall_row(), self.tally.department_rows(), out_dir)
+
+
+def run_pipeline(jobs: List[Tuple[str, Path]], out_root: Path,
+                 gen_workers: int = GEN_WORKERS, judge_workers: int = JUDGE_WORKERS):
+    global _FAST
+    if not generate.DRY_RUN and (not generate.METIS_API_KEY or not generate.METIS_BOT_ID or not JUDGE_BOT_ID):
+        raise RuntimeError("Missing API key, generation bot id or judge bot id.")
+    _FAST = FastJudge() if FAST_JUDGE else None
+
+    safe_mkdir(out_root / "results")
+    metrics = Metrics(out_root / "results" / "calls.metrics.jsonl", progress=generate.PROGRESS)
+    if not generate.DRY_RUN:
+        generate._client(generate.METIS_API_KEY, generate.METIS_BOT_ID).metrics = metrics
+        _judge_client().metrics = metrics
+
+    pjobs = [PipelineJob(method, path, out_root) for method, path in jobs]
+    gen_pool = ThreadPoolExecutor(max_workers=max(1, gen_workers), thread_name_prefix="gen")
+    judge_pool = ThreadPoolExecutor(max_workers=max(1, judge_workers), thread_name_prefix="judge")
+    gen_window, judge_window = 2 * max(1, gen_workers), 2 * max(1, judge_workers)
+    gen_pending: Dict[Any, Tuple[PipelineJob, int]] = {}
+    judge_pending: Dict[Any, PipelineJob] = {}
+    judged = 0
+
+    def cases():
+        active = list(pjobs)
+        while active:
+            for job in list(active):
+                nxt = job.next_case()
+                if nxt is None:
+                    active.remove(job)
+                    continue
+                yield (job,) + nxt
+
+    source = cases()
+    exhausted = False
+    try:
+        while True:
+            # feed the generation stage; stop while the judge stage is saturated (backpressure)
+            while not exhausted and len(gen_pending) < gen_window and len(judge_pending) < judge_window:
+                nxt = next(source, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                job, idx, cid, case = nxt
+                gen_pending[gen_pool.submit(run_case, cid, case)] = (job, idx)
+            if not gen_pending and not judge_pending:
+                break
+
+            for fut in wait(list(gen_pending) + list(judge_pending), return_when=FIRST_COMPLETED).done:
+                if fut in gen_pending:
+                    job, idx = gen_pending.pop(fut)
+                    res = fut.result()
+                    metrics.case(job.method, res["id"], ok="error" not in res, total_s=res["elapsed"],
+                                 cached=res.get("cached", False))
+                    job.on_generated(res)
+                    if "error" not in res:
+                        judge_pending[judge_pool.submit(judge_result, idx, res)] = job
+                else:
+                    job = judge_pending.pop(fut)
+                    status, record, seconds = fut.result()
+                    metrics.case(f"{job.method}/judge", record["dataset_id"], ok=status == "ok", total_s=seconds)
+                    job.on_judged(status, record)
+                    judged += 1
+                    if PROGRESS_EVERY and judged % PROGRESS_EVERY == 0:
+                        print(f"  … {job.method}: {job.tally.line()}")
+    except KeyboardInterrupt:
+        print("\n🛑 Interrupted by user. Judged cases are saved; the rest resume next run.")
+        gen_pool.shutdown(wait=False, cancel_futures=True)
+        judge_pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        gen_pool.shutdown(wait=True)
+        judge_pool.shutdown(wait=True)
+        for job in pjobs:
+            job.close()
+        metrics.close()
+        generate.close_result_store()
+
+    if _FAST is not None:
+        print(f"⚡ {_FAST.summary()}")
+    if not generate.DRY_RUN:
+        print(f"⏱  generate {generate._client(generate.METIS_API_KEY, generate.METIS_BOT_ID).limiter.summary()}")
+        print(f"⏱  judge    {_judge_client().limiter.summary()}")
+        if generate._response_cache() is not None:
+            print(f"🗄  {generate._response_cache().summary()}")
+    print(f"📈 {metrics.summary()}")
+    close_clients()
+    for job in pjobs:
+        print(f"✔ {job.method}: {job.total} prompts | {job.tally.line()}")
+
+
+def main():
+    global JUDGE_API_KEY, JUDGE_BOT_ID, WRITE_AUDIT, FAST_JUDGE
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input",  default=generate.INPUT_FILE,  help="Path to prompts file")
+    parser.add_argument("--out",    default=generate.OUTPUT_ROOT, help="Output root dir")
+    parser.add_argument("--method", default=generate.METHOD,      help="Method name")
+    parser.add_argument("--job", action="append", type=parse_job, metavar="METHOD=PATH",
+                        help="Repeatable; several methods in one pass (overrides --input/--method)")
+    parser.add_argument("--dry", action="store_true", help="No API calls (mock generation, local/dummy judge)")
+    parser.add_argument("--gen-workers", type=int, default=GEN_WORKERS)
+    parser.add_argument("--judge-workers", type=int, default=JUDGE_WORKERS)
+    parser.add_argument("--api-base", default=generate.API_BASE, help="Metis base URL (e.g. a local mock server)")
+    parser.add_argument("--api-key", default=generate.METIS_API_KEY)
+    parser.add_argument("--bot-id", default=generate.METIS_BOT_ID, help="Generation bot")
+    parser.add_argument("--judge-api-key", default=JUDGE_API_KEY, help="Defaults to --api-key")
+    parser.add_argument("--judge-bot-id", default=JUDGE_BOT_ID, help="Judge bot")
+    parser.add_argument("--no-audit", action="store_true", help="Skip generate.py's per-method output files")
+    parser.add_argument("--fast-judge", action="store_true", help="Decide clear-cut verifications locally (fast_judge.py)")
+    parser.add_argument("--no-fast-judge", action="store_true", help="Send every verification to the judge bot")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the API (no response cache)")
+    parser.add_argument("--progress", action="store_true", help="Live progress line on stderr")
+    args = parser.parse_args()
+
+    generate.DRY_RUN = generate.DRY_RUN or args.dry
+    generate.API_BASE = args.api_base.rstrip("/")
+    generate.METIS_API_KEY = args.api_key
+    generate.METIS_BOT_ID = args.bot_id
+    generate.PROGRESS = generate.PROGRESS or args.progress
+    if args.no_cache:
+        generate.CACHE_DIR = ""
+    JUDGE_API_KEY = args.judge_api_key
+    JUDGE_BOT_ID = args.judge_bot_id
+    WRITE_AUDIT = WRITE_AUDIT and not args.no_audit
+    FAST_JUDGE = (FAST_JUDGE or args.fast_judge) and not args.no_fast_judge
+
+    jobs = args.job or [(args.method, Path(args.input).expanduser().resolve())]
+    run_pipeline(jobs, Path(args.out).expanduser().resolve(), args.gen_workers, args.judge_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming reader for separator-delimited prompt / verification files.
+
+The prompt files (generate.py input), the notebooks' verify_*.txt files and the
+generate.py bundles (<METHOD>.all.txt) are all "blocks separated by a line that is
+exactly a separator" — 22 '=' or 80 '-'. Instead of read_text() + re.split() over
+the whole file, iter_blocks() reads the file line by line through a large buffer
+and yields each block as soon as its closing separator (or EOF) is seen, so memory
+stays at one block and the first case starts immediately.
+
+Separator detection is lazy: the first line equal to one of the candidate
+separators fixes the separator for the rest of the file; any other candidate seen
+afterwards is ordinary block content.
+
+Case headers (generate.py input blocks) are parsed by parse_case() in ONE walk over
+the block's lines: it returns the DxBench id, the GT line, the redacted body for the
+API and the header line offsets together. Its output is byte-identical to
+generate.extract_id / extract_gt / redact_id_and_gt_for_api (see bench.py header).
+
+Usage:
+    for block in iter_blocks(path, separators=(SEP_EQ, SEP_DASH)):
+        case = parse_case(block)
+        ...
+"""
+
+import re
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Sequence, Union
+
+
+SEP_EQ   = "=" * 22    # prompts_*.txt / verify_*.txt (notebooks)
+SEP_DASH = "-" * 80    # generate.py <METHOD>.all.txt bundles
+
+READ_BUFFER = 1 << 20  # 1 MiB read buffer
+
+
+def iter_blocks(path: Union[str, Path], separators: Sequence[str] = (SEP_EQ,),
+                encoding: str = "utf-8") -> Iterator[str]:
+    """
+    Yield non-blank blocks one at a time. A separator line is a line whose text,
+    ignoring trailing whitespace, equals the separator (same rule as the old
+    `(?m)^SEP\\s*$` split). Blank-only blocks are skipped, as before.
+    """
+    sep: Optional[str] = separators[0] if len(separators) == 1 else None
+    buf = []
+    with open(path, "r", encoding=encoding, buffering=READ_BUFFER) as f:
+        for line in f:
+            s = line.rstrip()
+            if sep is None and s in separators:
+                sep = s
+            if s == sep:
+                block = "".join(buf)
+                buf.clear()
+                if block.strip():
+                    yield block
+                continue
+            buf.append(line)
+    block = "".join(buf)
+    if block.strip():
+        yield block
+
+
+# =============================================================================
+#                       Case header: ID / GT / redaction
+# =============================================================================
+
+ID_LINE = re.compile(r"^\s*(dxbench|DxBench)[_\- ]?(\d+)\s*$", re.IGNORECASE)
+
+STOP_HEADERS = [
+    r"^\s*Patient\s+Symptoms\s*:?",
+    r"^\s*Explicit\s+Symptoms\s*:?",
+    r"^\s*Implicit\s+Symptoms\s*:?",
+    r"^\s*Symptoms\s*:?",
+    r"^\s*Clinical\s+Notes\s*:?",
+    r"^\s*Case\s*:?",
+]
+STOP_RE = re.compile("|".join(STOP_HEADERS), re.IGNORECASE)
+
+GT_FALLBACK_LINES = 5   # no Symptoms/Case header → GT must be in the first 5 lines
+
+
+class CaseHeader(NamedTuple):
+    id: Optional[str]      # "dxbench_<n>" or None
+    gt: str                # ground-truth line ("" if none)
+    body: str              # block with ID + GT removed (what the API sees)
+    id_line: int           # line offsets inside the block; -1 = not present
+    gt_line: int
+    stop_line: int         # first Symptoms/Case header line
+
+
+def parse_case(block: str) -> CaseHeader:
+    """
+    Single pass over the block's lines. Until the first STOP header is seen we
+    track both redaction rules of redact_id_and_gt_for_api (header mode and the
+    no-header fallback) as sets of dropped line indices; the STOP header (or EOF)
+    decides which one applies. Lines after the header are only checked for an
+    ID line if none was found yet (extract_id scans the whole block).
+    """
+    lines = block.splitlines()
+
+    cid = None
+    id_line = -1
+    first_text = -1        # first non-empty, non-ID line before the header (= GT)
+    stop_line = -1
+
+    drop_hdr = []          # header mode: every ID line + first_text
+    drop_nohdr = []        # fallback: ID lines until GT, then the first text line after an ID
+    saw_id = False
+    nohdr_gt_done = False
+
+    for i, ln in enumerate(lines):
+        if stop_line < 0 and STOP_RE.search(ln):
+            stop_line = i
+            if cid is not None:
+                break
+            continue
+
+        if stop_line >= 0:
+            # body: only needed to find a late ID line
+            m = ID_LINE.match(ln.strip())
+            if m:
+                cid, id_line = f"dxbench_{m.group(2)}", i
+                break
+            continue
+
+        s = ln.strip()
+        is_id = ID_LINE.match(s)
+        if is_id:
+            if cid is None:
+                cid, id_line = f"dxbench_{is_id.group(2)}", i
+            drop_hdr.append(i)
+            if not nohdr_gt_done:
+                saw_id = True
+                drop_nohdr.append(i)
+            continue
+        if s:
+            if first_text < 0:
+                first_text = i
+                drop_hdr.append(i)
+            if saw_id and not nohdr_gt_done:
+                nohdr_gt_done = True
+                drop_nohdr.append(i)
+
+    if stop_line >= 0:
+        dropped = set(drop_hdr)
+        gt_line = first_text
+    else:
+        dropped = set(drop_nohdr)
+        gt_line = first_text if 0 <= first_text < GT_FALLBACK_LINES else -1
+
+    kept = [ln for i, ln in enumerate(lines) if i not in dropped] if dropped else lines
+    body = "\n".join(kept).strip() + "\n"
+    gt = lines[gt_line].strip() if gt_line >= 0 else ""
+    return CaseHeader(cid, gt, body, id_line, gt_line, stop_line)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive rate control for Metis calls, shared by generate.py and test-api-final.py
+(through metis_client.MetisClient).
+
+— How it works —
+* Pacing: requests are released on a schedule of one every 1/rate seconds
+  (a token bucket with burst 1), no matter how many worker threads are waiting,
+  so concurrent workers do not fire in lockstep.
+* AIMD: every successful call raises the rate by RATE_STEP req/s (additive
+  increase, up to RATE_MAX); a 429 multiplies it by RATE_BACKOFF (multiplicative
+  decrease, at most once per ~2 request intervals so a burst of 429s counts once). The rate
+  settles just under what the endpoint will sustain.
+* Retry-After: a 429/503 carrying Retry-After (seconds or HTTP date) pauses ALL
+  callers until then, not only the thread that received it.
+* Jitter: retry sleeps use "full jitter" (uniform in [0, base·2^attempt]) and a
+  small random spread on top of Retry-After, so retries do not synchronise.
+
+Check it against the mock server:
+    python mock_metis_server.py --max-rps 3 --latency 0.05 0.1
+"""
+
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+
+RATE_START   = 2.0    # req/s at start
+RATE_MIN     = 0.2
+RATE_MAX     = 50.0
+RATE_STEP    = 0.25   # additive increase per success (req/s)
+RATE_BACKOFF = 0.5    # multiplicative decrease on 429
+BACKOFF_BASE = 0.5    # seconds, retry sleep base (× 2^attempt, jittered)
+BACKOFF_CAP  = 30.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After header → seconds to wait (None if absent/unparseable)."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """Thread-safe paced token bucket with AIMD rate adaptation."""
+
+    def __init__(self, rate: float = RATE_START, min_rate: float = RATE_MIN, max_rate: float = RATE_MAX,
+                 step: float = RATE_STEP, backoff: float = RATE_BACKOFF):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.step = step
+        self.backoff_factor = backoff
+
+        self._lock = threading.Lock()
+        self._next_slot = 0.0      # monotonic time of the next free slot
+        self._pause_until = 0.0    # Retry-After pause (monotonic)
+        self._last_decrease = 0.0
+
+        self.calls = 0
+        self.throttled = 0
+        self.peak_rate = rate
+
+    def acquire(self):
+        """Block until this caller may send one request."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._pause_until)
+            self._next_slot = slot + 1.0 / self.rate
+            self.calls += 1
+        delay = slot - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+            self.peak_rate = max(self.peak_rate, self.rate)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        """Called on 429 (or 503 with Retry-After)."""
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            # at most one decrease per ~2 request intervals (≥ 1 s): a burst of
+            # 429s from requests already in flight is one congestion signal
+            if now - self._last_decrease >= max(1.0, 2.0 / self.rate):
+                self.rate = max(self.min_rate, self.rate * self.backoff_factor)
+                self._last_decrease = now
+            if retry_after is not None:
+                self._pause_until = max(self._pause_until, now + retry_after)
+
+    @staticmethod
+    def retry_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+        """Sleep before retry #attempt: Retry-After (+ small spread) or full-jitter backoff."""
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 0.1 * retry_after + 0.1)
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+    def summary(self) -> str:
+        with self._lock:
+            return (f"rate={self.rate:.2f} req/s (peak {self.peak_rate:.2f}), "
+                    f"calls={self.calls}, throttled={self.throttled}")
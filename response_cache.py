@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk, content-addressed cache of Metis responses (generation and judge calls).
+
+Key  = sha256 of (bot id, exact prompt content, generation params), so re-running
+generate.py into a new OUTPUT_ROOT, or re-judging after deleting a broken JSONL,
+reuses every answer already paid for. Only successful (2xx) JSON responses are
+stored.
+
+Layout:   <CACHE_DIR>/<key[:2]>/<key>.json    (one file per response)
+Eviction: least-recently-used first once the total size exceeds max_bytes. Recency
+          survives restarts because a hit bumps the file's mtime.
+Stats:    hits / misses / stores / evictions → summary() at the end of a run.
+
+Usage:
+    cache = ResponseCache(Path("~/.cache/dx-metis").expanduser(), max_bytes=512 << 20)
+    key = cache.key(bot_id, content)
+    resp = cache.get(key)
+    if resp is None:
+        resp = call_api(...)
+        cache.put(key, resp)
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+CACHE_MAX_BYTES = 512 << 20   # 512 MiB
+
+
+class ResponseCache:
+    """Thread-safe size-bounded LRU cache of JSON responses on disk."""
+
+    def __init__(self, root: Path, max_bytes: int = CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, int]" = OrderedDict()   # key → size, oldest first
+        self.total_bytes = 0
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self._load_index()
+
+    # ---- keys ------------------------------------------------------------------
+
+    @staticmethod
+    def key(bot_id: str, content: str, params: Optional[Dict[str, Any]] = None) -> str:
+        blob = json.dumps([bot_id, content, params or {}], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.json"
+
+    # ---- index -----------------------------------------------------------------
+
+    def _load_index(self):
+        entries = []
+        for p in self.root.glob("*/*.json"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime, p.stem, st.st_size))
+        for _, key, size in sorted(entries):
+            self._lru[key] = size
+            self.total_bytes += size
+
+    # ---- get / put -------------------------------------------------------------
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key not in self._lru:
+                self.misses += 1
+                return None
+            self._lru.move_to_end(key)
+        p = self._path(key)
+        try:
+            value = json.loads(p.read_text(encoding="utf-8"))
+            os.utime(p)   # persist recency for the next run
+        except (OSError, ValueError):
+            with self._lock:
+                self.total_bytes -= self._lru.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: Dict[str, Any]):
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        p = self._path(key)
+        p.parent.mkdir(exist_ok=True)
+        tmp = p.with_name(f"{p.name}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, p)   # atomic: readers never see half a file
+        with self._lock:
+            self.total_bytes += len(data) - self._lru.pop(key, 0)
+            self._lru[key] = len(data)
+            self.stores += 1
+            self._evict()
+
+    def _evict(self):
+        """Caller holds self._lock."""
+        while self.total_bytes > self.max_bytes and len(self._lru) > 1:
+            key, size = self._lru.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def summary(self) -> str:
+        with self._lock:
+            looked_up = self.hits + self.misses
+            rate = 100.0 * self.hits / looked_up if looked_up else 0.0
+            return (f"cache: hits={self.hits} misses={self.misses} ({rate:.1f}% hit) "
+                    f"stores={self.stores} evictions={self.evictions} "
+                    f"size={self.total_bytes / (1 << 20):.1f} MiB / {self.max_bytes / (1 << 20):.0f} MiB")
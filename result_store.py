@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Indexed result store (SQLite) shared by generate.py, test-api-final.py, pipeline.py
+and dep-analyze.py.
+
+The JSONL files stay (resume checkpoints and older tools read them); every record
+written to them is also written here, once, with the case key normalised:
+
+    results(model, method, stage, case_id,      -- PRIMARY KEY; stage = 'generate' | 'judge'
+            dxbench_id,                         -- number of a dxbench_<n> id (481), NULL for other ids
+            ok, gt, output, top1, top3, top5, error, record, ts)
+
+    index (model, method, dxbench_id)   → one run, or one case of one run
+    index (dxbench_id)                  → "all outputs for case 481" across models/methods
+    partial index on failures (ok = 0)  → "failures for method X"
+
+— How it works —
+* case_id is what the script keys its checkpoint on (generate: id, judge: idx).
+  A later success for the same key replaces the failure row, so ok = 0 rows are the
+  cases that are still failing.
+* Judge rows carry TOP1/TOP3/TOP5 already parsed from answer.content
+  (judgments.parse_content), so dep-analyze.py --store counts without any JSON work.
+* WAL mode: readers (dep-analyze.py, queries) never block the running scripts, and
+  several scripts may write to one shared store file. Every add() call is one
+  transaction (generate.py calls it once per ResultWriter group commit).
+
+Usage:
+    store = ResultStore(out_dir / "results.sqlite")
+    store.add("meerkat", "single_step_cot", "judge", [record, ...], key_field="idx")
+    store.case(481); store.failures(method="single_step_cot"); store.runs()
+
+    python result_store.py results.sqlite runs
+    python result_store.py results.sqlite case 481
+    python result_store.py results.sqlite failures --method single_step_cot
+"""
+
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from judgments import ID_KEYS, parse_content
+from prompt_blocks import ID_LINE
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    model      TEXT    NOT NULL,
+    method     TEXT    NOT NULL,
+    stage      TEXT    NOT NULL,
+    case_id    TEXT    NOT NULL,
+    dxbench_id INTEGER,
+    ok         INTEGER NOT NULL,
+    gt         TEXT,
+    output     TEXT,
+    top1       TEXT,
+    top3       TEXT,
+    top5       TEXT,
+    error      TEXT,
+    record     TEXT    NOT NULL,
+    ts         REAL    NOT NULL,
+    PRIMARY KEY (model, method, stage, case_id)
+);
+CREATE INDEX IF NOT EXISTS results_run  ON results (model, method, dxbench_id);
+CREATE INDEX IF NOT EXISTS results_case ON results (dxbench_id);
+CREATE INDEX IF NOT EXISTS results_fail ON results (method, stage) WHERE ok = 0;
+"""
+
+COLUMNS = ("model", "method", "stage", "case_id", "dxbench_id", "ok", "gt", "output",
+           "top1", "top3", "top5", "error", "record", "ts")
+STAGES = ("generate", "judge")
+
+
+def dxbench_number(record: Dict[str, Any]) -> Optional[int]:
+    """
+    481 for a record whose id is "dxbench_481" (any ID_KEYS field, or the same in meta).
+    None for any other id — e.g. generate.py's fallback "zero_shot_direct_0004" for a case
+    without an ID line — so its trailing number never lands in the dxbench_id index.
+    """
+    for src in (record, record.get("meta") or record.get("metadata") or {}):
+        for key in ID_KEYS:
+            m = ID_LINE.match(str(src.get(key) or ""))
+            if m:
+                return int(m.group(2))
+    return None
+
+def _verdict(record: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """TOP1/TOP3/TOP5 as judgments.count_judgment reads them (None = content is not a JSON object)."""
+    inner = parse_content((record.get("answer") or {}).get("content"))
+    if not isinstance(inner, dict):
+        return None, None, None
+    return tuple((inner.get(f) or "").strip().upper() for f in ("TOP1", "TOP3", "TOP5"))
+
+def _row(model: str, method: str, stage: str, record: Dict[str, Any], key_field: str, now: float) -> tuple:
+    ok = "error" not in record
+    top1 = top3 = top5 = None
+    if stage == "judge" and ok:
+        top1, top3, top5 = _verdict(record)
+    err = record.get("error")
+    return (model, method, stage, str(record.get(key_field)), dxbench_number(record), int(ok),
+            record.get("gt"), record.get("output"), top1, top3, top5,
+            None if err is None else str(err), json.dumps(record, ensure_ascii=False), now)
+
+
+class ResultStore:
+    """Thread-safe SQLite sink + indexed queries over all results."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.executescript(SCHEMA)
+
+    # ---- writing ---------------------------------------------------------------
+
+    def add(self, model: str, method: str, stage: str, records: Iterable[Dict[str, Any]], key_field: str = "id"):
+        """Insert/replace records of one run in a single transaction (failures: records with "error")."""
+        if stage not in STAGES:
+            raise ValueError(f"stage must be one of {STAGES}, got {stage!r}")
+        now = time.time()
+        rows = [_row(model, method, stage, r, key_field, now) for r in records]
+        if not rows:
+            return
+        with self._lock, self._db:
+            self._db.executemany(
+                f"INSERT OR REPLACE INTO results ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                rows)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # ---- queries (all served by an index) -------------------------------------
+
+    def _query(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def case(self, dxbench_id: int) -> List[sqlite3.Row]:
+        """Every stored row (all models, methods, stages) of one DxBench case."""
+        return self._query("SELECT * FROM results WHERE dxbench_id = ? ORDER BY model, method, stage",
+                           (int(dxbench_id),))
+
+    def failures(self, method: Optional[str] = None, stage: Optional[str] = None) -> List[sqlite3.Row]:
+        """Cases whose latest outcome is a failure."""
+        sql, params = "SELECT * FROM results WHERE ok = 0", []
+        if method is not None:
+            sql += " AND method = ?"
+            params.append(method)
+        if stage is not None:
+            sql += " AND stage = ?"
+            params.append(stage)
+        return self._query(sql + " ORDER BY method, stage, dxbench_id", tuple(params))
+
+    def run(self, model: str, method: str, stage: str = "judge") -> List[sqlite3.Row]:
+        return self._query("SELECT * FROM results WHERE model = ? AND method = ? AND stage = ? "
+                           "ORDER BY dxbench_id", (model, method, stage))
+
+    def runs(self, stage: Optional[str] = None) -> List[sqlite3.Row]:
+        """(model, method, stage, n, failed) for every run in the store."""
+        sql = "SELECT model, method, stage, COUNT(*) AS n, SUM(ok = 0) AS failed FROM results"
+        params: tuple = ()
+        if stage is not None:
+            sql += " WHERE stage = ?"
+            params = (stage,)
+        return self._query(sql + " GROUP BY model, method, stage ORDER BY model, method, stage", params)
+
+    def verdicts(self, model: Optional[str] = None) -> Iterator[Tuple[str, str, Optional[int], Any, Any, Any]]:
+        """(model, method, dxbench_id, top1, top3, top5) of every successful judgement, run by run."""
+        sql, params = "SELECT model, method, dxbench_id, top1, top3, top5 FROM results WHERE stage = 'judge' AND ok = 1", ()
+        if model is not None:
+            sql += " AND model = ?"
+            params = (model,)
+        for r in self._query(sql + " ORDER BY model, method", params):
+            yield tuple(r)
+
+    def summary(self) -> str:
+        rows = self.runs()
+        return f"result store {self.path}: " + (
+            "; ".join(f"{r['model']}/{r['method']} {r['stage']} {r['n']} ({r['failed']} failed)" for r in rows)
+            or "empty")
+
+
+# =============================================================================
+#                                    CLI
+# =============================================================================
+
+def _print_rows(rows: List[sqlite3.Row], fields: Tuple[str, ...]):
+    for r in rows:
+        print("  " + " | ".join(f"{r[f]}" if len(str(r[f])) <= 80 else str(r[f])[:77] + "..." for f in fields))
+    print(f"({len(rows)} rows)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Query a result store")
+    parser.add_argument("db", help="results.sqlite")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("runs", help="Row / failure counts per model, method and stage")
+    p = sub.add_parser("case", help="All outputs and verdicts for one DxBench case")
+    p.add_argument("dxbench_id", type=int)
+    p = sub.add_parser("failures", help="Cases whose latest outcome is a failure")
+    p.add_argument("--method")
+    p.add_argument("--stage", choices=STAGES)
+    args = parser.parse_args()
+
+    store = ResultStore(Path(args.db))
+    try:
+        if args.cmd == "runs":
+            _print_rows(store.runs(), ("model", "method", "stage", "n", "failed"))
+        elif args.cmd == "case":
+            _print_rows(store.case(args.dxbench_id),
+                        ("model", "method", "stage", "case_id", "gt", "top1", "top3", "top5", "output", "error"))
+        else:
+            _print_rows(store.failures(args.method, args.stage),
+                        ("model", "method", "stage", "case_id", "dxbench_id", "error"))
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
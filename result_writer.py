@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Group-commit writer for the per-case outputs of generate.py.
+
+Per case, generate.py produces three things: a record in <METHOD>.jsonl (+ its
+checkpoint line), a verification prompt appended to the packed archive <METHOD>.vpack
+(verification_archive.py) or the legacy <METHOD>.all.txt bundle and, optionally,
+verification/<METHOD>/<id>.txt. Writing them one case at a time means several file
+opens and flushes per case. ResultWriter keeps the files open, buffers cases in
+memory and commits them as a group when COMMIT_EVERY cases are pending or the
+oldest pending case is COMMIT_INTERVAL seconds old (a background thread enforces
+the time bound).
+
+— Durability (DURABILITY) —
+    "flush"  each commit is handed to the OS (survives a crash of this process)
+    "fsync"  each commit is also fsync'ed (survives power loss / OS crash)
+Cases still pending in memory are lost on a hard crash and are simply re-run on
+resume, because they are not in the checkpoint yet.
+
+— Commit order —
+verification archive / bundle / per-case files and failures first, then results JSONL
+and checkpoint. A crash in between can at worst leave a verification entry for a case
+that will be re-run (duplicate entry; the archive index keeps the latest), never a
+"done" case without its verification prompt. The optional `store` callback (result_store.py) gets each
+group last, as one call, so it never holds a case the checkpoint does not.
+
+All methods are thread-safe, so workers may call add() directly.
+"""
+
+import os
+import sys
+import time
+import json
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from checkpoint import Checkpoint
+from verification_archive import VerificationArchive, BUNDLE_SEP
+
+
+COMMIT_EVERY    = 32      # cases per group commit
+COMMIT_INTERVAL = 2.0     # seconds a case may wait in memory
+DURABILITY      = "flush" # "flush" | "fsync"
+
+
+class ResultWriter:
+    """Buffers (record, verification text) pairs and commits them in groups."""
+
+    def __init__(self, ckpt: Checkpoint, bundle_path: Optional[Path], fail_path: Path,
+                 case_dir: Optional[Path] = None, commit_every: int = COMMIT_EVERY,
+                 commit_interval: float = COMMIT_INTERVAL, durability: str = DURABILITY,
+                 store: Optional[Callable[[List[Dict[str, Any]]], None]] = None,
+                 archive_path: Optional[Path] = None):
+        if durability not in ("flush", "fsync"):
+            raise ValueError(f"durability must be 'flush' or 'fsync', got {durability!r}")
+        self.ckpt = ckpt
+        self.ckpt.fsync = durability == "fsync"
+        self.case_dir = case_dir
+        self.commit_every = max(1, commit_every)
+        self.commit_interval = commit_interval
+        self.fsync = durability == "fsync"
+        self.store = store
+
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Dict[str, Any], str, Dict[str, Any]]] = []
+        self._failures: List[Dict[str, Any]] = []
+        self._oldest: Optional[float] = None
+        self._bundle_f = bundle_path.open("a", encoding="utf-8") if bundle_path is not None else None
+        self._archive = VerificationArchive(archive_path, writable=True, fsync=self.fsync) if archive_path else None
+        self._fail_path = fail_path
+        self._fail_f = None   # opened on the first failure only
+        self.commits = 0
+
+        self._stop = threading.Event()
+        self._timer = None
+        if commit_interval > 0:
+            self._timer = threading.Thread(target=self._tick, name="result-writer", daemon=True)
+            self._timer.start()
+
+    # ---- public ----------------------------------------------------------------
+
+    def add(self, record: Dict[str, Any], verif_text: str, stored: Optional[Dict[str, Any]] = None):
+        """Queue one finished case (its JSONL record + verification prompt; `stored` = store row if it differs)."""
+        with self._lock:
+            self._pending.append((record, verif_text, stored or record))
+            self._touch()
+            if len(self._pending) >= self.commit_every:
+                self._commit()
+
+    def add_failure(self, obj: Dict[str, Any]):
+        with self._lock:
+            self._failures.append(obj)
+            self._touch()
+            if len(self._failures) >= self.commit_every:
+                self._commit()
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join(timeout=2)
+        with self._lock:
+            self._commit()
+            if self._bundle_f is not None:
+                self._bundle_f.close()
+            if self._archive is not None:
+                self._archive.close()
+            if self._fail_f is not None:
+                self._fail_f.close()
+
+    # ---- internals -------------------------------------------------------------
+
+    def _touch(self):
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def _tick(self):
+        while not self._stop.wait(self.commit_interval / 2):
+            with self._lock:
+                if self._oldest is not None and time.monotonic() - self._oldest >= self.commit_interval:
+                    try:
+                        self._commit()
+                    except Exception as e:   # disk full, permissions, ...: report, keep the timer alive
+                        print(f"⚠️ result writer: background commit failed: {type(e).__name__}: {e}", file=sys.stderr)
+
+    def _sync(self, f):
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+
+    def _commit(self):
+        """Caller holds self._lock."""
+        pending, self._pending = self._pending, []
+        failures, self._failures = self._failures, []
+        self._oldest = None
+        if not pending and not failures:
+            return
+
+        if failures:
+            if self._fail_f is None:
+                self._fail_f = self._fail_path.open("a", encoding="utf-8")
+            self._fail_f.write("".join(json.dumps(o, ensure_ascii=False) + "\n" for o in failures))
+            self._sync(self._fail_f)
+
+        if pending:
+            if self.case_dir is not None:
+                for record, verif_text, _ in pending:
+                    (self.case_dir / f"{record['id']}.txt").write_text(verif_text, encoding="utf-8")
+            if self._archive is not None:
+                self._archive.append_many((record["id"], verif_text) for record, verif_text, _ in pending)
+            if self._bundle_f is not None:
+                self._bundle_f.write("".join(verif_text + BUNDLE_SEP for _, verif_text, _ in pending))
+                self._sync(self._bundle_f)
+            self.ckpt.append_results([record for record, _, _ in pending])
+        if self.store is not None:
+            self.store([stored for _, _, stored in pending] + failures)
+        self.commits += 1
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Stop criteria that end decoding as soon as a structured diagnosis answer is complete,
+instead of running on to EOS / max_new_tokens (4000 in the Meerkat notebooks, 1400 in
+run_llm of Medical_Assistant-final.ipynb) while the model repeats "Step 3" blocks.
+
+Criteria (each one stateful, one set per sequence — see default_criteria()):
+    JsonObjectComplete     the answer is a JSON object ({... or ```json {...) and it closed
+    ClarifyingQuestionsEnd the "Clarifying Questions" list has ended (a non-item line after
+                           ≥ min_items items) or reached max_items items
+    RepeatedSectionHeader  a section header (Step N / Output Section N / Clarifying Questions)
+                           starts a second time
+
+— How it works —
+* IncrementalDecoder turns token ids into text as they arrive (decode of the last few
+  tokens only, held back while a multi-byte character is incomplete), so checking costs
+  O(new text) per token, not a decode of the whole answer.
+* Criteria only look at the new text: JsonObjectComplete keeps a brace depth / in-string
+  state, the line-based ones only parse lines that have just been completed.
+* A criterion that fires returns where the useful answer ends; the text is cut there
+  (the repeated header and everything after it are dropped), so _get_block no longer
+  has to pick the *last* "Step N".
+
+Usage:
+    engine = BatchEngine(model, tokenizer, stop=default_criteria)        # meerkat_engine.py
+    checker = StopChecker(tokenizer, default_criteria())                # any decode loop
+    for tok in tokens:
+        hit = checker.feed(tok)
+        if hit: answer = checker.text[:hit.end]; break
+    model.generate(**inputs, stopping_criteria=StoppingCriteriaList([StructuredStop(tokenizer, prompt_len)]))
+"""
+
+import re
+from typing import Callable, List, NamedTuple, Optional, Sequence
+
+from structured_output import loads
+
+
+# =============================================================================
+#                          Incremental detokenisation
+# =============================================================================
+
+class IncrementalDecoder:
+    """
+    Text of a growing token sequence. Each push decodes tokens[prefix:] and returns the
+    part not returned before; the prefix window gives SentencePiece tokenizers the context
+    they need for leading spaces, and a trailing U+FFFD (half a UTF-8 character) is held back.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.tokens: List[int] = []
+        self.text = ""
+        self._prefix = 0
+        self._read = 0
+
+    def _decode(self, ids: Sequence[int]) -> str:
+        return self.tokenizer.decode(ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token: int) -> str:
+        self.tokens.append(int(token))
+        before = self._decode(self.tokens[self._prefix:self._read])
+        now = self._decode(self.tokens[self._prefix:])
+        if len(now) <= len(before) or now.endswith("\ufffd"):
+            return ""
+        delta = now[len(before):]
+        self._prefix, self._read = self._read, len(self.tokens)
+        self.text += delta
+        return delta
+
+
+# =============================================================================
+#                                  Criteria
+# =============================================================================
+
+class StopHit(NamedTuple):
+    reason: str   # criterion name
+    end: int      # keep text[:end]
+
+
+class StopCriterion:
+    """Base class: check() sees the whole text so far and where the new part starts."""
+
+    name = "stop"
+
+    def check(self, text: str, start: int) -> Optional[int]:
+        """End offset of the complete answer, or None to keep going."""
+        raise NotImplementedError
+
+
+class _LineCriterion(StopCriterion):
+    """Calls on_line() once for every newly completed line."""
+
+    def __init__(self):
+        self._pos = 0   # start of the first line not yet seen complete
+
+    def check(self, text: str, start: int) -> Optional[int]:
+        while True:
+            nl = text.find("\n", self._pos)
+            if nl < 0:
+                return None
+            line_start, self._pos = self._pos, nl + 1
+            end = self.on_line(text[line_start:nl], line_start, nl + 1)
+            if end is not None:
+                return end
+
+    def on_line(self, line: str, line_start: int, line_end: int) -> Optional[int]:
+        raise NotImplementedError
+
+
+FENCE_OPEN = re.compile(r"\s*(?:```(?:json)?\s*)?\{", re.IGNORECASE)
+FENCE_PREFIX = re.compile(r"\s*(?:`{1,3}(?:j|js|jso|json)?\s*)?", re.IGNORECASE)   # could still become FENCE_OPEN
+
+class JsonObjectComplete(StopCriterion):
+    """The answer is a JSON object (optionally ```json-fenced) and its closing brace arrived."""
+
+    name = "json_complete"
+
+    def __init__(self):
+        self._open = None     # offset of the object's '{'; -1 = answer is not JSON
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def check(self, text: str, start: int) -> Optional[int]:
+        if self._open is None:
+            if FENCE_PREFIX.fullmatch(text):
+                return None   # nothing decisive yet
+            m = FENCE_OPEN.match(text)
+            self._open = m.end() - 1 if m else -1
+            self._pos = self._open
+        if self._open < 0:
+            return None
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                self._depth += 1
+            elif c == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._pos = len(text)
+                    try:
+                        loads(text[self._open:i + 1])
+                    except ValueError:
+                        self._open = -1   # not valid JSON after all: let other criteria decide
+                        return None
+                    return i + 1
+        self._pos = len(text)
+        return None
+
+
+QUESTIONS_HEADER = re.compile(   # a line that is only the header (optionally "Output Section II:", markdown)
+    r"(?i)^\s*(?:#+\s*|\*\*\s*)?(?:Output\s+Section\s+[IVX\d]+\s*[:\-–—]\s*)?(?:\*\*)?\s*"
+    r"Clarifying Questions(?:\s*to\s*Ask)?\s*(?:\*\*)?\s*:?\s*(?:\*\*)?\s*$")
+LIST_ITEM = re.compile(r"^\s*(?:[-*•]|\d+\.)\s*(.+)$")   # parse_questions' item rule
+
+class ClarifyingQuestionsEnd(_LineCriterion):
+    """
+    After a "Clarifying Questions" header: stop at the first unindented non-item line once
+    min_items questions are listed (that line is dropped), or right after the max_items-th.
+    Indented lines are continuations of the current item; blank lines are ignored.
+    """
+
+    name = "questions_end"
+
+    def __init__(self, min_items: int = 2, max_items: int = 5):
+        super().__init__()
+        self.min_items = min_items
+        self.max_items = max_items
+        self._in_list = False
+        self._items = 0
+
+    def on_line(self, line: str, line_start: int, line_end: int) -> Optional[int]:
+        if not self._in_list:
+            if QUESTIONS_HEADER.match(line):
+                self._in_list = True
+            return None
+        if LIST_ITEM.match(line):
+            self._items += 1
+            return line_end if self._items >= self.max_items else None
+        if not line.strip() or line[:1].isspace():
+            return None
+        return line_start if self._items >= self.min_items else None
+
+
+SECTION_HEADER = re.compile(
+    r"(?i)^\s*(?:#+\s*|\*\*\s*)?(step\s*\d+|output\s+section\s+[ivx\d]+|clarifying\s+questions)"
+    r"\b\s*(?:\*\*)?\s*(?:[:\-–—.(]|to\s+ask|$)")
+
+class RepeatedSectionHeader(_LineCriterion):
+    """A section header seen before starts again: the answer is cut just before it."""
+
+    name = "repeated_section"
+
+    def __init__(self):
+        super().__init__()
+        self._seen = set()
+
+    def on_line(self, line: str, line_start: int, line_end: int) -> Optional[int]:
+        m = SECTION_HEADER.match(line)
+        if m is None:
+            return None
+        key = re.sub(r"\s+", "", m.group(1).lower())
+        if key in self._seen:
+            return line_start
+        self._seen.add(key)
+        return None
+
+
+def default_criteria() -> List[StopCriterion]:
+    """A fresh set for one sequence (criteria are stateful)."""
+    return [JsonObjectComplete(), ClarifyingQuestionsEnd(), RepeatedSectionHeader()]
+
+
+# =============================================================================
+#                              Per-sequence checker
+# =============================================================================
+
+class StopChecker:
+    """Decodes one sequence incrementally and runs its criteria on every new piece of text."""
+
+    def __init__(self, tokenizer, criteria: Sequence[StopCriterion]):
+        self.decoder = IncrementalDecoder(tokenizer)
+        self.criteria = list(criteria)
+        self.hit: Optional[StopHit] = None
+
+    @property
+    def text(self) -> str:
+        return self.decoder.text
+
+    def feed(self, token: int) -> Optional[StopHit]:
+        start = len(self.decoder.text)
+        if not self.decoder.push(token) or self.hit is not None:
+            return self.hit
+        text = self.decoder.text
+        for c in self.criteria:
+            end = c.check(text, start)
+            if end is not None:
+                self.hit = StopHit(c.name, end)
+                break
+        return self.hit
+
+    def answer(self) -> str:
+        """The text so far, cut where a criterion fired."""
+        return self.text if self.hit is None else self.text[:self.hit.end]
+
+
+# =============================================================================
+#                       transformers.generate() adapter
+# =============================================================================
+
+try:
+    import torch
+    from transformers import StoppingCriteria
+except ImportError:   # optional: only the adapter needs them
+    torch = None
+    StoppingCriteria = object
+
+
+class StructuredStop(StoppingCriteria):
+    """
+    stopping_criteria for model.generate (e.g. run_llm): one StopChecker per batch row,
+    fed with the tokens generated since the last call. answer(row) gives the cut text.
+    """
+
+    def __init__(self, tokenizer, prompt_len: int, make_criteria: Callable[[], List[StopCriterion]] = default_criteria):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.make_criteria = make_criteria
+        self.checkers: List[StopChecker] = []
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if not self.checkers:
+            self.checkers = [StopChecker(self.tokenizer, self.make_criteria()) for _ in range(input_ids.shape[0])]
+        done = []
+        for row, checker in enumerate(self.checkers):
+            fed = self.prompt_len + len(checker.decoder.tokens)
+            for tok in input_ids[row, fed:].tolist():
+                checker.feed(tok)
+            done.append(checker.hit is not None)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    def answer(self, row: int = 0) -> Optional[str]:
+        """Cut text of a row that stopped early (None if it ended on EOS / max_new_tokens)."""
+        if not self.checkers or self.checkers[row].hit is None:
+            return None
+        return self.checkers[row].answer()
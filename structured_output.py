@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Structured-output extraction shared by generate.py (assistant text from a Metis
+response) and the judgement analysis (JSON verdict inside answer.content).
+
+— How it works —
+* loads(): orjson when it is installed (x1.4 on a 5000-line results JSONL in
+  `bench.py extract --input`), otherwise json. Anything orjson rejects (NaN, > 64-bit ints, ...) is
+  retried with json.loads, so results are identical either way.
+* parse_content(): strip ``` fences; a content that is exactly one JSON object is
+  parsed directly (the usual judge answer). Otherwise last_json_object() finds the
+  last balanced {...} in the text, e.g. the final verdict after a chain of thought.
+* last_json_object(): one left-to-right pass with a brace/string state machine.
+  Outside any object only '{' followed by a key or '}' opens one (one compiled regex,
+  so prose and prose braces like "{k}" are skipped at C speed); inside, the next
+  '{', '}' or '"' is found by regex and a string is jumped over in one match (escapes
+  included), so braces in strings do not count and quotes in the surrounding prose
+  cannot desynchronise it. Every balanced {...} span is recorded; only the last one
+  closed is parsed. If it is not JSON, the spans closed before it are tried from the
+  end, skipping those inside a span that already failed — the text parsed is at most
+  the whole text once, so a chain of unclosed '{"a": ' costs one pass and no parse.
+
+The previous rule (fences, then a greedy {.*} from the first '{' to the last '}')
+gives the same object whenever it parsed at all; the scanner additionally recovers
+answers where prose or a second {...} surrounds the verdict.
+`python bench.py extract` checks both on the same corpus and times them: x10–14 on the
+synthetic chain-of-thought corpus, most of it from strip_fences() (FENCE's trailing
+\s*``` is retried at every offset of a long text, slicing only looks at the ends).
+"""
+
+import re
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:   # optional: plain json is used
+    orjson = None
+
+
+FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)   # حذف ```/```json
+OBJECT_START = re.compile(r'\{\s*["}]')   # a JSON object opens with a key or is empty
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(s) -> Any:
+    """json.loads with the optional orjson fast path (same result, same ValueError on bad input)."""
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except (orjson.JSONDecodeError, TypeError):
+            pass
+    return json.loads(s)
+
+def strip_fences(raw: Any) -> str:
+    """Same result as FENCE.sub("", ...) — but FENCE's trailing \\s*``` is tried at every
+    offset of a long chain of thought; slicing only looks at the two ends."""
+    s = str(raw).strip()
+    if s.startswith("```"):
+        s = s[3:]
+        if s[:4].lower() == "json":
+            s = s[4:]
+        s = s.lstrip()
+    if s.endswith("```"):
+        s = s[:-3]
+    return s.strip()
+
+
+_TOKEN = re.compile(r'[{}"]')
+_STRING_REST = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)   # after the opening quote
+
+def _closed_spans(text: str) -> List[Tuple[int, int]]:
+    """(start, end) of every balanced {...} in text, in the order they close."""
+    spans: List[Tuple[int, int]] = []
+    stack: List[int] = []
+    pos = 0
+    while True:
+        if not stack:
+            m = OBJECT_START.search(text, pos)
+            if m is None:
+                return spans
+            stack.append(m.start())
+            pos = m.start() + 1
+            continue
+        m = _TOKEN.search(text, pos)
+        if m is None:
+            return spans
+        pos = m.end()
+        c = m.group()
+        if c == '"':
+            m = _STRING_REST.match(text, pos)
+            if m is None:
+                return spans   # unterminated string: nothing after it can close an object
+            pos = m.end()
+        elif c == "{":
+            stack.append(m.start())
+        else:
+            spans.append((stack.pop(), pos))
+
+def last_json_object(text: str) -> Optional[Dict[str, Any]]:
+    """The last balanced {...} in text that parses as JSON, or None."""
+    limit = len(text)   # spans ending after this lie inside one that failed to parse
+    for start, end in reversed(_closed_spans(text)):
+        if end > limit:
+            continue
+        try:
+            return loads(text[start:end])
+        except (ValueError, RecursionError):
+            limit = start
+    return None
+
+def parse_content(raw: Any) -> Optional[Any]:
+    """raw = answer.content (ممکن است بلاک مارک‌داون یا متن اضافه داشته باشد). خروجی: JSON داخلی یا None."""
+    if raw is None:
+        return None
+    s = strip_fences(raw)
+    if s.startswith("{") and s.endswith("}"):
+        try:
+            return loads(s)
+        except (ValueError, RecursionError):
+            pass
+    return last_json_object(s)
+
+
+def assistant_text(api_response: Dict[str, Any]) -> str:
+    """
+    Try common shapes:
+      - {"messages":[{"role":"ASSISTANT","content": "..."} , ...], ...}
+      - {"content":"..."} or {"answer":{"content":"..."}}
+    Fallback to the whole response as JSON (kept for traceability)
+    """
+    msgs = api_response.get("messages") or api_response.get("data") or None
+    if isinstance(msgs, list):
+        for msg in reversed(msgs):
+            if not isinstance(msg, dict):
+                continue
+            role = str(msg.get("role", "")).upper()
+            if role in ("ASSISTANT", "AI"):
+                c = msg.get("content")
+                if isinstance(c, str) and c.strip():
+                    return c.strip()
+                if isinstance(c, dict) and isinstance(c.get("content"), str):
+                    return c["content"].strip()
+    ans = api_response.get("answer")
+    if isinstance(ans, dict) and isinstance(ans.get("content"), str):
+        return ans["content"].strip()
+    if isinstance(api_response.get("content"), str):
+        return api_response["content"].strip()
+    return json.dumps(api_response, ensure_ascii=False)
@@ -1,5 +1,16 @@
 # -*- coding: utf-8 -*-
-import re, json, time, requests, sys
+import re, json, time, requests, sys, sqlite3
+from metis_client import MetisClient, shared_client, close_clients
+from rate_limit import AdaptiveRateLimiter
+from response_cache import ResponseCache
+from metrics import Metrics
+from fast_judge import FastJudge, canonical_pair_key
+from checkpoint import Checkpoint
+from result_store import ResultStore
+from judgments import run_model
+from prompt_blocks import iter_blocks
+from verification_archive import VerificationArchive, SUFFIX as ARCHIVE_SUFFIX
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from typing import List, Dict, Any, Tuple
 
@@ -15,6 +26,8 @@ FILES = {
     "least_to_most": "F:\\A-project\\Final\\run\\meerkat - full dataset\\verify_least_to_most.txt",
     "zero_shot_direct": "F:\\A-project\\Final\\run\\meerkat - full dataset\\verify_zero_shot_direct.txt"
 }
+# مسیرهای .vpack (آرشیو فشردهٔ generate.py، verification/<METHOD>.vpack) هم پذیرفته می‌شوند:
+# رکوردها با ایندکس id→offset مستقیم از mmap خوانده می‌شوند، بدون split روی جداکننده
 
 # طبق خواسته‌ی شما دقیقاً با همین نام و مقدار:
 BASE_URL = "https://api.metisai.ir"
@@ -27,7 +40,36 @@ EQUAL_SEP = "-" * 80   # ======================
 CONNECT_TIMEOUT = 10
 READ_TIMEOUT = 120
 MAX_RETRIES = 5
-SLEEP_BETWEEN_MSGS = 0.2
+RATE_START = 2.0   # req/s اولیه؛ نرخ با AIMD تنظیم می‌شود و Retry-After رعایت می‌شود
+RATE_MAX = 20.0    # سقف نرخ (جایگزین SLEEP_BETWEEN_MSGS ثابت)
+CONCURRENCY = 4    # تعداد کیس‌های هم‌زمان (مشترک بین همهٔ روش‌ها؛ 1 → ترتیبی)
+SESSION_POOL = 0   # >0 → ساخت سشن‌ها از قبل در پس‌زمینه (از مسیر بحرانی هر کیس خارج می‌شود)
+
+# کش پاسخ‌ها روی دیسک (کلید = sha256 از botId + متن پرامپت + آدرس API)؛ "" → بدون کش
+CACHE_DIR = "~/.cache/dx-metis"
+CACHE_MAX_MB = 512   # سقف حجم؛ کم‌استفاده‌ترین‌ها (LRU) حذف می‌شوند
+_CACHE = None      # در هر اجرا توسط process_methods ساخته می‌شود (import پوشهٔ کش را نمی‌سازد)
+_LIMITER = None    # همین‌طور: یک نمونه برای کل اجرا
+
+# زمان‌سنجی: latency هر تماس (انتظار هدر / خواندن بدنه)، retry، حجم پاسخ، cases/min
+PROGRESS = False   # True → خط وضعیت زنده روی stderr
+
+# داور سریع محلی (fast_judge.py): خروجی‌های JSON تمیز با قوانین نرمال‌سازی/مترادف
+# همین پرامپت داوری می‌شوند؛ فقط موارد مبهم به API می‌روند. False → همه به API
+# پیش‌فرض خاموش تا توافق با داور LLM روی اجرای واقعی تأیید شود (bench.py judge --verify/--results)
+FAST_JUDGE = False
+_FAST = FastJudge() if FAST_JUDGE else None
+
+# حذف تکراری‌ها: جفت‌های (GT، خروجی دستیار) که بعد از نرمال‌سازی فاصله/مارک‌داون یکسان‌اند
+# (مثلاً روش‌ها یا مدل‌های مختلف با همان تشخیص) فقط یک بار داوری می‌شوند و نتیجه
+# برای همهٔ رکوردها نوشته می‌شود
+DEDUP = True
+_METRICS = None    # در هر اجرا توسط process_methods ساخته می‌شود
+
+# پایگاه نتایج ایندکس‌دار (result_store.py): هر رکورد/خطا با (مدل، روش، شمارهٔ DxBench) هم ذخیره می‌شود
+STORE_PATH = "results.sqlite"   # نسبی → زیر OUTPUT_DIR؛ مطلق → فایل مشترک با generate.py و مدل‌های دیگر؛ "" → خاموش
+STORE_MODEL = ""                # "" → نام پوشهٔ مدل (پوشهٔ والد results، مثل «meerkat - full dataset»)
+_STORE = None
 
 # ----------------------- کمکی‌ها -----------------------
 def detect_separator(text: str) -> str:
@@ -68,149 +110,277 @@ def extract_id_and_body(block: str):
 
     return dataset_id, body
 
-def load_done_indices(jsonl_path: Path) -> set:
-    done = set()
-    if jsonl_path.exists():
-        with jsonl_path.open("r", encoding="utf-8") as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                try:
-                    obj = json.loads(line)
-                    done.add(int(obj.get("idx")))
-                except Exception:
-                    pass
-    return done
-
 def append_jsonl(path: Path, obj: Dict[str, Any]):
     with path.open("a", encoding="utf-8") as f:
         f.write(json.dumps(obj, ensure_ascii=False) + "\n")
         f.flush()
 
 # ----------------------- اندپوینت‌ها (مطابق مرجع) -----------------------
+def _client() -> MetisClient:
+    """
+    کلاینت مشترک (keep-alive + connection pool) برای همهٔ درخواست‌ها؛
+    اگر SESSION_POOL > 0 باشد سشن‌ها از قبل در پس‌زمینه ساخته می‌شوند.
+    """
+    return shared_client(
+        API_KEY, BOT_ID, base_url=BASE_URL,
+        connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+        max_retries=MAX_RETRIES, session_pool=SESSION_POOL,
+        limiter=_LIMITER,
+        cache=_CACHE,
+    )
+
 def make_session() -> str:
     """
     ساخت سشن طبق کد مرجع:
     POST {BASE_URL}/api/v1/chat/session
     body: {"botId": ..., "user": None, "initialMessages": None}
+    (سشن‌ها یک‌بارمصرف‌اند؛ از استخر اگر فعال باشد)
     """
-    r = requests.post(
-        f"{BASE_URL}/api/v1/chat/session",
-        headers={"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"},
-        json={"botId": BOT_ID, "user": None, "initialMessages": None},
-        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
-    )
-    r.raise_for_status()
-    return r.json()["id"]
+    return _client().acquire_session()
 
 def send_message(session_id: str, content: str) -> Dict[str, Any]:
     """
     ارسال پیام طبق کد مرجع با ریترا‌ی/بک‌آف:
     POST {BASE_URL}/api/v1/chat/session/{session_id}/message
     body: {"message": {"content": ..., "type": "USER"}}
+    (پاسخ موفق در کش ذخیره می‌شود)
     """
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            r = requests.post(
-                f"{BASE_URL}/api/v1/chat/session/{session_id}/message",
-                headers={"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"},
-                json={"message": {"content": content, "type": "USER"}},
-                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)
-            )
-            if r.status_code == 429 or 500 <= r.status_code < 600:
-                if attempt < MAX_RETRIES:
-                    time.sleep(0.5 * (2 ** attempt))
-                    continue
-            r.raise_for_status()
-            return r.json()
-        except requests.RequestException as e:
-            if attempt < MAX_RETRIES:
-                time.sleep(0.5 * (2 ** attempt))
-                continue
-            raise e
+    return _client().send_message(session_id, content)
 
 # ----------------------- پردازش فایل‌ها -----------------------
-def process_method(method: str, prompt_file: Path):
-    out_path = OUTPUT_DIR / f"{method}.jsonl"
-    fail_path = OUTPUT_DIR / f"{method}.failures.jsonl"
+def judge_case(idx: int, dataset_id, body: str) -> Tuple[str, Dict[str, Any], float, bool]:
+    """
+    کار یک worker برای یک کیس (فقط تماس با API، بدون نوشتن فایل) + زمان‌سنجی:
+    (status, رکورد, ثانیه, از کش؟) که status یکی از "ok" / "fail" است.
+    """
+    t0 = time.perf_counter()
+    status, record = _judge_case(idx, dataset_id, body)
+    return status, record, time.perf_counter() - t0, record.pop("_cached", False)
 
-    raw_text = prompt_file.read_text(encoding="utf-8")
-    prompts = split_blocks(raw_text)
-    print(f"▶ {method}: {len(prompts)} prompts")
+def _judge_case(idx: int, dataset_id, body: str) -> Tuple[str, Dict[str, Any]]:
+    # مورد واضح؟ → داوری محلی در چند میکروثانیه، بدون تماس API.
+    # شکل answer مثل پاسخ API است تا dep-analyze.py همان answer.content را بخواند.
+    verdict = _FAST.judge_prompt(body) if _FAST is not None else None
+    if verdict is not None:
+        return "ok", {
+            "idx": idx,
+            "dataset_id": dataset_id,
+            "answer": {"content": json.dumps(verdict, ensure_ascii=False), "source": "fast_judge"}
+        }
 
-    done_idxs = load_done_indices(out_path)
-    if done_idxs:
-        print(f"↩️  Resuming: {len(done_idxs)} already done, will skip them")
+    # همین پرامپت قبلاً داوری شده؟ → از کش، بدون سشن و بدون تماس API
+    ans = _client().cached(body)
+    if ans is not None:
+        return "ok", {"idx": idx, "dataset_id": dataset_id, "answer": ans, "_cached": True}
 
+    # هر پرامپت = یک سشن مستقل (مثل کد مرجع)
     try:
-        for idx, block in enumerate(prompts):
-            if idx in done_idxs:
-                continue
+        session_id = make_session()
+    except requests.HTTPError as e:
+        return "fail", {
+            "idx": idx,
+            "dataset_id": dataset_id,
+            "error": "make_session_failed",
+            "status": getattr(e.response, "status_code", None),
+            "body": getattr(e.response, "text", None)
+        }
+    except Exception as e:
+        return "fail", {
+            "idx": idx,
+            "dataset_id": dataset_id,
+            "error": f"make_session_exc: {repr(e)}"
+        }
 
+    try:
+        ans = send_message(session_id, body)  # ← فقط بدنه ارسال می‌شود
+        # خروجی کم‌حجم: بدون prompt
+        return "ok", {"idx": idx, "dataset_id": dataset_id, "answer": ans}
+    except requests.HTTPError as e:
+        return "fail", {
+            "idx": idx,
+            "dataset_id": dataset_id,
+            "error": "send_message_failed",
+            "status": getattr(e.response, "status_code", None),
+            "body": getattr(e.response, "text", None)
+        }
+    except Exception as e:
+        return "fail", {
+            "idx": idx,
+            "dataset_id": dataset_id,
+            "error": f"send_message_exc: {repr(e)}"
+        }
+
+class MethodRun:
+    """وضعیت یک روش: فایل‌های خروجی، checkpoint و مکان‌نمای خواندن پرامپت‌ها (فقط نخ اصلی)."""
+
+    def __init__(self, method: str, prompt_file: Path):
+        self.method = method
+        self.model = STORE_MODEL or run_model(OUTPUT_DIR / f"{method}.jsonl")
+        self.out_path = OUTPUT_DIR / f"{method}.jsonl"
+        self.fail_path = OUTPUT_DIR / f"{method}.failures.jsonl"
+
+        # آرشیو .vpack: رکوردها به ترتیب ایندکس از mmap (هر رکورد = یک پرامپت، بدون جداکننده)
+        # فایل متنی: بلوک‌ها جریانی یکی‌یکی خوانده می‌شوند (حافظهٔ ثابت)؛
+        # جداکننده از اولین خط جداکننده‌ای که دیده شود تعیین می‌شود.
+        self.archive = VerificationArchive(prompt_file) if prompt_file.suffix == ARCHIVE_SUFFIX else None
+        if self.archive is not None:
+            self.prompts = enumerate(text for _, text in self.archive.items())
+        else:
+            self.prompts = enumerate(iter_blocks(prompt_file, separators=(DASH_SEP, EQUAL_SEP)))
+        print(f"▶ {method}: streaming prompts from {prompt_file.name}")
+
+        # ادامه از نقطهٔ قطع: ایندکس‌های انجام‌شده از فایل کنار <method>.jsonl.ckpt
+        # خوانده می‌شوند (بدون اسکن کامل JSONL)
+        self.ckpt = Checkpoint(self.out_path, key_field="idx")
+        self.done_idxs = {int(k) for k in self.ckpt.load() if k.lstrip("-").isdigit()}
+        if self.done_idxs:
+            print(f"↩️  {method}: resuming, {len(self.done_idxs)} already done, will skip them")
+
+    def next_case(self):
+        """کیس بعدیِ انجام‌نشده: (idx, dataset_id, body) یا None در پایان فایل."""
+        for idx, block in self.prompts:
+            if idx in self.done_idxs:
+                continue
             dataset_id, body = extract_id_and_body(block)
             if not body.strip():
-                append_jsonl(fail_path, {
+                record = {
                     "idx": idx,
                     "dataset_id": dataset_id,
                     "error": "empty_body_after_strip_id"
-                })
+                }
+                append_jsonl(self.fail_path, record)
+                self.store(record)
                 continue
+            return idx, dataset_id, body
+        return None
 
-            # هر پرامپت = یک سشن مستقل (مثل کد مرجع)
-            try:
-                session_id = make_session()
-            except requests.HTTPError as e:
-                append_jsonl(fail_path, {
-                    "idx": idx,
-                    "dataset_id": dataset_id,
-                    "error": "make_session_failed",
-                    "status": getattr(e.response, "status_code", None),
-                    "body": getattr(e.response, "text", None)
-                })
-                continue
-            except Exception as e:
-                append_jsonl(fail_path, {
-                    "idx": idx,
-                    "dataset_id": dataset_id,
-                    "error": f"make_session_exc: {repr(e)}"
-                })
-                continue
+    def write(self, status: str, record: Dict[str, Any], elapsed: float, cached: bool):
+        """نوشتن نتیجه (فقط نخ اصلی)."""
+        _METRICS.case(self.method, record["idx"], ok=status == "ok", total_s=elapsed, cached=cached)
+        if status == "ok":
+            self.ckpt.append_result(record)
+        else:
+            record["elapsed_s"] = round(elapsed, 3)
+            append_jsonl(self.fail_path, record)
+        self.store(record)
 
-            try:
-                ans = send_message(session_id, body)  # ← فقط بدنه ارسال می‌شود
-                # خروجی کم‌حجم: بدون prompt
-                append_jsonl(out_path, {
-                    "idx": idx,
-                    "dataset_id": dataset_id,
-                    "answer": ans
-                })
-            except requests.HTTPError as e:
-                append_jsonl(fail_path, {
-                    "idx": idx,
-                    "dataset_id": dataset_id,
-                    "error": "send_message_failed",
-                    "status": getattr(e.response, "status_code", None),
-                    "body": getattr(e.response, "text", None)
-                })
-            except Exception as e:
-                append_jsonl(fail_path, {
-                    "idx": idx,
-                    "dataset_id": dataset_id,
-                    "error": f"send_message_exc: {repr(e)}"
-                })
+    def close(self):
+        self.ckpt.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def store(self, record: Dict[str, Any]):
+        """همان رکورد در result store (کلید idx)؛ خطای پایگاه اجرا را متوقف نمی‌کند، JSONL مرجع است."""
+        if _STORE is None:
+            return
+        try:
+            _STORE.add(self.model, self.method, "judge", [record], key_field="idx")
+        except sqlite3.Error as e:
+            print(f"⚠️ result store write failed ({e}); JSONL outputs are unaffected")
+
+def process_methods(files: Dict[str, Any], workers: int = CONCURRENCY):
+    """
+    همهٔ روش‌ها در یک گذر: کیس‌های فایل‌ها به‌صورت نوبتی (round-robin) در یک
+    استخر مشترک از worker ها اجرا می‌شوند (کلاینت، محدودکنندهٔ نرخ و کش هم مشترک‌اند)،
+    پس زمان کل به ظرفیت API بستگی دارد نه به «تعداد روش × تعداد کیس».
+    نوشتن فایل‌ها فقط در نخ اصلی انجام می‌شود.
+    """
+    global _METRICS, _STORE, _CACHE, _LIMITER
+    if _CACHE is None and CACHE_DIR:
+        _CACHE = ResponseCache(Path(CACHE_DIR).expanduser(), max_bytes=CACHE_MAX_MB << 20)
+    if _LIMITER is None:
+        _LIMITER = AdaptiveRateLimiter(RATE_START, max_rate=RATE_MAX)
+    if STORE_PATH:
+        _STORE = ResultStore(OUTPUT_DIR / Path(STORE_PATH).expanduser())
+    # رکورد هر تماس/کیس → OUTPUT_DIR/calls.metrics.jsonl و خلاصهٔ p50/p95/p99 در پایان
+    _METRICS = Metrics(OUTPUT_DIR / "calls.metrics.jsonl", progress=PROGRESS)
+    _client().metrics = _METRICS
 
-            time.sleep(SLEEP_BETWEEN_MSGS)
+    runs = [MethodRun(method, Path(path)) for method, path in files.items()]
+    workers = max(1, workers)
+    window = 2 * workers            # حداکثر کیس در صف/در حال اجرا (همهٔ روش‌ها با هم)
+    pending = {}                    # future → کلید جفت
+    waiters = {}                    # کلید جفت → [(run, idx, dataset_id), ...] منتظر همان داوری
+    resolved = {}                   # کلید جفت → answer (داوری‌های موفق این اجرا)
+    n_cases = n_unique = 0
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="judge")
 
+    def fan_out(key, status, record, elapsed, cached):
+        """یک داوری → همهٔ رکوردهایی که همین جفت را خواسته بودند."""
+        first = True
+        for run, idx, dataset_id in waiters.pop(key):
+            rec = dict(record, idx=idx, dataset_id=dataset_id)
+            if not first:
+                rec["dedup"] = True
+            run.write(status, rec, elapsed if first else 0.0, cached or not first)
+            first = False
+        if status == "ok":
+            resolved[key] = record["answer"]
+
+    def drain(finished):
+        for fut in finished:
+            fan_out(pending.pop(fut), *fut.result())
+
+    try:
+        active = list(runs)
+        while active:
+            for run in list(active):
+                case = run.next_case()
+                if case is None:
+                    active.remove(run)
+                    continue
+                idx, dataset_id, body = case
+                n_cases += 1
+                key = canonical_pair_key(body) if DEDUP else (run.method, idx)
+                if key in resolved:          # قبلاً در همین اجرا داوری شده
+                    run.write("ok", {"idx": idx, "dataset_id": dataset_id,
+                                     "answer": resolved[key], "dedup": True}, 0.0, True)
+                    continue
+                if key in waiters:           # همین الان در حال داوری است
+                    waiters[key].append((run, idx, dataset_id))
+                    continue
+                if len(pending) >= window:
+                    drain(wait(pending, return_when=FIRST_COMPLETED).done)
+                n_unique += 1
+                waiters[key] = [(run, idx, dataset_id)]
+                pending[pool.submit(judge_case, *case)] = key
+        drain(wait(pending).done)
     except KeyboardInterrupt:
         print("\n🛑 Interrupted by user. Everything up to now is saved.")
+        pool.shutdown(wait=False, cancel_futures=True)
+        drain(f for f in list(pending) if f.done() and not f.cancelled())
+    finally:
+        pool.shutdown(wait=True)
+        for run in runs:
+            run.close()
+        print(f"⏱  {_client().limiter.summary()}")
+        if _CACHE is not None:
+            print(f"🗄  {_CACHE.summary()}")
+        if _FAST is not None:
+            print(f"⚡ {_FAST.summary()}")
+        if n_cases:
+            print(f"🔁 dedup: {n_cases} cases → {n_unique} judge requests "
+                  f"({n_cases - n_unique} shared, ratio {n_cases / max(1, n_unique):.2f}x)")
+        _METRICS.close()
+        print(f"📈 {_METRICS.summary()}")
+        if _STORE is not None:
+            print(f"🗃  {_STORE.summary()}")
+            _STORE.close()
+            _STORE = None
+
+def process_method(method: str, prompt_file: Path):
+    """یک روش به‌تنهایی (حالت قبلی)."""
+    process_methods({method: prompt_file})
 
 # ----------------------- اجرا -----------------------
 if __name__ == "__main__":
     if not API_KEY or not BOT_ID:
         raise SystemExit("❌ Fill in API_KEY and BOT_ID at the top of the script.")
 
-    for method, filepath in FILES.items():
-        process_method(method, Path(filepath))
+    try:
+        process_methods(FILES)
+    finally:
+        close_clients()
 
     print("✅ Done. Results are in:")
     for method in FILES.keys():
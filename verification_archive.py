@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Packed verification-prompt archive: one file per method instead of thousands of
+verification/<METHOD>/<id>.txt files plus a <METHOD>.all.txt bundle that the judge
+has to re-split by separator.
+
+    verification/<METHOD>.vpack       records back to back
+    verification/<METHOD>.vpack.idx   append-only index, one line per record:
+                                      <id>\\t<payload offset>\\t<payload bytes>\\n
+
+Each record in the pack is self-describing:
+
+    #VREC\\t<id>\\t<payload bytes>\\n<payload (UTF-8 verification prompt)>\\n
+
+— How it works —
+* Writers (result_writer.ResultWriter, group commits) append a whole group with one
+  write(), then its index lines. Readers mmap the pack: get(id) is one dict lookup
+  and one slice, items() streams every record without reading the file through
+  Python buffers or splitting on separators.
+* Duplicate ids (a case re-run after a crash) keep their first position in the
+  index order and point to the latest payload, so position-based consumers
+  (test-api-final.py's idx) see a stable order.
+* Crash safety (same idea as checkpoint.py): the pack is written before the index.
+  On open, the records after the last indexed one are recovered from their headers;
+  a torn last record is ignored by readers and cut off by the next writer. A missing
+  or stale index (pack replaced / shorter than the index says) is rebuilt by one
+  header scan, which skips over payloads by length.
+* refresh() picks up records appended by a writer in another process (e.g. the judge
+  following a running generate.py).
+
+Usage:
+    with VerificationArchive(path, writable=True) as pack:
+        pack.append_many([(cid, verif_text), ...])
+    pack = VerificationArchive(path)
+    pack["dxbench_481"]; len(pack); for cid, text in pack.items(): ...
+
+    python verification_archive.py list    single_step_cot.vpack
+    python verification_archive.py show    single_step_cot.vpack dxbench_481
+    python verification_archive.py export  single_step_cot.vpack out_dir/ [--ids dxbench_481 ...]
+    python verification_archive.py bundle  single_step_cot.vpack single_step_cot.all.txt
+    python verification_archive.py pack    single_step_cot.all.txt single_step_cot.vpack
+"""
+
+import os
+import mmap
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from prompt_blocks import iter_blocks, SEP_EQ, SEP_DASH
+
+
+MAGIC        = b"#VREC"
+SUFFIX       = ".vpack"
+INDEX_SUFFIX = ".idx"
+BUNDLE_SEP   = "\n" + ("-" * 80) + "\n\n"   # between records of the legacy <METHOD>.all.txt
+
+
+def index_path(path: Path) -> Path:
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+class VerificationArchive:
+    """Append-only packed archive of verification prompts with an id → (offset, length) index."""
+
+    def __init__(self, path: Path, writable: bool = False, fsync: bool = False):
+        self.path = Path(path)
+        self.index_path = index_path(self.path)
+        self.writable = writable
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._end = 0          # end of the last complete record
+        self._mm: Optional[mmap.mmap] = None
+        self._pack_f = None
+        self._idx_f = None
+
+        if writable:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.touch()
+        elif not self.path.exists():
+            raise FileNotFoundError(self.path)
+        self._load()
+
+    # ---- loading -------------------------------------------------------------
+
+    def _load(self):
+        size = self.path.stat().st_size
+        indexed = self._read_index()
+        if self._end > size:
+            # pack replaced / truncated behind the index → rebuild from the pack alone
+            self._index, self._end = {}, 0
+            indexed = False
+        self._map(size)
+        recovered = self._scan(self._end, size)
+
+        if self.writable:
+            if self._end < size:
+                with self.path.open("r+b") as f:   # torn last record
+                    f.truncate(self._end)
+                self._map(self._end)
+            if not indexed:
+                self._rewrite_index()
+            elif recovered:
+                self._open_for_append()
+                self._write_index_lines(recovered)
+            self._open_for_append()
+
+    def _read_index(self) -> bool:
+        if not self.index_path.exists():
+            return False
+        with self.index_path.open("rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return False   # torn last index line → rewritten; the header scan recovers the record
+                try:
+                    cid, off, n = line.decode("utf-8").rstrip("\n").split("\t")
+                    off, n = int(off), int(n)
+                except ValueError:
+                    continue
+                self._index[cid] = (off, n)
+                self._end = max(self._end, off + n + 1)
+        return True
+
+    def _map(self, size: int):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if size > 0:
+            with self.path.open("rb") as f:
+                self._mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _scan(self, start: int, size: int) -> List[Tuple[str, int, int]]:
+        """Index the complete records in [start, size) from their headers; returns the new entries."""
+        found = []
+        pos, mm = start, self._mm
+        while mm is not None and pos < size:
+            nl = mm.find(b"\n", pos, size)
+            if nl < 0 or not mm[pos:pos + len(MAGIC)] == MAGIC:
+                break
+            try:
+                _, cid, n = mm[pos:nl].decode("utf-8").split("\t")
+                n = int(n)
+            except ValueError:
+                break
+            off = nl + 1
+            if off + n + 1 > size:
+                break   # torn last record
+            self._index[cid] = (off, n)
+            found.append((cid, off, n))
+            pos = off + n + 1
+        self._end = pos
+        return found
+
+    def refresh(self) -> int:
+        """Pick up records appended since the last load / refresh; returns how many."""
+        with self._lock:
+            size = self.path.stat().st_size
+            if size <= self._end:
+                return 0
+            self._map(size)
+            return len(self._scan(self._end, size))
+
+    # ---- writing -------------------------------------------------------------
+
+    def _open_for_append(self):
+        if self._pack_f is None:
+            self._pack_f = self.path.open("ab")
+        if self._idx_f is None:
+            self._idx_f = self.index_path.open("ab")
+
+    def _rewrite_index(self):
+        tmp = self.index_path.with_name(self.index_path.name + ".tmp")
+        with tmp.open("wb") as f:
+            f.write(b"".join(_index_line(cid, off, n) for cid, (off, n) in self._index.items()))
+        os.replace(tmp, self.index_path)
+
+    def _write_index_lines(self, entries: Iterable[Tuple[str, int, int]]):
+        self._idx_f.write(b"".join(_index_line(cid, off, n) for cid, off, n in entries))
+        self._idx_f.flush()
+
+    def append_many(self, items: Iterable[Tuple[str, str]]):
+        """Append (id, text) records with one write, then their index lines."""
+        if not self.writable:
+            raise PermissionError(f"{self.path} is opened read-only")
+        with self._lock:
+            chunks, entries = [], []
+            pos = self._end
+            for cid, text in items:
+                cid = str(cid)
+                if not cid or "\t" in cid or "\n" in cid:
+                    raise ValueError(f"invalid record id {cid!r}")
+                payload = text.encode("utf-8")
+                header = b"%s\t%s\t%d\n" % (MAGIC, cid.encode("utf-8"), len(payload))
+                chunks += (header, payload, b"\n")
+                entries.append((cid, pos + len(header), len(payload)))
+                pos += len(header) + len(payload) + 1
+            if not entries:
+                return
+            self._pack_f.write(b"".join(chunks))
+            self._pack_f.flush()
+            if self.fsync:
+                os.fsync(self._pack_f.fileno())
+            self._write_index_lines(entries)
+            for cid, off, n in entries:
+                self._index[cid] = (off, n)
+            self._end = pos
+
+    def append(self, cid: str, text: str):
+        self.append_many([(cid, text)])
+
+    # ---- reading -------------------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __contains__(self, cid) -> bool:
+        return str(cid) in self._index
+
+    def ids(self) -> List[str]:
+        return list(self._index)
+
+    def sizes(self) -> List[Tuple[str, int]]:
+        """(id, payload bytes) in index order."""
+        return [(cid, n) for cid, (_, n) in self._index.items()]
+
+    def get(self, cid: str, default: Optional[str] = None) -> Optional[str]:
+        entry = self._index.get(str(cid))
+        if entry is None:
+            return default
+        return self._payload(*entry)
+
+    def __getitem__(self, cid: str) -> str:
+        text = self.get(cid)
+        if text is None:
+            raise KeyError(cid)
+        return text
+
+    def _payload(self, off: int, n: int) -> str:
+        with self._lock:
+            if self._mm is None or off + n > len(self._mm):
+                self._map(self._end)   # written through this handle after the last mapping
+            return self._mm[off:off + n].decode("utf-8")
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """(id, text) in index order (first appearance of every id, latest payload)."""
+        for cid, entry in list(self._index.items()):
+            yield cid, self._payload(*entry)
+
+    def export(self, out_dir: Path, ids: Optional[Iterable[str]] = None) -> int:
+        """verification/<METHOD>/<id>.txt files on demand (all records, or only `ids`)."""
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        n = 0
+        for cid in (self.ids() if ids is None else ids):
+            (out_dir / f"{cid}.txt").write_text(self[cid], encoding="utf-8")
+            n += 1
+        return n
+
+    def write_bundle(self, path: Path) -> int:
+        """Legacy <METHOD>.all.txt (separator-delimited) for tools that still read it."""
+        n = 0
+        with Path(path).open("w", encoding="utf-8") as f:
+            for _, text in self.items():
+                f.write(text + BUNDLE_SEP)
+                n += 1
+        return n
+
+    def close(self):
+        with self._lock:
+            for f in (self._pack_f, self._idx_f):
+                if f is not None:
+                    f.close()
+            self._pack_f = self._idx_f = None
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _index_line(cid: str, off: int, n: int) -> bytes:
+    return f"{cid}\t{off}\t{n}\n".encode("utf-8")
+
+def block_id(block: str) -> Optional[str]:
+    """The 'ID: <id>' line a verification prompt starts with (generate.build_verification_prompt)."""
+    for line in block.splitlines():
+        if line.strip():
+            s = line.strip()
+            return s.split(":", 1)[1].strip() if s.lower().startswith("id:") else None
+    return None
+
+def pack_bundle(src: Path, dst: Path) -> int:
+    """A separator-delimited bundle / verify_*.txt → archive (blocks without an ID line get <stem>_<n>)."""
+    with VerificationArchive(dst, writable=True) as pack:
+        batch = []
+        for i, block in enumerate(iter_blocks(src, separators=(SEP_DASH, SEP_EQ))):
+            text = block.strip("\n")
+            batch.append((block_id(text) or f"{Path(src).stem}_{i:04d}", text))
+            if len(batch) >= 1000:
+                pack.append_many(batch)
+                batch = []
+        pack.append_many(batch)
+        return len(pack)
+
+
+# =============================================================================
+#                                    CLI
+# =============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect / export a packed verification archive")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("list", help="Record ids and sizes")
+    p.add_argument("archive", type=Path)
+    p = sub.add_parser("show", help="Print one record")
+    p.add_argument("archive", type=Path)
+    p.add_argument("id")
+    p = sub.add_parser("export", help="Per-case <id>.txt files")
+    p.add_argument("archive", type=Path)
+    p.add_argument("out_dir", type=Path)
+    p.add_argument("--ids", nargs="+", help="Only these ids (default: all)")
+    p = sub.add_parser("bundle", help="Write a legacy separator-delimited <METHOD>.all.txt")
+    p.add_argument("archive", type=Path)
+    p.add_argument("out", type=Path)
+    p = sub.add_parser("pack", help="Convert a .all.txt / verify_*.txt file into an archive")
+    p.add_argument("src", type=Path)
+    p.add_argument("archive", type=Path)
+    args = parser.parse_args()
+
+    if args.cmd == "pack":
+        print(f"✔ {pack_bundle(args.src, args.archive)} records → {args.archive}")
+        return
+    with VerificationArchive(args.archive) as pack:
+        if args.cmd == "list":
+            for cid, n in pack.sizes():
+                print(f"{cid}\t{n}")
+            print(f"({len(pack)} records)")
+        elif args.cmd == "show":
+            print(pack[args.id])
+        elif args.cmd == "export":
+            print(f"✔ {pack.export(args.out_dir, args.ids)} files → {args.out_dir}")
+        else:
+            print(f"✔ {pack.write_bundle(args.out)} records → {args.out}")
+
+if __name__ == "__main__":
+    main()